@@ -1,4 +1,7 @@
 from .alchemy import Alchemy
+from .question_index import QuestionIndex
+from .survey_table import SurveyTable
+from .sparse import to_dense, to_sparse
 from . import alchemy_types
 
-__all__ = ['Alchemy', 'alchemy_types']
\ No newline at end of file
+__all__ = ['Alchemy', 'QuestionIndex', 'SurveyTable', 'alchemy_types', 'to_dense', 'to_sparse']
\ No newline at end of file
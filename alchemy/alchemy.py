@@ -1,38 +1,35 @@
+import asyncio
+import functools
+import logging
 import re
 import sqlite3
-from typing import List, Literal, Optional, Union
-from . import alchemy_types
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import chain
+from typing import Any, Callable, ContextManager, Iterable, Iterator, List, Literal, Optional, Union
+from . import export
 from . import nullable_category_dtype
+from . import pivot
+from .connection_pool import ConnectionPool
+from .migrations import LATEST_VERSION, configure_connection, connect_read_only, migrate, schema_version, variable_name, variable_prefix
+from .query_cache import DEFAULT_QUERY_CACHE_BYTES, QueryCache
+from .question_index import QuestionIndex
+from .storage import CHUNK_KEYS, DEFAULT_CHUNKSIZE, EXTRA_RECORD_COLUMNS, RECORD_COLUMNS, ParquetStorage, RecordSelection, SQLiteStorage, flat_variable_names
+from .survey_table import SurveyTable
+from .table_cache import DEFAULT_MAX_BYTES, TableCache
 
 import pandas as pd
 import numpy as np
 
-RECORDS_DTYPES = {
-  "survey_id":     np.int32,
-  "response_id":   np.int32,
-  "question":      np.str_,
-  "subquestion":   np.str_,
-  "option":        np.str_,
-  "answer":        np.str_,
-  "question_type": np.int8,
-}
-
-
-GET_RECORDS = '''
-  SELECT 
-    a.survey_id,
-    a.response_id,
-    q1.shortname as question,
-    q2.title     as subquestion,
-    o.value      as option,
-    o.option_order,
-    a.answer,
-    q1.question_type
-  FROM answer as a 
-  INNER JOIN question as q1 ON q1.id = a.question_id
-  LEFT  JOIN question as q2 ON q2.id = a.sub_question_id
-  LEFT  JOIN option   as o  ON o.id  = a.option_id
-  {where} ORDER BY a.survey_id, a.response_id, question;''';
+logger = logging.getLogger(__name__)
+
+# All a flat table needs, the column names coming precomputed
+FLAT_RECORD_COLUMNS = ["survey_id", "response_id", "variable_name", "answer"]
+
+EXECUTORS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+GET_SURVEY_IDS = "SELECT id FROM survey ORDER BY id;"
 
 def replace_non_alphanumeric(input_string):
     ret = re.sub(r'[^a-zA-Z0-9]', '_', input_string)
@@ -41,114 +38,447 @@ def replace_non_alphanumeric(input_string):
     return ret
 
 class Alchemy():
-  def __init__(self, db_path: str):
-    self._conn = sqlite3.connect(db_path)
+  def __init__(self, db_path: str, 
+                     storage:     Optional[Union[Literal["sqlite", "parquet"], Any]]="sqlite",
+                     parquet_dir: Optional[str]=None,
+                     dtype_backend: Literal["numpy", "pyarrow"]="numpy",
+                     cache_dir:     Optional[str]=None,
+                     cache_max_bytes: int=DEFAULT_MAX_BYTES,
+                     read_only:     bool=False,
+                     query_cache:   bool=False,
+                     query_cache_max_bytes: int=DEFAULT_QUERY_CACHE_BYTES,
+                     query_copy_on_read:    bool=True,
+                     pool_size:     Optional[int]=None,
+                     pool_timeout:  Optional[float]=None,
+                     migrate:       bool=False):
+    # dtype_backend="pyarrow" loads the text record columns as arrow strings.
+    # With a cache_dir, tables built by get_table are kept on disk until a
+    # load changes one of their surveys, see TableCache. read_only=True opens
+    # an already migrated database without write access. query_cache=True
+    # keeps the results of `query` in memory until the database changes,
+    # see QueryCache. With a pool_size the instance can be shared between
+    # threads: every read runs on a read-only connection out of a
+    # ConnectionPool of that size, and the a* methods run reads on a thread
+    # pool for asyncio code. The schema is only upgraded when asked to, with
+    # migrate=True or a call to migrate().
+    if pool_size is not None and db_path == ":memory:":
+      raise ValueError("a connection pool cannot be used with an in-memory database")
+    # pooled, this connection is only used under locks (migrating, and the
+    # query cache's change checks), never by two threads at once
+    same_thread     = pool_size is None
+    self._db_path   = db_path
+    self._read_only = read_only
+    if read_only:
+      self._own_conn = connect_read_only(db_path, check_same_thread=same_thread)
+    else:
+      self._own_conn = configure_connection(sqlite3.connect(db_path, check_same_thread=same_thread))
+      if migrate:
+        self.migrate()
+      elif self.schema_version < LATEST_VERSION:
+        logger.warning(f"{db_path} is at schema version {self.schema_version}, not the current "
+                       f"{LATEST_VERSION}; call migrate() or run `alchemy migrate` before reading it")
+    self._pool          = ConnectionPool(db_path, pool_size, pool_timeout) if pool_size is not None else None
+    self._async_pool    = None
+    self._async_lock    = threading.Lock()
+    self._storage_kind  = storage
+    self._parquet_dir   = parquet_dir
+    self._dtype_backend = dtype_backend
+    self._cache = TableCache(cache_dir, cache_max_bytes) if cache_dir else None
+    self._query_cache = QueryCache(query_cache_max_bytes, query_copy_on_read) if query_cache else None
+    if storage == "parquet" and not parquet_dir:
+      raise ValueError("parquet storage needs a `parquet_dir`")
+    # any object with read_records(survey_ids, columns, decode, categorical)
+    # and iter_records(survey_ids, columns, decode, chunksize, by, categorical)
+    # methods can stand in for the built in storages
+    self._own_storage = self._make_storage(self._own_conn)
+
+  @property
+  def schema_version(self) -> int:
+    return schema_version(self._own_conn)
+
+  def migrate(self, target: Optional[int]=None, vacuum: bool=False) -> int:
+    # Upgrades the database schema to `target` (default: the latest), see
+    # migrations.migrate. Returns the version it is at.
+    if self._read_only:
+      raise RuntimeError("a read-only Alchemy cannot migrate its database")
+    before = self.schema_version
+    after  = migrate(self._own_conn, target, vacuum=vacuum)
+    if after != before:
+      logger.info(f"migrated {self._db_path} from schema version {before} to {after}")
+    return after
+
+  def close(self):
+    if self._async_pool is not None:
+      self._async_pool.shutdown()
+    if self._pool is not None:
+      self._pool.close()
+    self._own_conn.close()
+
+  @property
+  def _conn(self) -> sqlite3.Connection:
+    # the pooled connection of the read this thread is in, if any
+    conn = self._pool.current() if self._pool is not None else None
+    return conn if conn is not None else self._own_conn
+
+  @property
+  def _storage(self):
+    conn = self._conn
+    return self._own_storage if conn is self._own_conn else self._make_storage(conn)
+
+  def _make_storage(self, conn: sqlite3.Connection):
+    if self._storage_kind is None or self._storage_kind == "sqlite":
+      return SQLiteStorage(conn, self._dtype_backend)
+    if self._storage_kind == "parquet":
+      return ParquetStorage(conn, self._parquet_dir, self._dtype_backend)
+    return self._storage_kind
+
+  def _reading(self) -> ContextManager:
+    # Holds a pooled connection for the calls inside, nested ones included
+    return self._pool.connection() if self._pool is not None else nullcontext()
+
+  def _iter_reading(self, records: Callable[[], Iterator[pd.DataFrame]]) -> Iterator[pd.DataFrame]:
+    # a stream keeps its connection until it is exhausted or closed
+    with self._reading():
+      yield from records()
   
   def get_table(self, records:     Optional[pd.DataFrame]=None, 
                       survey_ids:  Optional[Union[int, List[int]]]=None, 
-                      column_mode: Optional[Literal["flat", "multi"]]="flat") -> pd.DataFrame:
-    if type(records) == None:
-      records = self.get_records(survey_ids)
-      return self._pivot_table(records)
-    return self._pivot_table(records, survey_ids, column_mode)
-
-  def get_records(self, survey_ids: Optional[Union[int, List[int]]]=None) -> pd.DataFrame:
-    where_clauses = []
-    params = []
-    if survey_ids:
-      if type(survey_ids) == int:
-        where_clauses.append("a.survey_id = ?")
-        params.append(survey_ids)
-      elif type(survey_ids) == list:
-        if type(survey_ids[0]) == int:
-          where_clauses.append(f"a.survey_id IN ({','.join(['?'] * len(survey_ids))})")
-          params += survey_ids
-        else:
-          raise ValueError(f"get_records expects `survey_ids` to be an int or list of ints, got list of {type(survey_ids[0])}")
-      else:
-        raise ValueError(f"get_table expects `survey_ids` to be an int or a list of ints, got {type(survey_ids)}")
-    query = self._build_query(GET_RECORDS, where_clauses)
-    return pd.read_sql_query(query, self._conn, params=params, dtype=RECORDS_DTYPES)
-
-  def query(self, query: str) -> pd.DataFrame:
-      return pd.read_sql(query, con=self._conn)
-
-  def _build_query(self, select_clause: str, where_clauses: Optional[Union[list[str], str]]=None):
-      query = select_clause
-      where_stmt = ' AND '.join(where_clauses)
-      if where_stmt: where_stmt = f"WHERE {where_stmt}"
-      return query.format(where=where_stmt)
-  
+                      column_mode: Optional[Literal["flat", "multi"]]="flat",
+                      chunksize:   Optional[int]=None,
+                      workers:     Optional[int]=None,
+                      executor:    Literal["thread", "process"]="thread",
+                      sparse:      bool=False) -> pd.DataFrame:
+    # With a chunksize the records are streamed and pivoted a chunk at a
+    # time, so only the finished table has to fit in memory. With `workers`
+    # each survey is read and pivoted on its own in a pool of that many
+    # threads or processes, each through a read-only connection of its own,
+    # and the results are stacked into the same table; the workers only see
+    # committed data. With `sparse` the
+    # multi select columns, and in flat mode the matrix / table columns too,
+    # are pd.SparseDtype, only their answered cells stored; see to_dense for
+    # the dense table.
+    if records is not None:
+      return self._pivot_table(records, survey_ids, column_mode, sparse)
+    with self._reading():
+      return self._get_table(survey_ids, column_mode, chunksize, workers, executor, sparse=sparse)
+
+  def lazy_table(self, survey_ids:  Optional[Union[int, List[int]]]=None,
+                       column_mode: Optional[Literal["flat", "multi"]]="flat") -> SurveyTable:
+    # A get_table to be narrowed with select / filter before it is read,
+    # see SurveyTable
+    self._survey_id_list(survey_ids)
+    return SurveyTable(self, survey_ids, column_mode)
+
+  def _get_table(self, survey_ids:  Optional[Union[int, List[int]]],
+                       column_mode: Optional[Literal["flat", "multi"]],
+                       chunksize:   Optional[int],
+                       workers:     Optional[int],
+                       executor:    Literal["thread", "process"],
+                       selection:   Optional[RecordSelection]=None,
+                       sparse:      bool=False) -> pd.DataFrame:
+    if workers is not None:
+      self._check_workers(workers, executor)
+    if self._cache is None:
+      return self._build_table(survey_ids, column_mode, chunksize, workers, executor, selection, sparse)
+    key   = self._cache.key(self._conn, self._survey_id_list(survey_ids), column_mode, self._dtype_backend, selection,
+                            sparse)
+    table = self._cache.get(key)
+    if table is None:
+      table = self._build_table(survey_ids, column_mode, chunksize, workers, executor, selection, sparse)
+      self._cache.put(key, table)
+    return table
+
+  def _build_table(self, survey_ids:  Optional[Union[int, List[int]]],
+                         column_mode: Optional[Literal["flat", "multi"]],
+                         chunksize:   Optional[int],
+                         workers:     Optional[int]=None,
+                         executor:    Literal["thread", "process"]="thread",
+                         selection:   Optional[RecordSelection]=None,
+                         sparse:      bool=False) -> pd.DataFrame:
+    if workers and workers > 1:
+      return self._build_table_parallel(survey_ids, column_mode, chunksize, workers, executor, selection, sparse)
+    columns = _record_columns(column_mode, sparse)
+    if chunksize:
+      return self._pivot_chunks(self.iter_records(survey_ids, chunksize, columns, selection=selection),
+                                survey_ids, column_mode, selection, sparse)
+    return self._pivot_table(self.get_records(survey_ids, columns, selection=selection), column_mode=column_mode,
+                             sparse=sparse)
+
+  def _build_table_parallel(self, survey_ids:  Optional[Union[int, List[int]]],
+                                  column_mode: Optional[Literal["flat", "multi"]],
+                                  chunksize:   Optional[int],
+                                  workers:     int,
+                                  executor:    Literal["thread", "process"],
+                                  selection:   Optional[RecordSelection]=None,
+                                  sparse:      bool=False) -> pd.DataFrame:
+    # Records come ordered by survey, so the surveys' parts stacked in id
+    # order are the parts of one pass over all of them.
+    ids = self._survey_id_list(survey_ids)
+    ids = sorted(set(ids)) if ids else [row[0] for row in self._conn.execute(GET_SURVEY_IDS)]
+    # the workers read through connections of their own, so they only see
+    # what has been committed
+    if self._own_conn.in_transaction:
+      raise RuntimeError("get_table cannot use `workers` while this Alchemy has uncommitted writes, "
+                         "commit them first")
+    args = [(self._db_path, self._storage_kind, self._parquet_dir, self._dtype_backend, survey_id, column_mode, chunksize,
+             selection, sparse) for survey_id in ids]
+    with EXECUTORS[executor](max_workers=min(workers, max(len(ids), 1))) as pool:
+      parts = list(chain.from_iterable(pool.map(_survey_table_parts, *zip(*args)))) if args else []
+    if not parts:
+      return self._pivot_table(self.get_records(survey_ids, selection=selection), column_mode=column_mode,
+                               sparse=sparse)
+    return self._stack_parts(parts, column_mode, sparse)
+
+  def _check_workers(self, workers: int, executor: str):
+    if workers < 1:
+      raise ValueError(f"get_table expects a positive number of `workers`, got {workers}")
+    if executor not in EXECUTORS:
+      raise ValueError(f"get_table expects `executor` to be one of {list(EXECUTORS)}, got {executor}")
+    if self._storage_kind not in (None, "sqlite", "parquet"):
+      raise ValueError("get_table can only use `workers` with the sqlite or parquet storage")
+    if self._db_path == ":memory:":
+      raise ValueError("get_table cannot use `workers` on an in-memory database")
+
+  def export(self, out_dir:    str,
+                   survey_ids: Optional[Union[int, List[int]]]=None,
+                   format:     Literal["csv", "parquet"]="csv",
+                   chunksize:  int=DEFAULT_CHUNKSIZE,
+                   per_chunk:  bool=False) -> List[str]:
+    # Writes the flat table of each survey (default: all of them) to
+    # out_dir/{survey_id}.csv or .parquet, read and pivoted `chunksize`
+    # records at a time, so memory stays bounded whatever the survey's size.
+    # Columns come in question order (see export.export_columns), the same
+    # in every chunk. With per_chunk each chunk is a file of its own, see
+    # export.write_survey. Returns the paths written.
+    export.check_format(format)
+    if chunksize < 1:
+      raise ValueError(f"export expects a positive `chunksize`, got {chunksize}")
+    paths = []
+    with self._reading():
+      ids = self._survey_id_list(survey_ids) or [row[0] for row in self._conn.execute(GET_SURVEY_IDS)]
+      for survey_id in ids:
+        columns = export.export_columns(self._conn, survey_id)
+        tables  = (self._table_part(chunk, "flat")
+                   for chunk in self.iter_records(survey_id, chunksize, FLAT_RECORD_COLUMNS) if len(chunk))
+        paths  += export.write_survey(tables, columns, out_dir, survey_id, format, per_chunk)
+    return paths
+
+  def get_records(self, survey_ids: Optional[Union[int, List[int]]]=None,
+                        columns:    Optional[List[str]]=None,
+                        decode:     bool=True,
+                        categorical: bool=False,
+                        selection:  Optional[RecordSelection]=None) -> pd.DataFrame:
+    # decode=False returns answers as a categorical of the stored answer values.
+    # categorical=True reads only integer ids and returns question, subquestion,
+    # option and answer as categoricals, in the same rows and order. A
+    # selection (see SurveyTable) narrows the records read.
+    self._check_columns(columns)
+    with self._reading():
+      return self._storage.read_records(self._survey_id_list(survey_ids), columns, decode,
+                                        categorical=categorical, **self._selection_kwargs(selection))
+
+  def iter_records(self, survey_ids: Optional[Union[int, List[int]]]=None,
+                         chunksize:  int=DEFAULT_CHUNKSIZE,
+                         columns:    Optional[List[str]]=None,
+                         decode:     bool=True,
+                         by:         Literal["response", "survey"]="response",
+                         categorical: bool=False,
+                         selection:  Optional[RecordSelection]=None) -> Iterator[pd.DataFrame]:
+    # Same records as get_records, as a stream of DataFrames of roughly
+    # `chunksize` rows that never split a response (or, with by="survey", a
+    # survey) across two chunks.
+    self._check_columns(columns)
+    if by not in CHUNK_KEYS:
+      raise ValueError(f"iter_records expects `by` to be one of {list(CHUNK_KEYS)}, got {by}")
+    if chunksize < 1:
+      raise ValueError(f"iter_records expects a positive `chunksize`, got {chunksize}")
+    survey_ids = self._survey_id_list(survey_ids)
+    return self._iter_reading(lambda: self._storage.iter_records(survey_ids, columns, decode, chunksize, by,
+                                                                 categorical=categorical,
+                                                                 **self._selection_kwargs(selection)))
+
+  def _selection_kwargs(self, selection: Optional[RecordSelection]) -> dict:
+    # only handed to the storage when there is one, so storages written
+    # before selections existed keep working without them
+    return {} if selection is None else {"selection": selection}
+
+  def _check_columns(self, columns: Optional[List[str]]):
+    if columns:
+      unknown = [c for c in columns if c not in RECORD_COLUMNS + EXTRA_RECORD_COLUMNS]
+      if unknown:
+        raise ValueError(f"get_records got unknown columns {unknown}, expected a subset of {RECORD_COLUMNS + EXTRA_RECORD_COLUMNS}")
+
+  def _survey_id_list(self, survey_ids: Optional[Union[int, List[int]]]) -> Optional[List[int]]:
+    if not survey_ids:
+      return None
+    if type(survey_ids) == int:
+      return [survey_ids]
+    elif type(survey_ids) == list:
+      if type(survey_ids[0]) == int:
+        return survey_ids
+      raise ValueError(f"get_records expects `survey_ids` to be an int or list of ints, got list of {type(survey_ids[0])}")
+    raise ValueError(f"get_table expects `survey_ids` to be an int or a list of ints, got {type(survey_ids)}")
+
+  def question_index(self, survey_ids: Optional[Union[int, List[int]]]=None) -> QuestionIndex:
+    with self._reading():
+      return QuestionIndex.from_db(self._conn, survey_ids)
+
+  def query(self, query: str, params: Optional[Union[list, tuple, dict]]=None, cache: bool=True) -> pd.DataFrame:
+      # cache=False reads past the query cache, for queries whose result can
+      # change without the data changing (random(), date('now'), ...)
+      with self._reading():
+        read = lambda: pd.read_sql(query, con=self._conn, params=params)
+        if self._query_cache is None or not cache:
+          return read()
+        # changes are watched for on the instance's own connection, whose
+        # data_version moves with every commit, pooled readers' included
+        return self._query_cache.fetch(self._own_conn, query, params, read)
+
+  # asyncio wrappers, each running its read on a worker thread (and pooled
+  # connection) so the event loop is never blocked on sqlite
+
+  async def aquery(self, query: str, params: Optional[Union[list, tuple, dict]]=None, cache: bool=True) -> pd.DataFrame:
+    return await self._run_async(self.query, query, params, cache)
+
+  async def aget_table(self, *args, **kwargs) -> pd.DataFrame:
+    return await self._run_async(self.get_table, *args, **kwargs)
+
+  async def aget_records(self, *args, **kwargs) -> pd.DataFrame:
+    return await self._run_async(self.get_records, *args, **kwargs)
+
+  def _run_async(self, read: Callable, *args, **kwargs) -> "asyncio.Future":
+    if self._pool is None:
+      raise RuntimeError("the async methods need a pooled Alchemy, pass a `pool_size`")
+    with self._async_lock:
+      if self._async_pool is None:
+        self._async_pool = ThreadPoolExecutor(max_workers=self._pool.size, thread_name_prefix="alchemy")
+    return asyncio.get_running_loop().run_in_executor(self._async_pool, functools.partial(read, *args, **kwargs))
+
   def _pivot_table(self, records: pd.DataFrame, 
                    survey_ids:        Optional[Union[int, List[int]]]=None,
-                   column_mode:      Optional[Literal["flat", "multi"]]="flat") -> pd.DataFrame:
-    tmp_records = records.copy()
+                   column_mode:      Optional[Literal["flat", "multi"]]="flat",
+                   sparse:           bool=False) -> pd.DataFrame:
+    # records is only ever read from here on, so it is not copied up front
+    records = self._decode_categoricals(records)
     if survey_ids:
       if type(survey_ids) == int:
-        tmp_records = tmp_records.loc[records["survey_id"] == survey_ids]
+        records = records.loc[records["survey_id"] == survey_ids]
       elif type(survey_ids) == list:
         if type(survey_ids[0]) == int:
-          tmp_records = tmp_records.loc[records["survey_id"].isin(survey_ids)]
+          records = records.loc[records["survey_id"].isin(survey_ids)]
         else:
           raise ValueError(f"survey_ids must be either an integer or a list of integers, got list of f{type(survey_ids[0])}")
       else:
         raise ValueError(f"survey_ids must be either an integer or a list of integers, got {type(survey_ids)}")
     if column_mode == "flat":
-      return self._flatten_table(tmp_records)
+      return self._flatten_table(records, sparse)
     else: 
-      tmp_records["tmp_option"] = ""
-      single_select = tmp_records.loc[tmp_records["question_type"].isin(alchemy_types.SINGLE_SELECT_QUESTIONS)]
-      single_select_cats = (single_select.copy().drop_duplicates(subset=["question", "option"])
-                                              .pivot(columns="question", index="option_order", values="option"))
-      single_select = single_select.pivot(columns=["question", "subquestion", "tmp_option"], values="option", index=["survey_id", "response_id"])
+      # the sections share one row index, so they only have to be put side by side
+      single_select, single_select_options, multi_select, value = pivot.multi_sections(records, sparse=sparse)
+      self._categorize_single_select(single_select, single_select_options)
+      return pd.concat([single_select, multi_select, value], axis=1)
+
+  def _decode_categoricals(self, records: pd.DataFrame) -> pd.DataFrame:
+    # The pivots work on plain strings; categorical records (and undecoded
+    # answers) are turned back into the dtype of their categories.
+    categorical = [c for c in records.columns if isinstance(records[c].dtype, pd.CategoricalDtype)]
+    if not categorical:
+      return records
+    return records.astype({c: records[c].cat.categories.dtype for c in categorical})
+
+  def _pivot_sections(self, records: pd.DataFrame, sparse: bool=False):
+      return pivot.multi_sections(records, aligned=False, sparse=sparse)
+
+  def _categorize_single_select(self, single_select: pd.DataFrame, options: pd.DataFrame):
+      single_select_cats = (options.drop_duplicates(subset=["question", "option"])
+                                   .pivot(columns="question", index="option_order", values="option"))
       for question in single_select_cats.columns:
         cat = nullable_category_dtype.NullableCategory(single_select_cats[question].dropna().unique(), ordered=True) 
         single_select[question,"",""] = single_select[question,"",""].astype(cat)
-      
-      single_select.columns.set_names("option", level=2, inplace=True)
-      
-      multi_select = tmp_records.loc[tmp_records["question_type"].isin(alchemy_types.MULTI_SELECT_QUESTIONS)]
 
-      multi_select = multi_select.pivot(columns=["question", "subquestion", "option"], values="answer", index=["survey_id", "response_id"])
-      multi_select.replace({'0': 0, '1': 1}, inplace=True)
-      multi_select = multi_select.astype('boolean')
+  def _pivot_chunks(self, chunks: Iterable[pd.DataFrame],
+                    survey_ids:  Optional[Union[int, List[int]]]=None,
+                    column_mode: Optional[Literal["flat", "multi"]]="flat",
+                    selection:   Optional[RecordSelection]=None,
+                    sparse:      bool=False) -> pd.DataFrame:
+    # Pivots each chunk of whole responses on its own and stacks the results.
+    parts = [self._table_part(chunk, column_mode, sparse) for chunk in chunks]
+    if not parts:
+      return self._pivot_table(self.get_records(survey_ids, selection=selection), column_mode=column_mode,
+                               sparse=sparse)
+    return self._stack_parts(parts, column_mode, sparse)
 
-      value = tmp_records.loc[tmp_records["question_type"].isin(alchemy_types.SINGLE_VALUE_QUESTION) | tmp_records["question_type"].isin(alchemy_types.MULTI_VALUE_QUESTIONS)]
-      value = value.pivot(columns=["question", "subquestion", "option"], values="answer", index=["survey_id", "response_id"])
+  def _table_part(self, records: pd.DataFrame, column_mode: Optional[Literal["flat", "multi"]], sparse: bool=False):
+    # The flat table, or the unfinished multi sections, of some whole responses
+    records = self._decode_categoricals(records)
+    if column_mode == "flat":
+      return self._flatten_table(records, sparse)
+    return self._pivot_sections(records, sparse)
 
-      return pd.concat([single_select, multi_select, value], axis=1)
+  def _stack_parts(self, parts: list, column_mode: Optional[Literal["flat", "multi"]],
+                   sparse: bool=False) -> pd.DataFrame:
+    # Parts of disjoint responses, in record order, stacked into the table a
+    # single pivot over all of them gives; a column missing from a part is
+    # all NA there.
+    if column_mode == "flat":
+      return pivot.stack_flat(parts)
+    # multi column pivots order columns by first appearance, which stacking
+    # the parts in order keeps
+    single_select, single_select_options, multi_select, value = (pd.concat(section) for section in zip(*parts))
+    self._categorize_single_select(single_select, single_select_options)
+    multi_select = multi_select.astype(pivot.SPARSE_CHECKED if sparse else 'boolean')
+    return pd.concat([single_select, multi_select, value], axis=1)
    
-  def _flatten_table(self, records: pd.DataFrame) -> pd.DataFrame:
-    records["variable_name"] = ""
-    records.loc[records["question_type"].isin(alchemy_types.SINGLETON_QUESTIONS), "variable_name"] = (
-    records.loc[records["question_type"].isin(alchemy_types.SINGLETON_QUESTIONS), "question"]
-           .str.replace(r'[^a-zA-Z0-9]', '_', regex=True)
-    )
-
-    records.loc[records["question_type"].isin(alchemy_types.MULTI_QUESTIONS), "variable_name"] = (
-    records.loc[records["question_type"].isin(alchemy_types.MULTI_QUESTIONS), "option"]
-           .str.replace('[^a-zA-Z0-9]', '_', regex=True)
-           .str.lstrip('X') + '_' +
-    records.loc[records["question_type"].isin(alchemy_types.MULTI_QUESTIONS), "question"]
-           .str.replace(r'[^a-zA-Z0-9]', '_', regex=True)
-    )
-
-    records.loc[records["question_type"].isin(alchemy_types.TWO_LAYER_QUESTIONS), "variable_name"] = (
-    records.loc[records["question_type"].isin(alchemy_types.TWO_LAYER_QUESTIONS), "subquestion"]
-           .str.replace(r'[^a-zA-Z0-9]', '_', regex=True)
-           .str.lstrip('X') + '_' +
-    records.loc[records["question_type"].isin(alchemy_types.TWO_LAYER_QUESTIONS), "question"]
-           .str.replace(r'[^a-zA-Z0-9]', '_', regex=True)
-    )
-
-    records.loc[records["variable_name"].str.contains(r'^\d', regex=True), "variable_name"] = (
-    records.loc[records["variable_name"].str.contains(r'^\d', regex=True), "variable_name"]
-            .str.pad(1, 'left', 'X') 
-    )
-    records.drop_duplicates(subset=['survey_id', 'response_id', 'variable_name'], inplace=True)
-
-
-    return records.pivot(index=["survey_id", "response_id"], columns="variable_name", values="answer")
+  def _flatten_table(self, records: pd.DataFrame, sparse: bool=False) -> pd.DataFrame:
+    # Builds the variable names on the side rather than as a new column of
+    # `records`, so the caller's frame is left untouched.
+    if "variable_name" in records:
+      # rebuilt so the table's columns get the default string dtype, whatever
+      # the dtype backend of the records
+      variable_name = pd.Series(records["variable_name"].to_numpy(dtype=object, na_value=np.nan), index=records.index)
+    else:
+      variable_name = self._variable_names(records)
+
+    return pivot.flat_table(records, variable_name, sparse)
+
+  def _variable_names(self, records: pd.DataFrame) -> pd.Series:
+    # For records read without variable_name: the names only depend on the
+    # question, subquestion and option, so each combination is named once.
+    columns = ["question_type", "question", "subquestion", "option"]
+    groups  = records[columns].groupby(columns, dropna=False, sort=False)
+    first   = groups.head(1).reset_index(drop=True)
+    parts   = pd.DataFrame({"question_type": first["question_type"],
+                            "variable_name": first["question"].map(variable_name, na_action="ignore"),
+                            "sub_prefix":    first["subquestion"].map(variable_prefix, na_action="ignore"),
+                            "option_prefix": first["option"].map(variable_prefix, na_action="ignore")})
+    names   = flat_variable_names(parts).to_numpy()
+    return pd.Series(names[groups.ngroup().to_numpy()], index=records.index)
+
+
+def _record_columns(column_mode: Optional[Literal["flat", "multi"]], sparse: bool=False) -> Optional[List[str]]:
+  # The records a table is built from; a sparse flat table also needs the
+  # question types
+  if column_mode != "flat":
+    return None
+  return FLAT_RECORD_COLUMNS + ["question_type"] if sparse else FLAT_RECORD_COLUMNS
+
+
+def _survey_table_parts(db_path: str, storage: Optional[str], parquet_dir: Optional[str], dtype_backend: str,
+                        survey_id: int, column_mode: Optional[Literal["flat", "multi"]],
+                        chunksize: Optional[int], selection: Optional[RecordSelection]=None,
+                        sparse: bool=False) -> list:
+  # Runs in a get_table worker, thread or process: the table parts of one
+  # survey, read through a read-only connection of its own
+  alchemy = Alchemy(db_path, storage, parquet_dir, dtype_backend, read_only=True)
+  try:
+    columns = _record_columns(column_mode, sparse)
+    if chunksize:
+      chunks = alchemy.iter_records(survey_id, chunksize, columns, selection=selection)
+    else:
+      chunks = [alchemy.get_records(survey_id, columns, selection=selection)]
+    return [alchemy._table_part(chunk, column_mode, sparse) for chunk in chunks if len(chunk)]
+  finally:
+    alchemy.close()
 
 
     
@@ -0,0 +1,63 @@
+import argparse
+from typing import List, Optional
+
+from .alchemy import Alchemy
+from .export import EXPORT_FORMATS
+from .migrations import PAGE_SIZE
+from .storage import DEFAULT_CHUNKSIZE
+
+
+def export_command(args: argparse.Namespace):
+  alchemy = Alchemy(args.db, args.storage, args.parquet_dir, read_only=True)
+  try:
+    paths = alchemy.export(args.out_dir, args.survey_ids or None, args.format,
+                           args.chunksize, args.per_chunk)
+  finally:
+    alchemy.close()
+  for path in paths:
+    print(path)
+
+
+def migrate_command(args: argparse.Namespace):
+  alchemy = Alchemy(args.db)
+  try:
+    before = alchemy.schema_version
+    after  = alchemy.migrate(args.target, vacuum=args.vacuum)
+  finally:
+    alchemy.close()
+  print(f"{args.db}: schema version {before} -> {after}")
+
+
+def main(argv: Optional[List[str]]=None):
+  parser   = argparse.ArgumentParser(prog="alchemy", description="Work with the survey data in an alchemy database.")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  export = commands.add_parser("export", help="write each survey's flat table to csv or parquet, streamed in chunks")
+  export.add_argument("survey_ids", nargs="*", type=int, help="surveys to export, all of them if none are given")
+  export.add_argument("--db", type=str, default="alchemy.db",
+                      help="database to read, already migrated")
+  export.add_argument("--out-dir", type=str, default=".",
+                      help="directory the files are written to, as <survey_id>.<format>")
+  export.add_argument("--format", choices=EXPORT_FORMATS, default="csv",
+                      help="file format to write")
+  export.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE,
+                      help="answers read and pivoted at a time, which bounds memory use")
+  export.add_argument("--per-chunk", action="store_true",
+                      help="write each chunk to a file of its own, <survey_id>/part-00000.<format> on")
+  export.add_argument("--storage", choices=["sqlite", "parquet"], default="sqlite",
+                      help="where the answers are read from")
+  export.add_argument("--parquet-dir", type=str, default=None,
+                      help="parquet store to read answers from with --storage parquet")
+  export.set_defaults(run=export_command)
+
+  migrate = commands.add_parser("migrate", help="upgrade the database schema in place")
+  migrate.add_argument("--db", type=str, default="alchemy.db",
+                       help="database to upgrade")
+  migrate.add_argument("--target", type=int, default=None,
+                       help="schema version to migrate to, the latest if not given")
+  migrate.add_argument("--vacuum", action="store_true",
+                       help=f"rebuild the database afterwards, reclaiming free space and moving it to {PAGE_SIZE} byte pages")
+  migrate.set_defaults(run=migrate_command)
+
+  args = parser.parse_args(argv)
+  args.run(args)
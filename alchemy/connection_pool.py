@@ -0,0 +1,121 @@
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from .migrations import connect_read_only
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 8
+
+# Connections idle for longer than this are checked before being handed out
+HEALTH_CHECK_AFTER = 1.0
+
+
+class ConnectionPool():
+  # Up to `size` read-only connections to the database at `db_path`, each
+  # held by one thread at a time. A thread asking while it already holds one
+  # gets the same connection back, so nested reads never wait on themselves;
+  # other threads wait up to `timeout` seconds (None: for ever) for one to
+  # be returned. In WAL mode, which migrate() sets, the readers neither
+  # block nor are blocked by the connection loading surveys.
+  def __init__(self, db_path: str, size: int = DEFAULT_POOL_SIZE, timeout: Optional[float] = None):
+    if size < 1:
+      raise ValueError(f"a connection pool needs a positive size, got {size}")
+    self.db_path  = db_path
+    self.size     = size
+    self.timeout  = timeout
+    self._idle: List[sqlite3.Connection] = []
+    self._last_used = {}
+    self._open   = 0
+    self._closed = False
+    self._local  = threading.local()
+    self._cond   = threading.Condition()
+
+  @contextmanager
+  def connection(self) -> Iterator[sqlite3.Connection]:
+    held = getattr(self._local, "conn", None)
+    if held is not None:
+      self._local.depth += 1
+      try:
+        yield held
+      finally:
+        self._local.depth -= 1
+      return
+    conn = self._acquire()
+    self._local.conn, self._local.depth = conn, 1
+    try:
+      yield conn
+    finally:
+      self._local.conn = None
+      self._release(conn)
+
+  def current(self) -> Optional[sqlite3.Connection]:
+    # The connection this thread holds, if any
+    return getattr(self._local, "conn", None)
+
+  def close(self):
+    # Idle connections close now, ones in use as they are returned
+    with self._cond:
+      self._closed = True
+      for conn in self._idle:
+        conn.close()
+        self._last_used.pop(id(conn), None)
+      self._open -= len(self._idle)
+      self._idle.clear()
+      self._cond.notify_all()
+
+  def _acquire(self) -> sqlite3.Connection:
+    deadline = None if self.timeout is None else time.monotonic() + self.timeout
+    with self._cond:
+      while True:
+        if self._closed:
+          raise RuntimeError("the connection pool is closed")
+        if self._idle:
+          conn = self._idle.pop()
+          break
+        if self._open < self.size:
+          self._open += 1
+          conn = None
+          break
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          raise TimeoutError(f"no connection was free within {self.timeout}s, all {self.size} are in use")
+        self._cond.wait(remaining)
+    try:
+      if conn is not None and not self._healthy(conn):
+        self._last_used.pop(id(conn), None)
+        conn.close()
+        conn = None
+      return conn if conn is not None else connect_read_only(self.db_path, check_same_thread=False)
+    except BaseException:
+      with self._cond:
+        self._open -= 1
+        self._cond.notify()
+      raise
+
+  def _release(self, conn: sqlite3.Connection):
+    if conn.in_transaction:
+      conn.rollback()
+    with self._cond:
+      if self._closed:
+        self._last_used.pop(id(conn), None)
+        conn.close()
+        self._open -= 1
+      else:
+        self._last_used[id(conn)] = time.monotonic()
+        self._idle.append(conn)
+      self._cond.notify()
+
+  def _healthy(self, conn: sqlite3.Connection) -> bool:
+    if time.monotonic() - self._last_used.get(id(conn), 0) < HEALTH_CHECK_AFTER:
+      return True
+    try:
+      conn.execute("SELECT 1;").fetchone()
+      return True
+    except sqlite3.Error as e:
+      logger.warning(f"replacing a broken pooled connection to {self.db_path}: {e}")
+      return False
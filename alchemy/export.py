@@ -0,0 +1,131 @@
+import os
+import sqlite3
+from typing import Iterable, List, Literal
+
+import pandas as pd
+
+from .pivot import INDEX
+from .storage import VARIABLE_NAME_CASE
+
+EXPORT_FORMATS = ["csv", "parquet"]
+
+# The flat columns a survey's answers fill, in question order: by question,
+# then sub question, then option order. Read off the distinct question /
+# sub question / option combinations, so a column is only listed if some
+# response has it.
+GET_EXPORT_COLUMNS = f'''
+  SELECT {VARIABLE_NAME_CASE}
+    FROM (SELECT DISTINCT question_id, sub_question_id, option_id
+            FROM answer
+           WHERE survey_id = ?) as a
+   INNER JOIN question as q1 ON q1.id = a.question_id
+   LEFT  JOIN question as q2 ON q2.id = a.sub_question_id
+   LEFT  JOIN option   as o  ON o.id  = a.option_id
+   ORDER BY q1.id, q2.id, o.option_order, o.id;'''
+
+
+def check_format(format: str):
+  if format not in EXPORT_FORMATS:
+    raise ValueError(f"export expects `format` to be one of {EXPORT_FORMATS}, got {format}")
+
+
+def export_columns(conn: sqlite3.Connection, survey_id: int) -> List[str]:
+  # Each name once, where it first comes in question order. Answers without
+  # a column name (instructions, logic, ...) are left out of exports.
+  names = (row[0] for row in conn.execute(GET_EXPORT_COLUMNS, [int(survey_id)]))
+  return list(dict.fromkeys(name for name in names if name))
+
+
+class CsvWriter():
+  # Flat table chunks appended to one csv file under a single header
+  def __init__(self, path: str, columns: List[str]):
+    self.columns = columns
+    self._file   = open(path, "w", newline="", encoding="utf-8")
+    pd.DataFrame(columns=INDEX + columns).to_csv(self._file, index=False, lineterminator="\n")
+
+  def write(self, table: pd.DataFrame):
+    _export_frame(table, self.columns).to_csv(self._file, index=False, header=False, lineterminator="\n")
+
+  def close(self):
+    self._file.close()
+
+
+class ParquetWriter():
+  # Flat table chunks appended as row groups of one parquet file. Every
+  # answer column is a string, so all chunks share one schema.
+  def __init__(self, path: str, columns: List[str]):
+    try:
+      import pyarrow as pa
+      import pyarrow.parquet as pq
+    except ImportError as e:
+      raise ImportError("parquet export requires pyarrow, install it with `pip install alchemy[parquet]`") from e
+    self.columns = columns
+    self._pa     = pa
+    self._schema = pa.schema([(column, pa.int32()) for column in INDEX] +
+                             [(column, pa.string()) for column in columns])
+    self._writer = pq.ParquetWriter(path, self._schema)
+
+  def write(self, table: pd.DataFrame):
+    frame = _export_frame(table, self.columns)
+    self._writer.write_table(self._pa.Table.from_pandas(frame, schema=self._schema, preserve_index=False))
+
+  def close(self):
+    self._writer.close()
+
+
+WRITERS = {"csv": CsvWriter, "parquet": ParquetWriter}
+
+
+def _export_frame(table: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+  # The chunk's columns put in export order, the ones it has no answers for
+  # all missing; survey_id and response_id come first
+  return table.reindex(columns=columns).reset_index()
+
+
+def write_survey(tables: Iterable[pd.DataFrame], columns: List[str], out_dir: str, survey_id: int,
+                 format: Literal["csv", "parquet"]="csv", per_chunk: bool=False) -> List[str]:
+  # Writes a survey's flat table chunks to out_dir/{survey_id}.{format}, or
+  # with per_chunk one file per chunk, out_dir/{survey_id}/part-00000.{format}
+  # on. Each file is written under a temporary name and moved into place
+  # once complete. Returns the paths written.
+  if per_chunk:
+    os.makedirs(os.path.join(out_dir, str(survey_id)), exist_ok=True)
+    paths = []
+    # a survey without answers still gets its header
+    for table in _at_least_one(tables, columns):
+      path = os.path.join(out_dir, str(survey_id), f"part-{len(paths):05d}.{format}")
+      _write(path, format, columns, [table])
+      paths.append(path)
+    return paths
+  os.makedirs(out_dir, exist_ok=True)
+  path = os.path.join(out_dir, f"{survey_id}.{format}")
+  _write(path, format, columns, tables)
+  return [path]
+
+
+def _at_least_one(tables, columns: List[str]):
+  empty = True
+  for table in tables:
+    empty = False
+    yield table
+  if empty:
+    yield _empty_table(columns)
+
+
+def _empty_table(columns: List[str]) -> pd.DataFrame:
+  index = pd.MultiIndex.from_arrays([[], []], names=INDEX)
+  return pd.DataFrame(index=index, columns=columns, dtype=object)
+
+
+def _write(path: str, format: str, columns: List[str], tables: Iterable[pd.DataFrame]):
+  tmp_path = f"{path}.{os.getpid()}.tmp"
+  writer   = WRITERS[format](tmp_path, columns)
+  try:
+    for table in tables:
+      writer.write(table)
+  except BaseException:
+    writer.close()
+    os.remove(tmp_path)
+    raise
+  writer.close()
+  os.replace(tmp_path, path)
@@ -0,0 +1,187 @@
+import copy
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+
+class Histogram():
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    self.bounds = bounds
+    self.counts = [0] * len(bounds)
+
+  def observe(self, value: float):
+    self.counts[bisect_left(self.bounds, value)] += 1
+
+  def quantile(self, q: float) -> Optional[float]:
+    # upper bound of the bucket the q-th observation falls in
+    total = sum(self.counts)
+    if not total:
+      return None
+    rank = q * total
+    seen = 0
+    for bound, count in zip(self.bounds, self.counts):
+      seen += count
+      if seen >= rank:
+        return bound
+    return self.bounds[-1]
+
+  def to_dict(self) -> Dict[str, int]:
+    return {("inf" if bound == float("inf") else f"{bound:g}"): count
+            for bound, count in zip(self.bounds, self.counts)}
+
+
+class StageStats():
+  def __init__(self, histogram: bool = True):
+    self.count     = 0
+    self.seconds   = 0.0
+    self.max       = 0.0
+    self.rows      = 0
+    self.bytes     = 0
+    self.histogram = Histogram() if histogram else None
+
+  def add(self, seconds: float, rows: int, bytes: int):
+    self.count   += 1
+    self.seconds += seconds
+    self.max      = max(self.max, seconds)
+    self.rows    += rows
+    self.bytes   += bytes
+    if self.histogram:
+      self.histogram.observe(seconds)
+
+  def to_dict(self) -> Dict[str, Any]:
+    stats = {"count":   self.count,
+             "seconds": round(self.seconds, 6),
+             "rows":    self.rows,
+             "bytes":   self.bytes}
+    if self.histogram:
+      stats.update({"mean":          round(self.seconds / self.count, 6) if self.count else None,
+                    "max":           round(self.max, 6),
+                    "p50":           _json_float(self.histogram.quantile(0.5)),
+                    "p95":           _json_float(self.histogram.quantile(0.95)),
+                    "rows_per_sec":  round(self.rows / self.seconds, 1) if self.seconds else None,
+                    "bytes_per_sec": round(self.bytes / self.seconds, 1) if self.seconds else None,
+                    "histogram":     self.histogram.to_dict()})
+    return stats
+
+
+class Stage():
+  # Handed to the body of an instrumented block (and to hooks) so it can
+  # report what it processed; seconds is filled in when the block exits.
+  __slots__ = ("name", "labels", "rows", "bytes", "seconds")
+
+  def __init__(self, name: str, labels: Dict[str, Any]):
+    self.name    = name
+    self.labels  = labels
+    self.rows    = 0
+    self.bytes   = 0
+    self.seconds = None
+
+
+Hook = Callable[[Stage], ContextManager]
+
+
+class Instrumentation():
+  # Collects timings for the stages of an ingest run. Stage names start with
+  # the layer they belong to ("http fetch", "json decode", "parse",
+  # "sqlite insert answer", ...) and a `survey_id` / `page` label breaks them
+  # down per survey and per page. Safe to use from the fetch and worker
+  # threads. Attached hooks are called with each Stage and the context
+  # manager they return is entered around it, e.g. to open a tracing span.
+  def __init__(self, enabled: bool = True):
+    self.enabled  = enabled
+    self._labels  = {}
+    self._hooks: List[Hook] = []
+    self._lock    = threading.Lock()
+    self._started = datetime.now(timezone.utc)
+    self._clock   = time.perf_counter()
+    self._stages:  Dict[str, StageStats] = {}
+    self._surveys: Dict[str, Dict[str, StageStats]] = {}
+    self._pages:   Dict[str, Dict[int, Dict[str, StageStats]]] = {}
+
+  def attach(self, hook: Hook):
+    self._hooks.append(hook)
+
+  def bind(self, **labels) -> "Instrumentation":
+    # A view adding `labels` to every stage, sharing this run's stats
+    bound = copy.copy(self)
+    bound._labels = {**self._labels, **labels}
+    return bound
+
+  @contextmanager
+  def stage(self, name: str, **labels) -> Iterator[Stage]:
+    stage = Stage(name, {**self._labels, **labels})
+    if not self.enabled:
+      yield stage
+      return
+    with ExitStack() as hooks:
+      for hook in self._hooks:
+        hooks.enter_context(hook(stage))
+      start = time.perf_counter()
+      try:
+        yield stage
+      finally:
+        stage.seconds = time.perf_counter() - start
+        self.record(stage)
+
+  def record(self, stage: Stage):
+    survey_id = stage.labels.get("survey_id")
+    page      = stage.labels.get("page")
+    with self._lock:
+      self._stages.setdefault(stage.name, StageStats()).add(stage.seconds, stage.rows, stage.bytes)
+      if survey_id is not None:
+        survey = self._surveys.setdefault(str(survey_id), {})
+        survey.setdefault(stage.name, StageStats()).add(stage.seconds, stage.rows, stage.bytes)
+        if page is not None:
+          pages = self._pages.setdefault(str(survey_id), {}).setdefault(int(page), {})
+          pages.setdefault(stage.name, StageStats(histogram=False)).add(stage.seconds, stage.rows, stage.bytes)
+
+  def layers(self) -> Dict[str, float]:
+    # Seconds spent per layer. Fetches overlap on the pool threads, so the
+    # http total can exceed the wall clock time of the run.
+    totals = {}
+    with self._lock:
+      for name, stats in self._stages.items():
+        layer = name.split()[0]
+        totals[layer] = totals.get(layer, 0.0) + stats.seconds
+    return totals
+
+  def report(self) -> Dict[str, Any]:
+    layers = self.layers()
+    with self._lock:
+      return {
+        "started_at": self._started.isoformat(),
+        "elapsed":    round(time.perf_counter() - self._clock, 6),
+        "layers":     {layer: round(seconds, 6) for layer, seconds in layers.items()},
+        "stages":     {name: stats.to_dict() for name, stats in self._stages.items()},
+        "surveys":    {survey_id: {"stages": {name: stats.to_dict() for name, stats in stages.items()},
+                                   "pages":  {page: {name: stats.to_dict() for name, stats in page_stages.items()}
+                                              for page, page_stages in sorted(self._pages.get(survey_id, {}).items())}}
+                       for survey_id, stages in self._surveys.items()},
+      }
+
+  def summary(self) -> str:
+    elapsed = time.perf_counter() - self._clock
+    layers  = ", ".join(f"{layer} {seconds:.2f}s" for layer, seconds in
+                        sorted(self.layers().items(), key=lambda item: -item[1]))
+    return f"{elapsed:.2f}s elapsed: {layers}"
+
+  def write_report(self, path: str):
+    with open(path, "w") as f:
+      json.dump(self.report(), f, indent=2)
+
+
+NO_INSTRUMENTATION = Instrumentation(enabled=False)
+
+
+def _json_float(value: Optional[float]) -> Optional[Any]:
+  if value == float("inf"):
+    return "inf"
+  return value
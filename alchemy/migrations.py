@@ -0,0 +1,325 @@
+import argparse
+import logging
+import os
+import re
+import sqlite3
+from typing import Callable, List, NamedTuple, Optional, Union
+from urllib.request import pathname2url
+
+logger = logging.getLogger(__name__)
+
+# Storage pragmas. page_size only takes effect on an empty database or after a
+# VACUUM, and can no longer change once the database is in WAL mode.
+PAGE_SIZE    = 8192
+MMAP_SIZE    = 256 * 1024 * 1024
+CACHE_SIZE   = -64 * 1024 # negative values are KiB
+JOURNAL_MODE = "wal"
+
+
+class Migration(NamedTuple):
+  version: int
+  name:    str
+  # either a list of statements or a callable taking the connection
+  apply:   Union[List[str], Callable[[sqlite3.Connection], None]]
+
+
+# The original schema.sql. Every statement is idempotent so that databases
+# created from schema.sql before user_version was tracked can adopt it as-is.
+BASELINE_SCHEMA = [
+  """
+  CREATE TABLE IF NOT EXISTS survey (
+    id          INTEGER PRIMARY KEY,
+    title       TEXT    NOT NULL UNIQUE
+  );""",
+  """
+  CREATE TABLE IF NOT EXISTS question (
+    id            INTEGER PRIMARY KEY,
+    base_type     INTEGER NOT NULL,
+    question_type INTEGER NOT NULL,
+    title         TEXT    NOT NULL,
+    shortname     TEXT    NOT NULL
+  );""",
+  """
+  CREATE TABLE IF NOT EXISTS option (
+    id            INTEGER PRIMARY KEY,
+    value         TEXT,
+    option_order  INTEGER
+  );""",
+  """
+  CREATE TABLE IF NOT EXISTS survey_x_question (
+    survey_id     INTEGER,
+    question_id   INTEGER,
+    UNIQUE(survey_id, question_id),
+    FOREIGN KEY (survey_id) REFERENCES survey(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
+    FOREIGN KEY (question_id) REFERENCES question(id) ON UPDATE RESTRICT ON DELETE RESTRICT
+  );""",
+  """
+  CREATE TABLE IF NOT EXISTS response (
+    id             INTEGER,
+    survey_id      INTEGER,
+    UNIQUE (id, survey_id),
+    FOREIGN KEY (survey_id) REFERENCES survey(id) ON UPDATE RESTRICT ON DELETE RESTRICT
+  );""",
+  """
+  CREATE TABLE IF NOT EXISTS answer (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    question_id     INTEGER,
+    sub_question_id INTEGER,
+    option_id       INTEGER,
+    response_id     INTEGER,
+    survey_id       INTEGER,
+    answer          TEXT,
+    FOREIGN KEY (sub_question_id) REFERENCES question(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
+    FOREIGN KEY (question_id) REFERENCES question(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
+    UNIQUE (survey_id, question_id, sub_question_id, option_id, response_id),
+    FOREIGN KEY (response_id, survey_id) REFERENCES response(id, survey_id) ON UPDATE RESTRICT ON DELETE RESTRICT
+  );""",
+  """
+  INSERT OR IGNORE INTO question (id, base_type, question_type, title, shortname)
+                          VALUES (0, 0, 0, '', '');""",
+  """
+  INSERT OR IGNORE INTO option (id, value)
+                        VALUES (0, '');""",
+]
+
+
+def _add_columns(*columns):
+  # ALTER TABLE ADD COLUMN has no IF NOT EXISTS, so check table_info first
+  def apply(con: sqlite3.Connection):
+    for table, column, column_type in columns:
+      existing = [row[1] for row in con.execute(f"PRAGMA table_info({table});")]
+      if column not in existing:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type};")
+  return apply
+
+
+# Plain numbers, as typed into slider, rank and textbox questions
+NUMBER_PATTERN = re.compile(r"\s*[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?\s*")
+
+
+def answer_number(value) -> Optional[float]:
+  if isinstance(value, (int, float)):
+    return float(value)
+  if isinstance(value, str) and NUMBER_PATTERN.fullmatch(value):
+    return float(value)
+  return None
+
+
+# Flat table column names are put together from these parts: a question's
+# variable_name, behind the variable_prefix of its option or sub question
+# for multi and two layer questions (see storage.VARIABLE_NAME_EXPR).
+NON_ALPHANUMERIC = re.compile(r"[^a-zA-Z0-9]")
+
+
+def variable_name(text) -> Optional[str]:
+  if not isinstance(text, str):
+    return None
+  return NON_ALPHANUMERIC.sub("_", text)
+
+
+def variable_prefix(text) -> Optional[str]:
+  name = variable_name(text)
+  return name.lstrip("X") if name is not None else None
+
+
+ANSWER_VALUE_SCHEMA = [
+  """
+  CREATE TABLE answer_value (
+    id      INTEGER PRIMARY KEY,
+    value   TEXT    NOT NULL UNIQUE,
+    number  REAL
+  );""",
+  """
+  INSERT INTO answer_value (value, number)
+  SELECT DISTINCT answer, answer_number(answer)
+    FROM answer
+   WHERE answer IS NOT NULL;""",
+  # sqlite can only drop a column that no index covers, so rebuild the table
+  """
+  CREATE TABLE answer_encoded (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    question_id     INTEGER,
+    sub_question_id INTEGER,
+    option_id       INTEGER,
+    response_id     INTEGER,
+    survey_id       INTEGER,
+    value_id        INTEGER,
+    FOREIGN KEY (sub_question_id) REFERENCES question(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
+    FOREIGN KEY (question_id) REFERENCES question(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
+    FOREIGN KEY (value_id) REFERENCES answer_value(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
+    UNIQUE (survey_id, question_id, sub_question_id, option_id, response_id),
+    FOREIGN KEY (response_id, survey_id) REFERENCES response(id, survey_id) ON UPDATE RESTRICT ON DELETE RESTRICT
+  );""",
+  """
+  INSERT INTO answer_encoded (id, question_id, sub_question_id, option_id, response_id, survey_id, value_id)
+  SELECT a.id, a.question_id, a.sub_question_id, a.option_id, a.response_id, a.survey_id, v.id
+    FROM answer as a
+    LEFT JOIN answer_value as v ON v.value = a.answer
+   ORDER BY a.id;""",
+  "DROP TABLE answer;",
+  "ALTER TABLE answer_encoded RENAME TO answer;",
+  """
+  CREATE INDEX answer_survey_response
+    ON answer (survey_id, response_id, question_id, sub_question_id, option_id, value_id);""",
+  "ANALYZE;",
+]
+
+
+def _encode_answer_values(con: sqlite3.Connection):
+  con.create_function("answer_number", 1, answer_number, deterministic=True)
+  for stmt in ANSWER_VALUE_SCHEMA:
+    con.execute(stmt)
+
+
+VARIABLE_NAME_SCHEMA = [
+  "UPDATE question SET variable_name = variable_name(shortname), variable_prefix = variable_prefix(title);",
+  "UPDATE option   SET variable_prefix = variable_prefix(value);",
+]
+
+
+def _add_variable_names(con: sqlite3.Connection):
+  _add_columns(
+    ("question", "variable_name",   "TEXT"),
+    ("question", "variable_prefix", "TEXT"),
+    ("option",   "variable_prefix", "TEXT"),
+  )(con)
+  con.create_function("variable_name",   1, variable_name,   deterministic=True)
+  con.create_function("variable_prefix", 1, variable_prefix, deterministic=True)
+  for stmt in VARIABLE_NAME_SCHEMA:
+    con.execute(stmt)
+
+
+MIGRATIONS = [
+  Migration(1, "baseline schema", BASELINE_SCHEMA),
+  Migration(2, "question parents and option owners", _add_columns(
+    ("question", "parent_id",   "INTEGER"),
+    ("option",   "question_id", "INTEGER"),
+  )),
+  Migration(3, "sync state", [
+    """
+    CREATE TABLE IF NOT EXISTS sync_state (
+      survey_id       INTEGER PRIMARY KEY,
+      high_water_mark TEXT,
+      synced_at       TEXT    NOT NULL,
+      FOREIGN KEY (survey_id) REFERENCES survey(id) ON UPDATE RESTRICT ON DELETE RESTRICT
+    );""",
+  ]),
+  Migration(4, "read path indexes", [
+    # Covers get_records: seek on survey_id, walk responses in order and read
+    # every answer column from the index without touching the table.
+    """
+    CREATE INDEX IF NOT EXISTS answer_survey_response
+      ON answer (survey_id, response_id, question_id, sub_question_id, option_id, answer);""",
+    # Options of a question (QuestionIndex.from_db) and responses of a survey
+    """
+    CREATE INDEX IF NOT EXISTS option_question
+      ON option (question_id, option_order);""",
+    """
+    CREATE INDEX IF NOT EXISTS response_survey
+      ON response (survey_id, id);""",
+    "ANALYZE;",
+  ]),
+  # answer.answer (TEXT) becomes answer.value_id, pointing into a table that
+  # holds every distinct answer once along with its numeric reading
+  Migration(5, "dictionary encoded answer values", _encode_answer_values),
+  # bumped by every committed load of a survey, see alchemy.table_cache
+  Migration(6, "survey data versions", _add_columns(
+    ("sync_state", "data_version", "INTEGER NOT NULL DEFAULT 0"),
+  )),
+  # flat column name parts, worked out once per question and option
+  Migration(7, "precomputed variable names", _add_variable_names),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def schema_version(con: sqlite3.Connection) -> int:
+  return con.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def configure_connection(con: sqlite3.Connection) -> sqlite3.Connection:
+  # Per connection settings, these are not stored in the database file
+  con.execute(f"PRAGMA mmap_size = {MMAP_SIZE};")
+  con.execute(f"PRAGMA cache_size = {CACHE_SIZE};")
+  con.execute("PRAGMA temp_store = MEMORY;")
+  return con
+
+
+def connect_read_only(db_path: str, check_same_thread: bool = True) -> sqlite3.Connection:
+  # A connection that can never write, for readers working alongside the
+  # connection that owns the database. Migrating needs write access, so the
+  # schema must already be current. check_same_thread=False lets a pool hand
+  # it to one thread after another.
+  uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+  con = configure_connection(sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread))
+  version = schema_version(con)
+  if version != LATEST_VERSION:
+    con.close()
+    raise RuntimeError(f"database schema version {version} is not the current {LATEST_VERSION}, "
+                       f"run `alchemy migrate` to migrate it")
+  return con
+
+
+def apply_storage_pragmas(con: sqlite3.Connection, vacuum: bool = False):
+  page_size = con.execute("PRAGMA page_size;").fetchone()[0]
+  if page_size != PAGE_SIZE:
+    empty = con.execute("PRAGMA page_count;").fetchone()[0] == 0
+    if empty or vacuum:
+      # the page size is fixed while in WAL mode, leave it to rebuild
+      con.execute("PRAGMA journal_mode = DELETE;")
+      con.execute(f"PRAGMA page_size = {PAGE_SIZE};")
+
+
+def migrate(con: sqlite3.Connection, target: Optional[int] = None, vacuum: bool = False) -> int:
+  # Brings the database up to `target` (default: latest) one migration at a
+  # time, each in its own transaction together with the user_version bump,
+  # so an interrupted upgrade resumes from the last completed step. With
+  # `vacuum` the file is rebuilt afterwards, picking up PAGE_SIZE and giving
+  # back the space freed by table rebuilds.
+  target  = LATEST_VERSION if target is None else target
+  version = schema_version(con)
+  if version > LATEST_VERSION:
+    raise RuntimeError(f"database schema version {version} is newer than this alchemy ({LATEST_VERSION})")
+  if con.in_transaction:
+    con.commit()
+  apply_storage_pragmas(con, vacuum=vacuum)
+  for migration in MIGRATIONS:
+    if migration.version <= version or migration.version > target:
+      continue
+    logger.info(f"migrating database to version {migration.version}: {migration.name}")
+    con.execute("BEGIN;")
+    try:
+      if callable(migration.apply):
+        migration.apply(con)
+      else:
+        for stmt in migration.apply:
+          con.execute(stmt)
+      con.execute(f"PRAGMA user_version = {migration.version};")
+      con.commit()
+    except Exception:
+      con.rollback()
+      raise
+    version = migration.version
+  if vacuum:
+    logger.info("rebuilding database")
+    con.execute("VACUUM;")
+  con.execute(f"PRAGMA journal_mode = {JOURNAL_MODE};")
+  # NORMAL is durable across application crashes in WAL mode
+  con.execute("PRAGMA synchronous = NORMAL;")
+  return version
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Upgrade an alchemy database in place.")
+  parser.add_argument("db_path", type=str, nargs="?", default="alchemy.db")
+  parser.add_argument("--target", type=int, default=None, help="schema version to migrate to")
+  parser.add_argument("--vacuum", action="store_true",
+                      help=f"rebuild the database afterwards, reclaiming free space and moving it to {PAGE_SIZE} byte pages")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  con = sqlite3.connect(args.db_path)
+  before = schema_version(con)
+  after  = migrate(con, args.target, vacuum=args.vacuum)
+  print(f"{args.db_path}: schema version {before} -> {after}")
+  con.close()
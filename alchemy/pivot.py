@@ -0,0 +1,334 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import take
+
+from . import alchemy_types
+
+# Pivot engine behind Alchemy.get_table. Rows (survey_id, response_id) and
+# columns are factorized to integer codes once, and each table is filled by
+# scattering the answers into preallocated arrays, one typed block per
+# question family. Gives exactly what DataFrame.pivot would: rows sorted,
+# flat columns sorted (NaN first), multi columns in order of first appearance;
+# tests/test_pivot.py checks that against DataFrame.pivot.
+# Sparse tables (get_table(sparse=True)) hold the multi select and matrix
+# columns as pd.SparseDtype, only their answered cells stored.
+
+INDEX         = ["survey_id", "response_id"]
+MULTI_COLUMNS = ["question", "subquestion", "option"]
+
+# multi select answers, on their way to a boolean
+CHECKED = {'0': 0, '1': 1}
+
+# Starting size of the factorize hash tables. They grow as needed, where the
+# default sizes them to the number of records up front.
+FACTORIZE_SIZE_HINT = 1024
+
+# Sparse multi select columns: 1.0 checked, 0.0 not, NaN (the fill) not
+# asked. 8 bytes per answered cell, where a dense boolean takes 2 per cell.
+SPARSE_CHECKED = pd.SparseDtype(np.float32, np.nan)
+# Sparse text columns, the answers as str objects
+SPARSE_ANSWER  = pd.SparseDtype(object, np.nan)
+
+# Questions whose flat columns a sparse table holds sparse
+SPARSE_QUESTIONS = alchemy_types.MULTI_SELECT_QUESTIONS + alchemy_types.TWO_LAYER_QUESTIONS
+
+
+def _factorize(values, sort: bool = False) -> Tuple[np.ndarray, pd.Index]:
+  # size_hint is only honoured for plain arrays, so numpy backed columns are
+  # unwrapped first
+  if isinstance(values, pd.Series):
+    values = values.array
+  if isinstance(values, pd.arrays.NumpyExtensionArray):
+    values = np.asarray(values)
+  codes, uniques = pd.factorize(values, sort=sort, size_hint=FACTORIZE_SIZE_HINT)
+  return codes, pd.Index(uniques, dtype=uniques.dtype)
+
+
+def _integers(values) -> Optional[np.ndarray]:
+  # the values as a plain integer array, if they are integers without NA
+  if isinstance(values, pd.Series):
+    values = values.array
+  if isinstance(values, pd.arrays.NumpyExtensionArray):
+    values = np.asarray(values)
+  if isinstance(values, np.ndarray):
+    return values if values.dtype.kind == "i" or (values.dtype.kind == "u" and values.dtype.itemsize < 8) else None
+  if pd.api.types.is_signed_integer_dtype(values.dtype) and not values.isna().any():
+    return values.to_numpy(dtype=np.int64)
+  return None
+
+
+def _sorted_codes(values: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+  # _factorize(values, sort=True). Non negative integers below the number of
+  # records (survey and response ids, mostly) are ranked through a table up
+  # to the largest of them instead of hashed and sorted, into int32 codes.
+  integers = _integers(values)
+  if integers is None or not len(integers) or integers.min() < 0 or integers.max() >= len(integers):
+    return _factorize(values, sort=True)
+  present = np.zeros(int(integers.max()) + 1, dtype=bool)
+  present[integers] = True
+  rank    = np.cumsum(present, dtype=np.int32)
+  rank   -= 1
+  return rank[integers], pd.Index(np.flatnonzero(present)).astype(values.dtype)
+
+
+def _is_type(question_type: pd.Series, types: List[int]) -> np.ndarray:
+  # question_type.isin(types), looked up in a table over the types
+  integers = _integers(question_type)
+  if integers is None or not len(integers) or integers.min() < 0:
+    return question_type.isin(types).to_numpy()
+  table = np.zeros(max(types) + 2, dtype=bool)
+  table[types] = True
+  return table[np.minimum(integers, len(table) - 1)]
+
+
+class Rows():
+  # The (survey_id, response_id) of every record as a code into the sorted
+  # unique pairs
+  def __init__(self, records: pd.DataFrame):
+    survey_codes,   surveys   = _sorted_codes(records["survey_id"])
+    response_codes, responses = _sorted_codes(records["response_id"])
+    n_responses  = max(len(responses), 1)
+    pairs        = survey_codes.astype(np.int64)
+    pairs       *= n_responses
+    pairs       += response_codes
+    del survey_codes, response_codes
+    self.codes, keys = _sorted_codes(pd.Series(pairs, copy=False))
+    keys             = keys.to_numpy()
+    self._surveys    = surveys.take(keys // n_responses)
+    self._responses  = responses.take(keys % n_responses)
+
+  def select(self, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, pd.MultiIndex]:
+    # row numbers of the masked records in a table over just their rows
+    if mask is None:
+      return self.codes, self.index(np.arange(len(self._surveys)))
+    present  = self._present(mask)
+    position = np.cumsum(present) - 1
+    return position[self.codes[mask]], self.index(np.flatnonzero(present))
+
+  def union(self, masks: List[np.ndarray]) -> List[Tuple[np.ndarray, pd.MultiIndex]]:
+    # One index for several sections, laid out as pd.concat(axis=1) would
+    # join theirs: the first section's rows, then each later section's new
+    # rows in their own order.
+    seen  = np.zeros(len(self._surveys), dtype=bool)
+    order = []
+    for mask in masks:
+      new   = self._present(mask) & ~seen
+      seen |= new
+      order.append(np.flatnonzero(new))
+    order    = np.concatenate(order)
+    position = np.empty(len(self._surveys), dtype=np.intp)
+    position[order] = np.arange(len(order))
+    index = self.index(order)
+    # an empty section keeps its empty index, so it adds nothing to the join
+    return [(position[self.codes[mask]], index) if mask.any() else self.select(mask) for mask in masks]
+
+  def index(self, keys: np.ndarray) -> pd.MultiIndex:
+    return pd.MultiIndex.from_arrays([self._surveys.take(keys), self._responses.take(keys)], names=INDEX)
+
+  def _present(self, mask: np.ndarray) -> np.ndarray:
+    present = np.zeros(len(self._surveys), dtype=bool)
+    present[self.codes[mask]] = True
+    return present
+
+
+class Columns():
+  # Columns of a section in order of appearance, keyed on the question,
+  # subquestion and option of its records (missing values as one more value)
+  def __init__(self, records: pd.DataFrame):
+    self._records = records
+
+  def first_seen(self, mask: np.ndarray, columns: List[str]) -> Tuple[np.ndarray, pd.MultiIndex]:
+    # Column numbers of the masked records and the labels of those columns,
+    # taken from the record each first occurs in; levels left out of
+    # `columns` are "".
+    key = np.zeros(int(mask.sum()), dtype=np.int64)
+    for column in columns:
+      codes, uniques = _factorize(self._records[column].array[mask])
+      key = key * (len(uniques) + 1) + (codes + 1)
+    codes, _ = _factorize(key)
+    # codes count up from 0 in order of appearance, so every new high is a first
+    first  = np.flatnonzero(np.diff(np.maximum.accumulate(codes), prepend=-1))
+    first  = np.flatnonzero(mask)[first]
+    # labels keep the dtype of their column, as factorized labels would, except
+    # for an empty section whose levels are inferred like the pivot's
+    labels = [self._records[column].array.take(first) if column in columns else pd.Index([""] * len(first), dtype=str)
+              for column in MULTI_COLUMNS]
+    if len(first):
+      labels = [pd.Index(level, dtype=level.dtype) for level in labels]
+    return codes, pd.MultiIndex.from_arrays(labels, names=MULTI_COLUMNS)
+
+
+def _sorted_columns(names: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+  codes, uniques = _factorize(names, sort=True)
+  if (codes < 0).any():
+    codes   = codes + 1
+    uniques = pd.Index([np.nan], dtype=uniques.dtype).append(uniques)
+  return codes, uniques
+
+
+def _values(column: pd.Series, mask: Optional[np.ndarray] = None):
+  # numpy backed columns as plain arrays, so _scatter infers their type
+  values = column.array if mask is None else column.array[mask]
+  return np.asarray(values) if isinstance(values, pd.arrays.NumpyExtensionArray) else values
+
+
+def _scatter(values, rows: np.ndarray, columns: np.ndarray, index: pd.Index, labels: pd.Index,
+             unique: bool = True) -> pd.DataFrame:
+  # Places values[i] at (rows[i], columns[i]). With `unique` a repeated cell
+  # is an error, as in DataFrame.pivot; otherwise the first value is kept.
+  n_rows, n_columns = len(index), len(labels)
+  cells  = columns.astype(np.intp)
+  cells *= n_rows
+  cells += rows
+  filled = np.zeros(n_rows * n_columns, dtype=bool)
+  filled[cells] = True
+  # fewer cells than records means a repeated cell; the rare table that has
+  # them keeps the first record of each
+  if np.count_nonzero(filled) != len(cells):
+    if unique:
+      raise ValueError("Index contains duplicate entries, cannot reshape")
+    first         = ~pd.Index(cells).duplicated()
+    cells, values = cells[first], values[first]
+  del filled
+  values, codes = _typed(values)
+  positions = np.full(n_rows * n_columns, -1, dtype=np.intp)
+  positions[cells] = np.arange(len(cells)) if codes is None else codes
+  if isinstance(values, pd.arrays.NumpyExtensionArray):
+    block = take(np.asarray(values), positions, allow_fill=True).reshape(n_columns, n_rows).T
+    return pd.DataFrame(block, index=index, columns=labels, dtype=values.dtype.numpy_dtype)
+  filled = values.take(positions, allow_fill=True)
+  # the index is set afterwards, as handing it over aligns each column on it
+  table  = pd.DataFrame({i: filled[i * n_rows:(i + 1) * n_rows] for i in range(n_columns)})
+  table.index, table.columns = index, labels
+  return table
+
+
+def _typed(values) -> Tuple[object, Optional[np.ndarray]]:
+  # The values typed the way the pivot infers its result. Object values are
+  # typed on their distinct values, each record keeping its code into them,
+  # as long as that makes them strings.
+  if isinstance(values, np.ndarray) and values.dtype == object:
+    codes, uniques = pd.factorize(values, size_hint=FACTORIZE_SIZE_HINT)
+    distinct = pd.Series(uniques, copy=False).array
+    if isinstance(distinct.dtype, pd.StringDtype):
+      return distinct, codes
+  return pd.Series(values, copy=False).array, None
+
+
+def _scatter_sparse(values, rows: np.ndarray, columns: np.ndarray, index: pd.Index, labels: pd.Index,
+                    dtype: pd.SparseDtype, unique: bool = True) -> pd.DataFrame:
+  # _scatter into sparse columns, `values` already of dtype's subtype. The
+  # records are sorted by cell rather than placed in a dense block, and each
+  # column is made dense only while it is being compressed.
+  n_rows, n_columns = len(index), len(labels)
+  order = np.lexsort((rows, columns))
+  cells = columns[order].astype(np.intp) * n_rows + rows[order]
+  # lexsort is stable, so of a repeated cell the first record comes first
+  repeated = cells[1:] == cells[:-1]
+  if repeated.any():
+    if unique:
+      raise ValueError("Index contains duplicate entries, cannot reshape")
+    first        = np.concatenate([[True], ~repeated])
+    order, cells = order[first], cells[first]
+  values = values[order]
+  bounds = np.searchsorted(cells, np.arange(n_columns + 1) * n_rows)
+  table  = {}
+  for i in range(n_columns):
+    dense = np.full(n_rows, dtype.fill_value, dtype=dtype.subtype)
+    dense[cells[bounds[i]:bounds[i + 1]] - i * n_rows] = values[bounds[i]:bounds[i + 1]]
+    table[i] = pd.arrays.SparseArray(dense, dtype=dtype)
+  table = pd.DataFrame(table)
+  table.index, table.columns = index, labels
+  return table
+
+
+def _sparse_answers(values) -> np.ndarray:
+  return np.asarray(pd.Series(values, copy=False).to_numpy(dtype=object, na_value=np.nan))
+
+
+def flat_table(records: pd.DataFrame, variable_name: pd.Series, sparse: bool = False) -> pd.DataFrame:
+  # One column per variable name; a response answering the same variable
+  # twice keeps its first answer. `sparse` makes the columns of multi select
+  # and matrix questions sparse, which needs the records' question_type.
+  rows, index   = Rows(records).select()
+  codes, labels = _sorted_columns(variable_name)
+  labels        = labels.rename("variable_name")
+  answers       = _values(records["answer"])
+  if not sparse:
+    return _scatter(answers, rows, codes, index, labels, unique=False)
+  in_sparse = np.zeros(len(labels), dtype=bool)
+  in_sparse[codes[_is_type(records["question_type"], SPARSE_QUESTIONS)]] = True
+  if not in_sparse.any():
+    return _scatter(answers, rows, codes, index, labels, unique=False)
+  # the dense and the sparse columns scattered apart, each renumbered from 0;
+  # the answers are typed all together first, as the whole table would be
+  answers = pd.Series(answers, copy=False).array
+  dense, sparse = ~in_sparse[codes], in_sparse[codes]
+  renumber = np.where(in_sparse, np.cumsum(in_sparse), np.cumsum(~in_sparse)) - 1
+  parts    = [_scatter(answers[dense], rows[dense], renumber[codes[dense]], index, labels[~in_sparse], unique=False),
+              _scatter_sparse(_sparse_answers(answers[sparse]), rows[sparse], renumber[codes[sparse]],
+                              index, labels[in_sparse], SPARSE_ANSWER, unique=False)]
+  # back in sorted column order
+  order = np.argsort(np.concatenate([np.flatnonzero(~in_sparse), np.flatnonzero(in_sparse)]))
+  return pd.concat(parts, axis=1).iloc[:, order]
+
+
+def stack_flat(tables: List[pd.DataFrame]) -> pd.DataFrame:
+  # Flat tables of disjoint responses, in row order, as one. Each was typed
+  # on its own answers, where a single table is str throughout as soon as
+  # any answer is text.
+  table  = pd.concat(tables)
+  text   = [dtype for dtype in table.dtypes if isinstance(dtype, pd.StringDtype)]
+  sparse = [isinstance(dtype, pd.SparseDtype) for dtype in table.dtypes]
+  if text and len(text) + sum(sparse) < table.shape[1]:
+    if any(sparse):
+      # sparse columns stay sparse, a column missing from a part stays NaN there
+      for i, dtype in enumerate(table.dtypes):
+        if not sparse[i] and not isinstance(dtype, pd.StringDtype):
+          table.isetitem(i, table.iloc[:, i].astype(text[0]))
+    else:
+      table = table.astype(text[0])
+  _, order = table.columns.sort_values(return_indexer=True, na_position="first")
+  return table.iloc[:, order]
+
+
+def multi_sections(records: pd.DataFrame, aligned: bool = True, sparse: bool = False):
+  # The single select, multi select and value sections of a multi table,
+  # plus the single select options Alchemy._categorize_single_select needs.
+  # `aligned` puts the sections on one shared row index, ready to be put
+  # side by side; otherwise each keeps just its own rows, for stacking the
+  # sections of separate chunks. `sparse` makes the multi select section
+  # SPARSE_CHECKED.
+  question_type = records["question_type"]
+  single = _is_type(question_type, alchemy_types.SINGLE_SELECT_QUESTIONS)
+  multi  = _is_type(question_type, alchemy_types.MULTI_SELECT_QUESTIONS)
+  value  = _is_type(question_type, alchemy_types.SINGLE_VALUE_QUESTION + alchemy_types.MULTI_VALUE_QUESTIONS)
+
+  rows    = Rows(records)
+  columns = Columns(records)
+  if aligned:
+    single_rows, multi_rows, value_rows = rows.union([single, multi, value])
+  else:
+    single_rows, multi_rows, value_rows = (rows.select(mask) for mask in [single, multi, value])
+
+  single_select_options = (records.loc[single, ["question", "option", "option_order"]]
+                                  .drop_duplicates(subset=["question", "option"]))
+  codes, labels = columns.first_seen(single, ["question", "subquestion"])
+  single_select = _scatter(_values(records["option"], single), single_rows[0], codes, single_rows[1], labels)
+
+  # 0 / 1 to booleans once per distinct answer
+  answer_codes, answers = _factorize(_values(records["answer"], multi))
+  checked       = pd.Series(answers).replace(CHECKED).astype("boolean").array.take(answer_codes, allow_fill=True)
+  codes, labels = columns.first_seen(multi, MULTI_COLUMNS)
+  if sparse:
+    checked      = checked.to_numpy(dtype=np.float32, na_value=np.nan)
+    multi_select = _scatter_sparse(checked, multi_rows[0], codes, multi_rows[1], labels, SPARSE_CHECKED)
+  else:
+    multi_select = _scatter(checked, multi_rows[0], codes, multi_rows[1], labels)
+
+  codes, labels = columns.first_seen(value, MULTI_COLUMNS)
+  value         = _scatter(_values(records["answer"], value), value_rows[0], codes, value_rows[1], labels)
+
+  return single_select, single_select_options, multi_select, value
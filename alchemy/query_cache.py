@@ -0,0 +1,117 @@
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Tuple
+
+import pandas as pd
+
+# Default bound on the memory cached query results may take up
+DEFAULT_QUERY_CACHE_BYTES = 64 * 1024 * 1024
+
+# Only statements that just read are cached
+CACHEABLE = re.compile(r"^\s*(SELECT|WITH|VALUES)\b", re.IGNORECASE)
+
+WHITESPACE = re.compile(r"\s+")
+
+# Under copy-on-write (always on from pandas 3) a shallow copy is enough to
+# keep a caller's writes away from the cached frame
+COPY_ON_WRITE = int(pd.__version__.split(".")[0]) >= 3
+
+
+def _normalize(query: str) -> str:
+  # Whitespace and a trailing ; do not change a query. Case is kept, it
+  # matters inside string literals.
+  return WHITESPACE.sub(" ", query).strip().rstrip(";").rstrip()
+
+
+def _params_key(params) -> Hashable:
+  if params is None:
+    return None
+  if isinstance(params, dict):
+    return tuple(sorted(params.items()))
+  return tuple(params)
+
+
+def _size(frame: pd.DataFrame) -> int:
+  return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+class QueryCache():
+  # Results of Alchemy.query, least recently used first out once they add up
+  # to more than `max_bytes`. Every entry is dropped as soon as the database
+  # changes: PRAGMA data_version moves with each commit from another
+  # connection (load_survey's), total_changes with each write through this
+  # one. With `copy_on_read` callers get a copy, so changing a returned frame
+  # never changes what the next caller is handed.
+  def __init__(self, max_bytes: int = DEFAULT_QUERY_CACHE_BYTES, copy_on_read: bool = True):
+    if max_bytes < 0:
+      raise ValueError(f"max_bytes must not be negative, got {max_bytes}")
+    self.max_bytes    = max_bytes
+    self.copy_on_read = copy_on_read
+    self.hits         = 0
+    self.misses       = 0
+    self._entries: "OrderedDict[Hashable, Tuple[pd.DataFrame, int]]" = OrderedDict()
+    self._bytes   = 0
+    self._version = None
+    self._lock    = threading.Lock()
+
+  def fetch(self, conn: sqlite3.Connection, query: str, params,
+            read: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+    # The cached result of `query` with `params`, or `read()`'s, cached
+    if not CACHEABLE.match(query):
+      return read()
+    key = (_normalize(query), _params_key(params))
+    with self._lock:
+      self._check_version(conn)
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._copy(entry[0])
+      self.misses += 1
+      version = self._version
+    frame = read()
+    with self._lock:
+      # a write while reading makes the frame as stale as what it replaced
+      self._check_version(conn)
+      if self._version == version:
+        self._put(key, frame)
+    return self._copy(frame)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  @property
+  def size(self) -> int:
+    return self._bytes
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def _check_version(self, conn: sqlite3.Connection):
+    version = (conn.execute("PRAGMA data_version;").fetchone()[0], conn.total_changes)
+    if version != self._version:
+      self._entries.clear()
+      self._bytes   = 0
+      self._version = version
+
+  def _put(self, key: Hashable, frame: pd.DataFrame):
+    size = _size(frame)
+    if size > self.max_bytes:
+      return
+    old = self._entries.pop(key, None)
+    if old is not None:
+      self._bytes -= old[1]
+    self._entries[key] = (frame, size)
+    self._bytes += size
+    while self._bytes > self.max_bytes:
+      _, (_, evicted) = self._entries.popitem(last=False)
+      self._bytes -= evicted
+
+  def _copy(self, frame: pd.DataFrame) -> pd.DataFrame:
+    if not self.copy_on_read:
+      return frame
+    return frame.copy(deep=not COPY_ON_WRITE)
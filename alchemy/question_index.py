@@ -0,0 +1,129 @@
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from .alchemy_types import QuestionType, QUESTION_TYPE_STR_MAP
+
+
+class QuestionOption(NamedTuple):
+  id:           int
+  value:        Optional[str]
+  option_order: Optional[int]
+
+
+class QuestionMeta(NamedTuple):
+  id:            int
+  question_type: QuestionType
+  parent_id:     int # 0 for top level questions
+  shortname:     str
+  title:         str
+  options:       Tuple[QuestionOption, ...]
+
+
+GET_QUESTIONS = '''
+  SELECT DISTINCT
+    q.id,
+    q.question_type,
+    q.parent_id,
+    q.shortname,
+    q.title
+  FROM question as q
+  INNER JOIN survey_x_question as sxq ON sxq.question_id = q.id
+  {where};'''
+
+GET_OPTIONS = '''
+  SELECT
+    o.question_id,
+    o.id,
+    o.value,
+    o.option_order
+  FROM option as o
+  WHERE o.question_id IN ({question_ids})
+  ORDER BY o.question_id, o.option_order;'''
+
+
+class QuestionIndex():
+  # Question metadata for one or more surveys keyed by question id, so that
+  # classifying an answer is a dict lookup instead of a round trip to sqlite.
+  def __init__(self, questions: Iterable[QuestionMeta]=()):
+    self._questions: Dict[int, QuestionMeta] = {q.id: q for q in questions}
+
+  @classmethod
+  def from_questions_data(cls, questions_data: List[dict]) -> "QuestionIndex":
+    # Accepts the `surveyquestion` payload either raw or after load_survey has
+    # normalized it (type mapped to an int, title flattened to English).
+    parents: Dict[int, int] = {}
+    flattened = {}
+    pending   = list(questions_data)
+    while pending:
+      question = pending.pop()
+      for sub_question in question.get("sub_questions", []) or []:
+        parents[int(sub_question["id"])] = int(question["id"])
+        pending.append(sub_question)
+      flattened.setdefault(int(question["id"]), question)
+    questions = []
+    for question_id, question in flattened.items():
+      options = tuple(QuestionOption(int(option["id"]), option.get("value"), option.get("option_order", j))
+                      for j, option in enumerate(question.get("options", []) or []))
+      title = question.get("title")
+      if isinstance(title, dict):
+        title = title.get("English")
+      questions.append(QuestionMeta(id            = question_id,
+                                    question_type = _to_question_type(question["type"]),
+                                    parent_id     = int(question.get("parent_id") or parents.get(question_id, 0)),
+                                    shortname     = question.get("shortname") or title or "",
+                                    title         = title or "",
+                                    options       = options))
+    return cls(questions)
+
+  @classmethod
+  def from_db(cls, con: sqlite3.Connection,
+              survey_ids: Optional[Union[int, List[int]]]=None) -> "QuestionIndex":
+    where  = ""
+    params = []
+    if survey_ids:
+      if type(survey_ids) == int:
+        survey_ids = [survey_ids]
+      where  = f"WHERE sxq.survey_id IN ({','.join(['?'] * len(survey_ids))})"
+      params = list(survey_ids)
+    rows = con.execute(GET_QUESTIONS.format(where=where), params).fetchall()
+    options: Dict[int, List[QuestionOption]] = {}
+    if rows:
+      question_ids = [row[0] for row in rows]
+      query = GET_OPTIONS.format(question_ids=','.join(['?'] * len(question_ids)))
+      for question_id, option_id, value, option_order in con.execute(query, question_ids):
+        options.setdefault(question_id, []).append(QuestionOption(option_id, value, option_order))
+    return cls(QuestionMeta(id            = row[0],
+                            question_type = QuestionType(row[1]),
+                            parent_id     = row[2] or 0,
+                            shortname     = row[3],
+                            title         = row[4],
+                            options       = tuple(options.get(row[0], ())))
+               for row in rows)
+
+  def get(self, question_id: Union[int, str]) -> Optional[QuestionMeta]:
+    return self._questions.get(int(question_id))
+
+  def question_type(self, question_id: Union[int, str]) -> Optional[QuestionType]:
+    question = self.get(question_id)
+    return question.question_type if question else None
+
+  def sub_questions(self, question_id: Union[int, str]) -> List[QuestionMeta]:
+    return [q for q in self._questions.values() if q.parent_id == int(question_id)]
+
+  def __getitem__(self, question_id: Union[int, str]) -> QuestionMeta:
+    return self._questions[int(question_id)]
+
+  def __contains__(self, question_id) -> bool:
+    return int(question_id) in self._questions
+
+  def __iter__(self) -> Iterator[QuestionMeta]:
+    return iter(self._questions.values())
+
+  def __len__(self) -> int:
+    return len(self._questions)
+
+
+def _to_question_type(question_type: Union[int, str]) -> QuestionType:
+  if isinstance(question_type, str):
+    return QUESTION_TYPE_STR_MAP[question_type]
+  return QuestionType(question_type)
@@ -0,0 +1,210 @@
+import argparse
+import gzip
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Query parameters that identify the caller rather than the data, so they are
+# neither written to fixtures nor needed to replay them.
+CREDENTIAL_PARAMS = {"api_token", "api_token_secret"}
+
+RATE_LIMIT_WINDOW = 60.0
+
+
+def fixture_key(url: str) -> str:
+  parts = urlsplit(url)
+  query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                 if k not in CREDENTIAL_PARAMS)
+  return f"{parts.path.rstrip('/')}?{urlencode(query)}"
+
+
+class FixtureRecorder():
+  # Appends every api response seen by a session to a gzipped jsonl file, one
+  # {"key", "status", "body"} object per line. Safe to use from the fetch pool.
+  def __init__(self, path: str):
+    self._file = gzip.open(path, "at", encoding="utf-8")
+    self._lock = threading.Lock()
+
+  def attach(self, session: requests.Session):
+    session.hooks["response"].append(self._record)
+
+  def _record(self, response: requests.Response, *args, **kwargs):
+    line = json.dumps({"key":    fixture_key(response.request.url),
+                       "status": response.status_code,
+                       "body":   response.text})
+    with self._lock:
+      self._file.write(line + "\n")
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class FixtureStore():
+  def __init__(self, fixtures: Dict[str, Tuple[int, bytes]]):
+    self._fixtures = fixtures
+
+  @classmethod
+  def load(cls, path: str) -> "FixtureStore":
+    fixtures = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+      for line in f:
+        if line.strip():
+          fixture = json.loads(line)
+          fixtures[fixture["key"]] = (fixture["status"], fixture["body"].encode("utf-8"))
+    return cls(fixtures)
+
+  def lookup(self, url: str) -> Tuple[int, bytes]:
+    key = fixture_key(url)
+    if key not in self._fixtures:
+      return 404, json.dumps({"result_ok": False, "message": f"no fixture recorded for {key}"}).encode("utf-8")
+    return self._fixtures[key]
+
+  def __len__(self) -> int:
+    return len(self._fixtures)
+
+
+class Throttle():
+  # Simulates the api's round trip latency and its per-minute request limit.
+  # admit() returns None when a request may proceed, otherwise the number of
+  # seconds the caller should wait (sent back as a 429 Retry-After).
+  def __init__(self, latency: float = 0.0, rate_limit: Optional[int] = None,
+               window: float = RATE_LIMIT_WINDOW):
+    self.latency    = latency
+    self.rate_limit = rate_limit
+    self.window     = window
+    self._requests  = deque()
+    self._lock      = threading.Lock()
+
+  def admit(self) -> Optional[float]:
+    if self.latency:
+      time.sleep(self.latency)
+    if not self.rate_limit:
+      return None
+    with self._lock:
+      now = time.monotonic()
+      while self._requests and now - self._requests[0] >= self.window:
+        self._requests.popleft()
+      if len(self._requests) >= self.rate_limit:
+        return self.window - (now - self._requests[0])
+      self._requests.append(now)
+      return None
+
+
+def _throttled_body(retry_after: float) -> bytes:
+  return json.dumps({"result_ok": False, "message": f"rate limit exceeded, retry in {retry_after:.1f}s"}).encode("utf-8")
+
+
+class ReplayAdapter(BaseAdapter):
+  # requests transport that answers from recorded fixtures instead of the
+  # network. Mount it on a session with session.mount(ALCHEMER_HOST, adapter).
+  def __init__(self, store: FixtureStore, throttle: Optional[Throttle] = None):
+    super().__init__()
+    self._store    = store
+    self._throttle = throttle or Throttle()
+
+  def send(self, request, **kwargs) -> requests.Response:
+    retry_after = self._throttle.admit()
+    if retry_after is None:
+      status, body = self._store.lookup(request.url)
+      headers = {}
+    else:
+      status, body = 429, _throttled_body(retry_after)
+      headers = {"Retry-After": f"{retry_after:.0f}"}
+    response = requests.Response()
+    response.status_code = status
+    response.reason      = "OK" if status == 200 else "Too Many Requests" if status == 429 else "Not Found"
+    response.headers     = CaseInsensitiveDict({"Content-Type": "application/json", **headers})
+    response._content    = body
+    response.encoding    = "utf-8"
+    response.url         = request.url
+    response.request     = request
+    return response
+
+  def close(self):
+    pass
+
+
+class ReplayServer():
+  # Local http stand-in for api.alchemer.com serving the same fixtures, for
+  # runs that should go through a real socket and connection pool.
+  def __init__(self, store: FixtureStore, throttle: Optional[Throttle] = None,
+               host: str = "127.0.0.1", port: int = 0):
+    throttle = throttle or Throttle()
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+
+      def do_GET(self):
+        retry_after = throttle.admit()
+        if retry_after is None:
+          status, body = store.lookup(self.path)
+        else:
+          status, body = 429, _throttled_body(retry_after)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if retry_after is not None:
+          self.send_header("Retry-After", f"{retry_after:.0f}")
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._server = ThreadingHTTPServer((host, port), Handler)
+    self._thread = None
+
+  @property
+  def url(self) -> str:
+    host, port = self._server.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def start(self) -> "ReplayServer":
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Serve recorded alchemer fixtures as a local mock api.")
+  parser.add_argument("fixtures", type=str, help="gzipped jsonl file written by FixtureRecorder")
+  parser.add_argument("--host", type=str, default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+  parser.add_argument("--rate-limit", type=int, default=None, help="requests allowed per minute")
+  args = parser.parse_args()
+
+  store  = FixtureStore.load(args.fixtures)
+  server = ReplayServer(store, Throttle(args.latency, args.rate_limit), args.host, args.port)
+  print(f"serving {len(store)} fixtures on {server.url}")
+  server.start()
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.stop()
@@ -0,0 +1,161 @@
+import logging
+import random
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple, Union
+
+import requests
+
+from .instrumentation import NO_INSTRUMENTATION, Instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Alchemer allows 240 api calls per minute per account
+DEFAULT_RATE_LIMIT      = 240
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES     = 6
+BACKOFF_BASE            = 0.5
+BACKOFF_MAX             = 60.0
+LOW_WATER               = 0.25 # fraction of the token bucket treated as "near the limit"
+DEFAULT_TIMEOUT         = (10.0, 60.0) # seconds to connect, and to wait on the server between bytes
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket():
+  # Hands out `rate` tokens per second with room for `capacity` in a burst.
+  def __init__(self, rate: float, capacity: Optional[float] = None):
+    self.rate     = rate
+    self.capacity = capacity if capacity is not None else max(rate, 1.0)
+    self._tokens  = self.capacity
+    self._updated = time.monotonic()
+    self._lock    = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens  = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait = (1 - self._tokens) / self.rate
+      time.sleep(wait)
+
+  def drain(self):
+    # Called when the server says we are over the limit anyway
+    with self._lock:
+      self._tokens  = 0
+      self._updated = time.monotonic()
+
+  @property
+  def fill(self) -> float:
+    with self._lock:
+      now = time.monotonic()
+      return min(self.capacity, self._tokens + (now - self._updated) * self.rate) / self.capacity
+
+
+class AdaptiveLimiter():
+  # Additive increase / multiplicative decrease cap on requests in flight:
+  # halves on a throttled response and moves by one after each window of
+  # successes - up while there is rate headroom, down once we are close to it.
+  def __init__(self, max_concurrency: int):
+    self.max_concurrency = max(max_concurrency, 1)
+    self.limit           = self.max_concurrency
+    self._in_flight      = 0
+    self._successes      = 0
+    self._cond           = threading.Condition()
+
+  def __enter__(self):
+    with self._cond:
+      while self._in_flight >= self.limit:
+        self._cond.wait()
+      self._in_flight += 1
+    return self
+
+  def __exit__(self, *exc):
+    with self._cond:
+      self._in_flight -= 1
+      self._cond.notify_all()
+
+  def on_success(self, headroom: bool = True):
+    with self._cond:
+      self._successes += 1
+      if self._successes < self.limit:
+        return
+      self._successes = 0
+      if headroom and self.limit < self.max_concurrency:
+        self.limit += 1
+        self._cond.notify_all()
+      elif not headroom and self.limit > 1:
+        self.limit -= 1
+
+  def on_throttle(self):
+    with self._cond:
+      self.limit      = max(1, self.limit // 2)
+      self._successes = 0
+
+
+class RequestScheduler():
+  # Shared front door for every api call: paces requests with a token bucket
+  # sized to the account's per-minute limit, retries 429/5xx, connection
+  # errors and timeouts with exponential backoff, and narrows the number of
+  # requests in flight whenever the api pushes back. Every request gets
+  # `timeout` unless the call passes its own, so a stalled connection is
+  # retried rather than waited on forever. Safe to call from many threads.
+  def __init__(self, session: Optional[requests.Session] = None,
+               rate_limit: int = DEFAULT_RATE_LIMIT,
+               max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+               max_retries: int = DEFAULT_MAX_RETRIES,
+               instrumentation: Optional[Instrumentation] = None,
+               timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT):
+    self.session     = session or requests.Session()
+    self.max_retries = max_retries
+    self.timeout     = timeout
+    self.metrics     = instrumentation or NO_INSTRUMENTATION
+    self._bucket     = TokenBucket(rate_limit / 60.0, capacity=max(max_concurrency, 1))
+    self._limiter    = AdaptiveLimiter(max_concurrency)
+
+  @property
+  def concurrency(self) -> int:
+    return self._limiter.limit
+
+  def get(self, url: str, params: Optional[Dict[str, Any]] = None, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", self.timeout)
+    attempt = 0
+    while True:
+      with self.metrics.stage("throttle wait"):
+        self._bucket.acquire()
+      try:
+        with self._limiter:
+          res = self.session.get(url, params=params, **kwargs)
+      except (requests.ConnectionError, requests.Timeout) as e:
+        if attempt >= self.max_retries:
+          raise
+        delay = self._backoff(attempt)
+        logger.warning(f"{type(e).__name__} fetching {url}: {e}. retrying in {delay:.1f}s")
+      else:
+        if res.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+          if res.status_code == 200:
+            # ease off before the api has to tell us to, once the bucket runs low
+            self._limiter.on_success(headroom=self._bucket.fill >= LOW_WATER)
+          return res
+        if res.status_code == 429:
+          self._limiter.on_throttle()
+          self._bucket.drain()
+        delay = self._retry_after(res) or self._backoff(attempt)
+        logger.warning(f"received {res.status_code} fetching {url}. retrying in {delay:.1f}s "
+                       f"with concurrency {self._limiter.limit}")
+      with self.metrics.stage("throttle backoff"):
+        time.sleep(delay)
+      attempt += 1
+
+  def _backoff(self, attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+  def _retry_after(self, res: requests.Response) -> Optional[float]:
+    try:
+      return min(BACKOFF_MAX, float(res.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+      return None
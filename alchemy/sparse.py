@@ -0,0 +1,46 @@
+from typing import Any, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .pivot import SPARSE_ANSWER, SPARSE_CHECKED
+
+# Between the dense tables get_table gives and sparse ones: multi select
+# (boolean) columns as SPARSE_CHECKED, text columns as SPARSE_ANSWER.
+# to_dense(get_table(..., sparse=True)) equals get_table(...).
+
+
+def to_sparse(table: pd.DataFrame, columns: Optional[List[Any]]=None) -> pd.DataFrame:
+  # The boolean and text columns among `columns` (default: all of them) made
+  # sparse; other columns are left as they are, and naming one is an error.
+  table = table.copy(deep=False)
+  for i, (label, dtype) in enumerate(table.dtypes.items()):
+    if (columns is not None and label not in columns) or isinstance(dtype, pd.SparseDtype):
+      continue
+    column = table.iloc[:, i]
+    if isinstance(dtype, pd.BooleanDtype) or dtype == bool:
+      table.isetitem(i, pd.arrays.SparseArray(column.to_numpy(dtype=np.float32, na_value=np.nan), dtype=SPARSE_CHECKED))
+    elif isinstance(dtype, pd.StringDtype) or dtype == object:
+      table.isetitem(i, pd.arrays.SparseArray(column.to_numpy(dtype=object, na_value=np.nan), dtype=SPARSE_ANSWER))
+    elif columns is not None:
+      raise ValueError(f"to_sparse only makes boolean and text columns sparse, {label!r} is {dtype}")
+  return table
+
+
+def to_dense(table: pd.DataFrame, string_dtype: Optional[Any]=None) -> pd.DataFrame:
+  # The sparse columns made dense again: numbers as "boolean", text as
+  # `string_dtype`, by default that of the table's dense text columns (or,
+  # with none, the type pandas infers for str objects).
+  if string_dtype is None:
+    string_dtype = next((dtype for dtype in table.dtypes if isinstance(dtype, pd.StringDtype)), None)
+  table = table.copy(deep=False)
+  for i, dtype in enumerate(table.dtypes):
+    if not isinstance(dtype, pd.SparseDtype):
+      continue
+    column = table.iloc[:, i]
+    if np.issubdtype(dtype.subtype, np.number):
+      table.isetitem(i, column.astype("boolean"))
+    else:
+      dense = column.sparse.to_dense()
+      table.isetitem(i, dense if string_dtype is None else dense.astype(string_dtype))
+  return table
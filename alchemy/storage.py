@@ -0,0 +1,735 @@
+import operator
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List, Literal, NamedTuple, Optional, Tuple
+
+import pandas as pd
+import numpy as np
+
+from . import alchemy_types
+
+RECORDS_DTYPES = {
+  "survey_id":     np.int32,
+  "response_id":   np.int32,
+  "question":      np.str_,
+  "subquestion":   np.str_,
+  "option":        np.str_,
+  "answer":        np.str_,
+  "question_type": np.int8,
+  # pinned so every iter_records chunk agrees, even one where all are null
+  "option_order":  np.float64,
+  "answer_number": np.float64,
+  "variable_name": np.str_,
+}
+
+STRING_COLUMNS = ["question", "subquestion", "option", "answer", "variable_name"]
+
+DTYPE_BACKENDS = ["numpy", "pyarrow"]
+
+RECORD_COLUMNS = ["survey_id", "response_id", "question", "subquestion",
+                  "option", "option_order", "answer", "question_type"]
+
+# Record columns only returned when asked for
+EXTRA_RECORD_COLUMNS = ["answer_number", "question_id", "sub_question_id", "option_id", "variable_name"]
+
+# What identifies an answer; categorical records are read as just these ids
+KEY_COLUMNS = ["survey_id", "response_id", "question_id", "sub_question_id", "option_id"]
+
+def _type_list(question_types) -> str:
+  return ", ".join(str(int(question_type)) for question_type in question_types)
+
+
+# The flat table column of a record, out of the parts stored at load time
+VARIABLE_NAME_CASE = f"""CASE
+      WHEN q1.question_type IN ({_type_list(alchemy_types.SINGLETON_QUESTIONS)}) THEN q1.variable_name
+      WHEN q1.question_type IN ({_type_list(alchemy_types.MULTI_QUESTIONS)}) THEN o.variable_prefix || '_' || q1.variable_name
+      WHEN q1.question_type IN ({_type_list(alchemy_types.TWO_LAYER_QUESTIONS)}) THEN q2.variable_prefix || '_' || q1.variable_name
+      ELSE ''
+    END"""
+
+VARIABLE_NAME_EXPR = f"{VARIABLE_NAME_CASE} as variable_name"
+
+GET_RECORDS = '''
+  SELECT
+    {columns}
+  FROM answer as a
+  INNER JOIN question as q1 ON q1.id = a.question_id
+  LEFT  JOIN question as q2 ON q2.id = a.sub_question_id
+  LEFT  JOIN option   as o  ON o.id  = a.option_id
+  {values}{where} ORDER BY a.survey_id, a.response_id, q1.shortname;'''
+
+RECORD_COLUMN_EXPRS = {
+  "survey_id":     "a.survey_id",
+  "response_id":   "a.response_id",
+  "question":      "q1.shortname as question",
+  "subquestion":   "q2.title     as subquestion",
+  "option":        "o.value      as option",
+  "option_order":  "o.option_order",
+  "answer":        "v.value      as answer",
+  "question_type": "q1.question_type",
+  "answer_number": "v.number     as answer_number",
+  "question_id":     "a.question_id",
+  "sub_question_id": "a.sub_question_id",
+  "option_id":       "a.option_id",
+  "variable_name":   VARIABLE_NAME_EXPR,
+}
+
+# Undecoded answers: the answer_value id, turned into categorical codes
+ANSWER_CODE_EXPR = "a.value_id   as answer"
+
+JOIN_ANSWER_VALUES = "LEFT  JOIN answer_value as v ON v.id = a.value_id\n  "
+
+# answer table columns each record column is derived from
+ANSWER_SOURCE_COLUMNS = {
+  "survey_id":     "survey_id",
+  "response_id":   "response_id",
+  "question":      "question_id",
+  "subquestion":   "sub_question_id",
+  "option":        "option_id",
+  "option_order":  "option_id",
+  "answer":        "answer",
+  "question_type": "question_id",
+  "answer_number": "answer_number",
+  "question_id":     "question_id",
+  "sub_question_id": "sub_question_id",
+  "option_id":       "option_id",
+  "variable_name":   "question_id",
+}
+
+# Responses with an answer passing a ResponseFilter, for a semijoin
+GET_FILTERED_RESPONSES = '''
+    SELECT a.survey_id, a.response_id
+    FROM answer as a
+    INNER JOIN question as q1 ON q1.id = a.question_id
+    LEFT  JOIN question as q2 ON q2.id = a.sub_question_id
+    LEFT  JOIN option   as o  ON o.id  = a.option_id
+    LEFT  JOIN answer_value as v ON v.id = a.value_id
+    WHERE {where}'''
+
+# Ids only, in index order; the text is attached afterwards in pandas
+GET_ANSWER_KEYS = '''
+  SELECT a.survey_id, a.response_id, a.question_id, a.sub_question_id, a.option_id, a.value_id
+  FROM answer as a
+  {where} ORDER BY a.survey_id, a.response_id, a.question_id, a.sub_question_id, a.option_id;'''
+
+ANSWER_KEYS_DTYPES = {"survey_id": np.int32, "response_id": np.int32}
+
+GET_SURVEY_ANSWERS = '''
+  SELECT a.survey_id, a.response_id, a.question_id, a.sub_question_id, a.option_id,
+         v.value as answer, v.number as answer_number
+    FROM answer as a
+    LEFT JOIN answer_value as v ON v.id = a.value_id
+   WHERE a.survey_id = ?
+   ORDER BY a.response_id, a.question_id, a.sub_question_id, a.option_id;'''
+
+GET_QUESTION_LOOKUP = '''
+  SELECT id, shortname as question, title as subquestion, question_type, variable_name, variable_prefix
+    FROM question
+   WHERE id IN ({ids});'''
+
+GET_VALUE_LOOKUP = '''
+  SELECT id, value, number
+    FROM answer_value
+   WHERE id IN ({ids})
+   ORDER BY id;'''
+
+GET_OPTION_LOOKUP = '''
+  SELECT id, value as option, option_order, variable_prefix
+    FROM option
+   WHERE id IN ({ids});'''
+
+# stay under sqlite's default bound parameter limit
+LOOKUP_CHUNK_SIZE = 900
+
+# records per chunk yielded by iter_records, before rounding to whole responses
+DEFAULT_CHUNKSIZE = 100_000
+
+# Rows per row group of a parquet partition, which bounds what streaming one
+# takes in memory
+PARTITION_ROW_GROUP_SIZE = 65_536
+
+# rows sharing these keys are never split across iter_records chunks
+CHUNK_KEYS = {
+  "response": ["survey_id", "response_id"],
+  "survey":   ["survey_id"],
+}
+
+# ResponseFilter comparisons, in sql and in pandas
+FILTER_OPS = {
+  "==": ("=",  operator.eq),
+  "!=": ("!=", operator.ne),
+  "<":  ("<",  operator.lt),
+  "<=": ("<=", operator.le),
+  ">":  (">",  operator.gt),
+  ">=": (">=", operator.ge),
+  "in":     ("IN", None),
+  "not in": ("NOT IN", None),
+}
+
+
+class AnswerMatch(NamedTuple):
+  # Answers to the questions `question_ids` whose question shortname is one
+  # of `shortnames` or whose flat variable name is one of `variable_names`.
+  # The ids narrow the read, the names pick the exact answers.
+  question_ids:   List[int]
+  shortnames:     List[str]
+  variable_names: List[str]
+
+
+class ResponseFilter(NamedTuple):
+  # Responses with a `answers` answer whose value compares `op` to `value`;
+  # numbers are compared against the answer's numeric reading, and "in" /
+  # "not in" take a list.
+  answers: AnswerMatch
+  op:      str
+  value:   Any
+
+
+class RecordSelection(NamedTuple):
+  # Narrows a read to the `answers` (all when None) of the responses passing
+  # every one of `responses`
+  answers:   Optional[AnswerMatch] = None
+  responses: Tuple[ResponseFilter, ...] = ()
+
+
+def _numeric(value) -> bool:
+  values = value if isinstance(value, (list, tuple)) else [value]
+  return all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values)
+
+
+def _placeholders(values) -> str:
+  return ','.join(['?'] * len(values))
+
+
+def _match_sql(match: AnswerMatch) -> Tuple[str, List[Any]]:
+  names, params = [], list(match.question_ids)
+  if match.shortnames:
+    names.append(f"q1.shortname IN ({_placeholders(match.shortnames)})")
+    params += match.shortnames
+  if match.variable_names:
+    names.append(f"({VARIABLE_NAME_CASE}) IN ({_placeholders(match.variable_names)})")
+    params += match.variable_names
+  return f"a.question_id IN ({_placeholders(match.question_ids)}) AND ({' OR '.join(names) or '0'})", params
+
+
+def _selection_sql(selection: RecordSelection, survey_clause: str,
+                   survey_params: List[int]) -> Tuple[List[str], List[Any]]:
+  # WHERE clauses over GET_RECORDS's a, q1, q2 and o, responses as semijoins
+  clauses, params = [], []
+  if selection.answers is not None:
+    clause, match_params = _match_sql(selection.answers)
+    clauses.append(clause)
+    params += match_params
+  for response_filter in selection.responses:
+    clause, match_params = _match_sql(response_filter.answers)
+    sql_op = FILTER_OPS[response_filter.op][0]
+    column = "v.number" if _numeric(response_filter.value) else "v.value"
+    if response_filter.op in ("in", "not in"):
+      clause += f" AND {column} {sql_op} ({_placeholders(response_filter.value)})"
+      match_params += list(response_filter.value)
+    else:
+      clause += f" AND {column} {sql_op} ?"
+      match_params.append(response_filter.value)
+    if survey_clause:
+      clause = f"{survey_clause} AND {clause}"
+    clauses.append(f"(a.survey_id, a.response_id) IN ({GET_FILTERED_RESPONSES.format(where=clause)})")
+    params += survey_params + match_params
+  return clauses, params
+
+
+def _matches(records: pd.DataFrame, match: AnswerMatch) -> np.ndarray:
+  # AnswerMatch over records read with question and variable_name
+  return (records["question"].isin(match.shortnames) |
+          records["variable_name"].isin(match.variable_names)).to_numpy()
+
+
+def _passes(records: pd.DataFrame, response_filter: ResponseFilter) -> np.ndarray:
+  # ResponseFilter over records read with answer and answer_number; a missing
+  # answer never passes, as in sql
+  column = "answer_number" if _numeric(response_filter.value) else "answer"
+  values = records[column]
+  if response_filter.op == "in":
+    passes = values.isin(response_filter.value)
+  elif response_filter.op == "not in":
+    passes = ~values.isin(response_filter.value)
+  else:
+    passes = FILTER_OPS[response_filter.op][1](values, response_filter.value)
+  return (passes & values.notna()).to_numpy()
+
+
+def check_selection(selection: Optional[RecordSelection], categorical: bool):
+  if selection is None:
+    return
+  if categorical:
+    raise ValueError("a record selection cannot be read as categorical records")
+  for response_filter in selection.responses:
+    if response_filter.op not in FILTER_OPS:
+      raise ValueError(f"response filters take an op in {list(FILTER_OPS)}, got {response_filter.op}")
+    if response_filter.op in ("in", "not in") and not isinstance(response_filter.value, (list, tuple)):
+      raise ValueError(f"the {response_filter.op} response filter takes a list, got {type(response_filter.value)}")
+
+
+def _records_dtypes(columns: Iterable[str], decode: bool = True,
+                    dtype_backend: str = "numpy") -> Dict[str, type]:
+  # The pyarrow backend keeps the text columns in arrow string arrays, a
+  # fraction of the size of python str objects and handled by arrow compute
+  # in the .str methods.
+  dtypes = {column: RECORDS_DTYPES[column] for column in columns
+            if column in RECORDS_DTYPES and (decode or column != "answer")}
+  if dtype_backend == "pyarrow":
+    dtypes.update({column: pd.StringDtype("pyarrow") for column in dtypes if column in STRING_COLUMNS})
+  return dtypes
+
+
+def _check_dtype_backend(dtype_backend: str):
+  if dtype_backend not in DTYPE_BACKENDS:
+    raise ValueError(f"dtype_backend must be one of {DTYPE_BACKENDS}, got {dtype_backend}")
+  if dtype_backend == "pyarrow":
+    try:
+      import pyarrow # noqa: F401
+    except ImportError as e:
+      raise ImportError("the pyarrow dtype backend requires pyarrow, install it with `pip install alchemy[arrow]`") from e
+
+
+def _lookup(conn: sqlite3.Connection, query: str, ids: Iterable) -> pd.DataFrame:
+  ids = [int(i) for i in ids if not pd.isna(i)]
+  frames = [pd.read_sql_query(query.format(ids=','.join(['?'] * len(chunk))), conn, params=chunk)
+            for chunk in (ids[i:i + LOOKUP_CHUNK_SIZE] for i in range(0, len(ids), LOOKUP_CHUNK_SIZE))]
+  if not frames:
+    return pd.read_sql_query(query.format(ids="NULL"), conn)
+  return pd.concat(frames, ignore_index=True)
+
+
+def _source_columns(columns: List[str], categorical: bool) -> List[str]:
+  # Partition columns records with `columns` are made from. Survey, response
+  # and question are always read: they define the ordering.
+  return list(dict.fromkeys(["survey_id", "response_id", "question_id"] +
+                            (KEY_COLUMNS if categorical or "variable_name" in columns else []) +
+                            [ANSWER_SOURCE_COLUMNS[c] for c in columns]))
+
+
+def _selection_columns(columns: List[str]) -> List[str]:
+  # what applying a selection to records needs on top of `columns`
+  return list(dict.fromkeys(columns + ["survey_id", "response_id", "question", "variable_name"]))
+
+
+def _selection_question_ids(selection: Optional[RecordSelection]) -> Optional[List[int]]:
+  if selection is None or selection.answers is None:
+    return None
+  return selection.answers.question_ids
+
+
+def _response_ordered(partition) -> bool:
+  # whether every row group of a parquet partition declares itself sorted by
+  # response_id, as write_survey writes them
+  index    = partition.schema_arrow.get_field_index("response_id")
+  metadata = partition.metadata
+  return all(metadata.row_group(i).sorting_columns[:1] and
+             metadata.row_group(i).sorting_columns[0].column_index == index
+             for i in range(metadata.num_row_groups))
+
+
+def _whole_groups(chunks: Iterable[pd.DataFrame], keys: List[str]) -> Iterator[pd.DataFrame]:
+  # Re-cuts chunks of key ordered records so that all rows sharing `keys`
+  # end up in the same chunk: everything from the start of each chunk's last
+  # group onwards is held back until a later chunk shows the group is over.
+  pending = []
+  for chunk in chunks:
+    if chunk.empty:
+      continue
+    starts = np.zeros(len(chunk), dtype=bool)
+    for key in keys:
+      values = chunk[key].to_numpy()
+      starts[1:] |= values[1:] != values[:-1]
+      if pending:
+        starts[0] |= values[0] != pending[-1][key].iloc[-1]
+    starts = np.flatnonzero(starts)
+    if not starts.size:
+      pending.append(chunk)
+      continue
+    cut  = starts[-1]
+    head = pending + ([chunk.iloc[:cut]] if cut else [])
+    yield pd.concat(head, ignore_index=True)
+    pending = [chunk.iloc[cut:]]
+  if pending:
+    yield pd.concat(pending, ignore_index=True)
+
+
+def _answer_categorical(conn: sqlite3.Connection, value_ids: pd.Series) -> pd.Categorical:
+  # answer_value ids -> categorical over just the values that occur, without
+  # materializing a string per record
+  ids    = value_ids.dropna().unique()
+  values = _lookup(conn, GET_VALUE_LOOKUP, ids).sort_values("id", ignore_index=True)
+  codes  = np.full(len(value_ids), -1, dtype=np.int32)
+  known  = value_ids.notna().to_numpy()
+  codes[known] = np.searchsorted(values["id"].to_numpy(), value_ids[known].to_numpy(np.int64))
+  return pd.Categorical.from_codes(codes, categories=pd.Index(values["value"], dtype=object))
+
+
+def _positions(lookup_ids: np.ndarray, ids: pd.Series) -> np.ndarray:
+  # row of each id in the sorted `lookup_ids`, -1 where it is null or absent
+  ids   = ids.to_numpy(dtype=np.float64, na_value=np.nan)
+  pos   = np.searchsorted(lookup_ids, np.nan_to_num(ids, nan=-1))
+  found = ~np.isnan(ids) & (pos < len(lookup_ids))
+  found[found] = lookup_ids[pos[found]] == ids[found]
+  return np.where(found, pos, -1)
+
+
+def _take(values: pd.Series, positions: np.ndarray, dtype) -> np.ndarray:
+  values = values.to_numpy(dtype=np.float64, na_value=np.nan)
+  return np.where(positions >= 0, values[positions], np.nan).astype(dtype)
+
+
+def _take_text(values: pd.Series, positions: np.ndarray) -> np.ndarray:
+  # -1 picks the None on the end
+  return np.append(values.to_numpy(dtype=object, na_value=None), None)[positions]
+
+
+def _categorical(strings: pd.Series, positions: np.ndarray, dtype_backend: str) -> pd.Categorical:
+  # codes of the lookup rows, taken per record; categories come out sorted
+  # so the codes order like the strings would
+  row_codes, categories = pd.factorize(strings.astype(object), sort=True)
+  codes = np.where(positions >= 0, row_codes[positions], -1)
+  if dtype_backend == "pyarrow":
+    categories = pd.Index(categories).astype(pd.StringDtype("pyarrow"))
+  return pd.Categorical.from_codes(codes, categories=pd.Index(categories)).remove_unused_categories()
+
+
+def flat_variable_names(parts: pd.DataFrame) -> pd.Series:
+  # Flat table column names, from question_type and the parts stored for the
+  # question (variable_name), its sub question and its option (sub_prefix,
+  # option_prefix). Same as VARIABLE_NAME_EXPR.
+  question_type = parts["question_type"]
+  singleton     = question_type.isin(alchemy_types.SINGLETON_QUESTIONS)
+  multi         = question_type.isin(alchemy_types.MULTI_QUESTIONS)
+  two_layer     = question_type.isin(alchemy_types.TWO_LAYER_QUESTIONS)
+
+  names = pd.Series("", index=parts.index, dtype=object)
+  names[singleton] = parts.loc[singleton, "variable_name"]
+  names[multi]     = parts.loc[multi, "option_prefix"] + "_" + parts.loc[multi, "variable_name"]
+  names[two_layer] = parts.loc[two_layer, "sub_prefix"] + "_" + parts.loc[two_layer, "variable_name"]
+  return names
+
+
+def _variable_name_categorical(questions: pd.DataFrame, options: pd.DataFrame, question_pos: np.ndarray,
+                               sub_pos: np.ndarray, option_pos: np.ndarray, dtype_backend: str) -> pd.Categorical:
+  # Names are put together once per question / sub question / option
+  # combination and handed out to the records by code.
+  combos = (question_pos * (len(questions) + 1) + sub_pos + 1) * (len(options) + 1) + option_pos + 1
+  _, first, codes = np.unique(combos, return_index=True, return_inverse=True)
+  parts = pd.DataFrame({"question_type": _take(questions["question_type"], question_pos[first], np.int8),
+                        "variable_name": _take_text(questions["variable_name"], question_pos[first]),
+                        "sub_prefix":    _take_text(questions["variable_prefix"], sub_pos[first]),
+                        "option_prefix": _take_text(options["variable_prefix"], option_pos[first])})
+  return _categorical(flat_variable_names(parts), codes.reshape(-1), dtype_backend)
+
+
+def _variable_names(conn: sqlite3.Connection, keys: pd.DataFrame, dtype_backend: str) -> pd.Categorical:
+  question_ids = pd.concat([keys["question_id"], keys["sub_question_id"]]).dropna().unique()
+  questions    = _lookup(conn, GET_QUESTION_LOOKUP, question_ids).sort_values("id", ignore_index=True)
+  options      = _lookup(conn, GET_OPTION_LOOKUP, keys["option_id"].dropna().unique()).sort_values("id", ignore_index=True)
+  question_ids = questions["id"].to_numpy(np.float64)
+  return _variable_name_categorical(questions, options,
+                                    _positions(question_ids, keys["question_id"]),
+                                    _positions(question_ids, keys["sub_question_id"]),
+                                    _positions(options["id"].to_numpy(np.float64), keys["option_id"]),
+                                    dtype_backend)
+
+
+def _categorical_records(conn: sqlite3.Connection, keys: pd.DataFrame, columns: List[str],
+                         dtype_backend: str) -> pd.DataFrame:
+  # Builds records out of integer keys (KEY_COLUMNS plus either value_id or
+  # the answer text) and small lookups of just the ids they use, with every
+  # text column a Categorical. Matches the joined records row for row.
+  question_ids = pd.concat([keys["question_id"], keys["sub_question_id"]]).dropna().unique()
+  questions    = _lookup(conn, GET_QUESTION_LOOKUP, question_ids).sort_values("id", ignore_index=True)
+  question_pos = _positions(questions["id"].to_numpy(np.float64), keys["question_id"])
+  # records without a known question are dropped, as by the inner join
+  keys         = keys.loc[question_pos >= 0].reset_index(drop=True)
+  question_pos = question_pos[question_pos >= 0]
+  question     = _categorical(questions["question"], question_pos, dtype_backend)
+
+  order = np.lexsort((question.codes, keys["response_id"].to_numpy(), keys["survey_id"].to_numpy()))
+  keys, question_pos, question = keys.take(order).reset_index(drop=True), question_pos[order], question.take(order)
+
+  records = {"survey_id": keys["survey_id"].astype(np.int32), "response_id": keys["response_id"].astype(np.int32),
+             "question":  question}
+  if "question_type" in columns:
+    records["question_type"] = _take(questions["question_type"], question_pos, np.int8)
+  if "subquestion" in columns or "variable_name" in columns:
+    sub_pos = _positions(questions["id"].to_numpy(np.float64), keys["sub_question_id"])
+    records["subquestion"] = _categorical(questions["subquestion"], sub_pos, dtype_backend)
+  if "option" in columns or "option_order" in columns or "variable_name" in columns:
+    options    = _lookup(conn, GET_OPTION_LOOKUP, keys["option_id"].dropna().unique()).sort_values("id", ignore_index=True)
+    option_pos = _positions(options["id"].to_numpy(np.float64), keys["option_id"])
+    records["option"]       = _categorical(options["option"], option_pos, dtype_backend)
+    records["option_order"] = _take(options["option_order"], option_pos, np.float64)
+  if "variable_name" in columns:
+    records["variable_name"] = _variable_name_categorical(questions, options, question_pos, sub_pos, option_pos,
+                                                          dtype_backend)
+  if "value_id" in keys:
+    if "answer" in columns or "answer_number" in columns:
+      values    = _lookup(conn, GET_VALUE_LOOKUP, keys["value_id"].dropna().unique()).sort_values("id", ignore_index=True)
+      value_pos = _positions(values["id"].to_numpy(np.float64), keys["value_id"])
+      records["answer"]        = _categorical(values["value"], value_pos, dtype_backend)
+      records["answer_number"] = _take(values["number"], value_pos, np.float64)
+  else:
+    if "answer" in columns:
+      records["answer"] = _categorical(keys["answer"], np.arange(len(keys)), dtype_backend)
+    if "answer_number" in columns:
+      records["answer_number"] = keys["answer_number"].to_numpy(np.float64)
+  for column in ["question_id", "sub_question_id", "option_id"]:
+    records[column] = keys[column]
+  return pd.DataFrame({column: records[column] for column in columns})
+
+
+class SQLiteStorage():
+  # Default storage: every record is joined out of the row-oriented sqlite db.
+  def __init__(self, conn: sqlite3.Connection, dtype_backend: str = "numpy"):
+    _check_dtype_backend(dtype_backend)
+    self._conn          = conn
+    self._dtype_backend = dtype_backend
+
+  def read_records(self, survey_ids: Optional[List[int]]=None,
+                   columns: Optional[List[str]]=None,
+                   decode:  bool=True,
+                   categorical: bool=False,
+                   selection: Optional[RecordSelection]=None) -> pd.DataFrame:
+    # With decode=False the answer column comes back as a categorical built
+    # straight from the stored value ids instead of one string per record.
+    # With categorical=True only the integer keys are read and every text
+    # column is decoded in pandas, see _categorical_records. A selection is
+    # compiled into the query's WHERE clause.
+    columns = columns or RECORD_COLUMNS
+    check_selection(selection, categorical)
+    if categorical:
+      query, params = self._keys_query(survey_ids)
+      keys = pd.read_sql_query(query, self._conn, params=params, dtype=ANSWER_KEYS_DTYPES)
+      return _categorical_records(self._conn, keys, columns, self._dtype_backend)
+    query, params = self._records_query(survey_ids, columns, decode, selection)
+    records = pd.read_sql_query(query, self._conn, params=params,
+                                dtype=_records_dtypes(columns, decode, self._dtype_backend))
+    if not decode and "answer" in columns:
+      records["answer"] = _answer_categorical(self._conn, records["answer"])
+    return records
+
+  def iter_records(self, survey_ids: Optional[List[int]]=None,
+                   columns:   Optional[List[str]]=None,
+                   decode:    bool=True,
+                   chunksize: int=DEFAULT_CHUNKSIZE,
+                   by:        Literal["response", "survey"]="response",
+                   categorical: bool=False,
+                   selection: Optional[RecordSelection]=None) -> Iterator[pd.DataFrame]:
+    # Streams the ordered query `chunksize` rows at a time. Undecoded answers
+    # and categorical columns get their categories per chunk, so they can
+    # differ between chunks.
+    columns = columns or RECORD_COLUMNS
+    keys    = CHUNK_KEYS[by]
+    check_selection(selection, categorical)
+    if categorical:
+      query, params = self._keys_query(survey_ids)
+      chunks = pd.read_sql_query(query, self._conn, params=params, chunksize=chunksize, dtype=ANSWER_KEYS_DTYPES)
+      for chunk in _whole_groups(chunks, keys):
+        yield _categorical_records(self._conn, chunk, columns, self._dtype_backend)
+      return
+    read_columns  = list(dict.fromkeys(keys + columns))
+    query, params = self._records_query(survey_ids, read_columns, decode, selection)
+    chunks = pd.read_sql_query(query, self._conn, params=params, chunksize=chunksize,
+                               dtype=_records_dtypes(read_columns, decode, self._dtype_backend))
+    for chunk in _whole_groups(chunks, keys):
+      if not decode and "answer" in columns:
+        chunk["answer"] = _answer_categorical(self._conn, chunk["answer"])
+      yield chunk[columns]
+
+  def _records_query(self, survey_ids: Optional[List[int]], columns: List[str],
+                     decode: bool, selection: Optional[RecordSelection]=None) -> Tuple[str, List[Any]]:
+    survey_clause, params = self._survey_clause(survey_ids)
+    clauses = [survey_clause] if survey_clause else []
+    if selection is not None:
+      selection_clauses, selection_params = _selection_sql(selection, survey_clause, params)
+      clauses += selection_clauses
+      params   = params + selection_params
+    where  = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    exprs  = [ANSWER_CODE_EXPR if c == "answer" and not decode else RECORD_COLUMN_EXPRS[c] for c in columns]
+    values = JOIN_ANSWER_VALUES if any(e.startswith("v.") for e in exprs) else ""
+    return GET_RECORDS.format(columns=',\n    '.join(exprs), values=values, where=where), params
+
+  def _keys_query(self, survey_ids: Optional[List[int]]) -> Tuple[str, List[int]]:
+    where, params = self._survey_filter(survey_ids)
+    return GET_ANSWER_KEYS.format(where=where), params
+
+  def _survey_filter(self, survey_ids: Optional[List[int]]) -> Tuple[str, List[int]]:
+    clause, params = self._survey_clause(survey_ids)
+    return (f"WHERE {clause}" if clause else ""), params
+
+  def _survey_clause(self, survey_ids: Optional[List[int]]) -> Tuple[str, List[int]]:
+    if not survey_ids:
+      return "", []
+    return f"a.survey_id IN ({_placeholders(survey_ids)})", list(survey_ids)
+
+
+class ParquetStorage():
+  # Keeps the answer fact table as parquet, one partition per survey under
+  # `root/survey_id=<id>/`, while the small question and option dimension
+  # tables stay in sqlite. Reads only touch the partitions and columns a
+  # request needs; partitions are (re)written from sqlite by write_survey,
+  # in response order, so iter_records can stream them a row group at a time.
+  def __init__(self, conn: sqlite3.Connection, root: str, dtype_backend: str = "numpy"):
+    try:
+      import pyarrow # noqa: F401
+    except ImportError as e:
+      raise ImportError("ParquetStorage requires pyarrow, install it with `pip install alchemy[parquet]`") from e
+    _check_dtype_backend(dtype_backend)
+    self._conn          = conn
+    self._dtype_backend = dtype_backend
+    self.root           = root
+
+  def partition_path(self, survey_id: int) -> str:
+    return os.path.join(self.root, f"survey_id={survey_id}", "answers.parquet")
+
+  def survey_ids(self) -> List[int]:
+    if not os.path.isdir(self.root):
+      return []
+    return sorted(int(name.split("=", 1)[1]) for name in os.listdir(self.root)
+                  if name.startswith("survey_id=") and os.path.exists(os.path.join(self.root, name, "answers.parquet")))
+
+  def write_survey(self, survey_id: int) -> int:
+    answers = pd.read_sql_query(GET_SURVEY_ANSWERS, self._conn, params=[int(survey_id)],
+                                dtype={"survey_id": np.int32, "response_id": np.int32,
+                                       "question_id": np.int64, "sub_question_id": np.int64,
+                                       "option_id": np.int64, "answer": object,
+                                       "answer_number": np.float64})
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    path = self.partition_path(int(survey_id))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    table    = pa.Table.from_pandas(answers, preserve_index=False)
+    # the order is declared in the file, see _response_ordered
+    pq.write_table(table, tmp_path, row_group_size=PARTITION_ROW_GROUP_SIZE,
+                   sorting_columns=pq.SortingColumn.from_ordering(table.schema, [("response_id", "ascending")]))
+    os.replace(tmp_path, path)
+    return len(answers)
+
+  def read_records(self, survey_ids: Optional[List[int]]=None,
+                   columns: Optional[List[str]]=None,
+                   decode:  bool=True,
+                   categorical: bool=False,
+                   selection: Optional[RecordSelection]=None) -> pd.DataFrame:
+    # A selection's question ids are pushed into the parquet reads as a row
+    # filter; the exact answers and the response filters are then applied to
+    # the records.
+    columns = columns or RECORD_COLUMNS
+    check_selection(selection, categorical)
+    if selection is None:
+      return self._read_records(survey_ids, columns, decode, categorical)
+    records = self._read_records(survey_ids, _selection_columns(columns), decode, categorical,
+                                 _selection_question_ids(selection))
+    return self._select(records, selection, self._passed_responses(survey_ids, selection))[columns]
+
+  def _passed_responses(self, survey_ids: Optional[List[int]], selection: RecordSelection) -> List[pd.MultiIndex]:
+    # The (survey_id, response_id) passing each of the selection's filters
+    passed = []
+    for response_filter in selection.responses:
+      answers = self.read_records(survey_ids, ["survey_id", "response_id", "question", "variable_name",
+                                               "answer", "answer_number"],
+                                  selection=RecordSelection(response_filter.answers))
+      passed.append(pd.MultiIndex.from_frame(answers.loc[_passes(answers, response_filter),
+                                                         ["survey_id", "response_id"]]))
+    return passed
+
+  def _select(self, records: pd.DataFrame, selection: RecordSelection, passed: List[pd.MultiIndex]) -> pd.DataFrame:
+    keep = np.ones(len(records), dtype=bool)
+    if selection.answers is not None:
+      keep &= _matches(records, selection.answers)
+    for responses in passed:
+      keep &= pd.MultiIndex.from_frame(records[["survey_id", "response_id"]]).isin(responses)
+    return records.loc[keep].reset_index(drop=True)
+
+  def _read_records(self, survey_ids: Optional[List[int]], columns: List[str], decode: bool,
+                    categorical: bool, question_ids: Optional[List[int]]=None) -> pd.DataFrame:
+    survey_ids = [survey_id for survey_id in (survey_ids or self.survey_ids())
+                  if os.path.exists(self.partition_path(survey_id))]
+    if not survey_ids:
+      dtypes = _records_dtypes(columns, decode, self._dtype_backend)
+      return pd.DataFrame({c: pd.Series(dtype=dtypes.get(c, object)) for c in columns})
+    # -1 stands in for an empty id list, which pyarrow will not take
+    filters = None if question_ids is None else [("question_id", "in", list(question_ids) or [-1])]
+    answers = pd.concat([pd.read_parquet(self.partition_path(survey_id), columns=_source_columns(columns, categorical),
+                                         filters=filters)
+                         for survey_id in survey_ids], ignore_index=True)
+    return self._decode(answers, columns, decode, categorical)
+
+  def _decode(self, answers: pd.DataFrame, columns: List[str], decode: bool, categorical: bool) -> pd.DataFrame:
+    # Partition rows to records: question, option and name text attached
+    # from sqlite, ordered by survey, response and question
+    if categorical:
+      # partitions are only in response order, put them in key order
+      answers = answers.sort_values(KEY_COLUMNS, kind="stable", ignore_index=True)
+      return _categorical_records(self._conn, answers, columns, self._dtype_backend)
+
+    questions = _lookup(self._conn, GET_QUESTION_LOOKUP, answers["question_id"].unique())
+    records   = answers.merge(questions[["id", "question", "question_type"]],
+                              how="inner", left_on="question_id", right_on="id")
+    if "subquestion" in columns:
+      sub_questions = _lookup(self._conn, GET_QUESTION_LOOKUP, records["sub_question_id"].unique())
+      records = records.merge(sub_questions[["id", "subquestion"]], how="left",
+                              left_on="sub_question_id", right_on="id", suffixes=("", "_sub"))
+    if "option" in columns or "option_order" in columns:
+      options = _lookup(self._conn, GET_OPTION_LOOKUP, records["option_id"].unique())
+      records = records.merge(options, how="left", left_on="option_id", right_on="id", suffixes=("", "_option"))
+
+    records = records.sort_values(["survey_id", "response_id", "question"], kind="stable", ignore_index=True)
+    if "variable_name" in columns:
+      records["variable_name"] = _variable_names(self._conn, records, self._dtype_backend)
+    records = records[columns].astype(_records_dtypes(columns, decode, self._dtype_backend))
+    if not decode and "answer" in columns:
+      records["answer"] = pd.Categorical(records["answer"].astype(object))
+    return records
+
+  def iter_records(self, survey_ids: Optional[List[int]]=None,
+                   columns:   Optional[List[str]]=None,
+                   decode:    bool=True,
+                   chunksize: int=DEFAULT_CHUNKSIZE,
+                   by:        Literal["response", "survey"]="response",
+                   categorical: bool=False,
+                   selection: Optional[RecordSelection]=None) -> Iterator[pd.DataFrame]:
+    # Surveys in id order, as sqlite gives them. A partition is read in
+    # batches of `chunksize` rows, re-cut into whole responses and decoded
+    # one chunk at a time, so memory is bounded per chunk (with by="survey",
+    # per survey). As with SQLiteStorage, categorical columns get their
+    # categories per chunk.
+    columns = columns or RECORD_COLUMNS
+    keys    = CHUNK_KEYS[by]
+    check_selection(selection, categorical)
+    read_columns = list(dict.fromkeys(keys + columns))
+    if selection is not None:
+      read_columns = _selection_columns(read_columns)
+    for survey_id in sorted(set(survey_ids or self.survey_ids())):
+      if not os.path.exists(self.partition_path(survey_id)):
+        continue
+      passed  = self._passed_responses([survey_id], selection) if selection is not None else []
+      batches = self._answer_batches(survey_id, _source_columns(read_columns, categorical), chunksize,
+                                     _selection_question_ids(selection))
+      for answers in _whole_groups(batches, keys):
+        records = self._decode(answers, read_columns, decode, categorical)
+        if selection is not None:
+          records = self._select(records, selection, passed)
+        if len(records):
+          yield records[columns]
+
+  def _answer_batches(self, survey_id: int, source_columns: List[str], chunksize: int,
+                      question_ids: Optional[List[int]]=None) -> Iterator[pd.DataFrame]:
+    import pyarrow.parquet as pq
+    partition = pq.ParquetFile(self.partition_path(survey_id))
+    if not _response_ordered(partition):
+      # written before partitions were kept in response order: read whole
+      answers = pd.read_parquet(self.partition_path(survey_id), columns=source_columns)
+      answers = answers.sort_values("response_id", kind="stable", ignore_index=True)
+      batches = (answers.iloc[i:i + chunksize] for i in range(0, len(answers), chunksize))
+    else:
+      batches = (batch.to_pandas() for batch in partition.iter_batches(batch_size=chunksize, columns=source_columns))
+    for batch in batches:
+      if question_ids is not None:
+        batch = batch.loc[batch["question_id"].isin(question_ids)]
+      yield batch
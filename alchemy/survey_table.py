@@ -0,0 +1,103 @@
+from typing import Any, List, Literal, Optional, Tuple, Union
+
+import pandas as pd
+
+from . import alchemy_types
+from .storage import AnswerMatch, RecordSelection, ResponseFilter, check_selection
+
+# Questions a name could refer to: by shortname, or by the variable_name a
+# flat column name is made of (the whole name, or what follows a "_"). With
+# survey ids, only questions of those surveys.
+GET_NAMED_QUESTIONS = '''
+  SELECT DISTINCT q.id, q.shortname, q.variable_name, q.question_type
+    FROM question as q
+    {surveys}
+   WHERE q.shortname IN ({names}) OR q.variable_name IN ({suffixes});'''
+
+IN_SURVEYS = '''INNER JOIN survey_x_question as sq
+       ON sq.question_id = q.id AND sq.survey_id IN ({survey_ids})'''
+
+PREFIXED_QUESTIONS = alchemy_types.MULTI_QUESTIONS + alchemy_types.TWO_LAYER_QUESTIONS
+
+
+class SurveyTable():
+  # get_table put off until collect(). select and filter return a new
+  # SurveyTable narrowed further, and collect compiles them into the records
+  # query: the selected questions as `question_id IN (...)` and each filter
+  # as a semijoin on the responses passing it, so only the answers the table
+  # needs are read. Columns and filters name questions by shortname or flat
+  # variable name.
+  def __init__(self, alchemy, survey_ids: Optional[Union[int, List[int]]]=None,
+               column_mode: Optional[Literal["flat", "multi"]]="flat",
+               columns: Tuple[str, ...]=(), filters: Tuple[Tuple[str, str, Any], ...]=()):
+    self._alchemy    = alchemy
+    self.survey_ids  = survey_ids
+    self.column_mode = column_mode
+    self.columns     = columns
+    self.filters     = filters
+
+  def select(self, *names: Union[str, List[str]]) -> "SurveyTable":
+    # The table's columns: every column of a question named by shortname,
+    # the one column named by a variable name. Replaces an earlier select.
+    columns = tuple(name for arg in names for name in ([arg] if isinstance(arg, str) else arg))
+    if not columns:
+      raise ValueError("select expects at least one shortname or variable name")
+    return SurveyTable(self._alchemy, self.survey_ids, self.column_mode, columns, self.filters)
+
+  def filter(self, name: str, op: str, value: Any) -> "SurveyTable":
+    # Keeps the responses with an answer to `name` comparing `op` to `value`,
+    # e.g. filter("Age", ">=", 18) or filter("Region", "in", ["East", "West"]).
+    # Filters add up.
+    check_selection(RecordSelection(responses=(ResponseFilter(AnswerMatch([], [], []), op, value),)), False)
+    return SurveyTable(self._alchemy, self.survey_ids, self.column_mode, self.columns,
+                       self.filters + ((name, op, value),))
+
+  def selection(self) -> RecordSelection:
+    # The select and filters, resolved against the questions in the db now
+    answers   = self._match(self.columns) if self.columns else None
+    responses = tuple(ResponseFilter(self._match((name,)), op, value) for name, op, value in self.filters)
+    return RecordSelection(answers, responses)
+
+  def collect(self, chunksize: Optional[int]=None, workers: Optional[int]=None,
+              executor: Literal["thread", "process"]="thread", sparse: bool=False) -> pd.DataFrame:
+    # Reads and pivots just the selected answers, see Alchemy.get_table for
+    # the arguments
+    with self._alchemy._reading():
+      return self._alchemy._get_table(self.survey_ids, self.column_mode, chunksize, workers, executor,
+                                      self.selection(), sparse)
+
+  async def acollect(self, chunksize: Optional[int]=None, workers: Optional[int]=None,
+                     executor: Literal["thread", "process"]="thread", sparse: bool=False) -> pd.DataFrame:
+    return await self._alchemy._run_async(self.collect, chunksize, workers, executor, sparse)
+
+  def _match(self, names: Tuple[str, ...]) -> AnswerMatch:
+    suffixes   = sorted({name[i + 1:] for name in names for i, c in enumerate(name) if c == "_"} | set(names))
+    survey_ids = self._alchemy._survey_id_list(self.survey_ids) or []
+    surveys    = IN_SURVEYS.format(survey_ids=','.join(['?'] * len(survey_ids))) if survey_ids else ""
+    query      = GET_NAMED_QUESTIONS.format(surveys=surveys, names=','.join(['?'] * len(names)),
+                                            suffixes=','.join(['?'] * len(suffixes)))
+    questions  = self._alchemy._conn.execute(query, survey_ids + list(names) + suffixes).fetchall()
+    question_ids, shortnames, variable_names = set(), set(), set()
+    for question_id, shortname, variable_name, question_type in questions:
+      for name in names:
+        if name == shortname:
+          question_ids.add(question_id)
+          shortnames.add(name)
+        if not variable_name:
+          continue
+        if question_type in PREFIXED_QUESTIONS:
+          named = name.endswith(f"_{variable_name}")
+        else:
+          named = name == variable_name
+        if named:
+          question_ids.add(question_id)
+          variable_names.add(name)
+    unknown = [name for name in names if name not in shortnames and name not in variable_names]
+    if unknown:
+      surveys = f" in surveys {survey_ids}" if survey_ids else ""
+      raise ValueError(f"no question{surveys} has the shortname or variable name {unknown}")
+    return AnswerMatch(sorted(question_ids), sorted(shortnames), sorted(variable_names))
+
+  def __repr__(self) -> str:
+    return (f"SurveyTable(survey_ids={self.survey_ids!r}, column_mode={self.column_mode!r}, "
+            f"columns={list(self.columns)!r}, filters={list(self.filters)!r})")
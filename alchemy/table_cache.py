@@ -0,0 +1,151 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+from typing import List, NamedTuple, Optional
+
+import pandas as pd
+
+# Default bound on the disk space cached tables may take up
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Bump when the cached tables change shape, so older entries are never read
+CACHE_FORMAT = 1
+
+GET_DATA_VERSIONS = '''
+  SELECT s.id, COALESCE(ss.data_version, 0)
+    FROM survey as s
+    LEFT JOIN sync_state as ss ON ss.survey_id = s.id
+  {where}
+   ORDER BY s.id;'''
+
+
+class CacheKey(NamedTuple):
+  # `table` names what was asked for, `version` the data it was built from
+  table:   str
+  version: str
+
+
+def _digest(value) -> str:
+  return hashlib.sha1(repr(value).encode()).hexdigest()[:16]
+
+
+class TableCache():
+  # Finished get_table results on disk under `root`, one file per surveys /
+  # column_mode / dtype_backend, tagged with the data_version each of those
+  # surveys had when it was built. Every committed load that changes a survey
+  # bumps its data_version, so a table from before the load is never handed
+  # back, and it is deleted once its replacement is written. Files not read
+  # for the longest are evicted whenever the cache grows past `max_bytes`.
+  # Flat tables are kept as parquet when pyarrow is installed; multi and
+  # sparse tables (MultiIndex columns, nullable_category and sparse dtypes,
+  # which parquet cannot round trip) are pickled, so only point `root` at a
+  # trusted directory.
+  def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES):
+    if max_bytes < 0:
+      raise ValueError(f"max_bytes must not be negative, got {max_bytes}")
+    self.root      = root
+    self.max_bytes = max_bytes
+    os.makedirs(root, exist_ok=True)
+
+  def key(self, conn: sqlite3.Connection, survey_ids: Optional[List[int]],
+          column_mode: str, dtype_backend: str, selection=None, sparse: bool = False) -> CacheKey:
+    # Read before the table is built: should a load commit in between, the
+    # table is newer than its key and is simply rebuilt on the next call.
+    where, params = "", []
+    if survey_ids:
+      where  = f" WHERE s.id IN ({','.join(['?'] * len(survey_ids))})"
+      params = [int(survey_id) for survey_id in survey_ids]
+    versions = conn.execute(GET_DATA_VERSIONS.format(where=where), params).fetchall()
+    table    = (CACHE_FORMAT, sorted(params) or "all", column_mode, dtype_backend)
+    if selection is not None:
+      # a narrowed table (see SurveyTable) is cached apart from the full one
+      table += (selection,)
+    if sparse:
+      table += ("sparse",)
+    return CacheKey(_digest(table), _digest(versions))
+
+  def get(self, key: CacheKey) -> Optional[pd.DataFrame]:
+    for path in self._paths(key):
+      if not os.path.exists(path):
+        continue
+      try:
+        table = self._read(path)
+      except Exception:
+        # half written by a crashed process or from an incompatible pandas
+        self._remove(path)
+        return None
+      os.utime(path) # mtime marks the last read, for eviction
+      return table
+    return None
+
+  def put(self, key: CacheKey, table: pd.DataFrame):
+    parquet_path, pickle_path = self._paths(key)
+    path     = parquet_path if self._parquet(table) else pickle_path
+    # unique per writer, for threads (or processes) building the same table
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    if path == parquet_path:
+      table.to_parquet(tmp_path)
+    else:
+      with open(tmp_path, "wb") as f:
+        pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    for entry in self._entries():
+      stale = os.path.basename(entry).startswith(f"{key.table}-") and entry != path
+      if stale:
+        self._remove(entry)
+    self._evict()
+
+  def clear(self):
+    for name in os.listdir(self.root):
+      self._remove(os.path.join(self.root, name))
+
+  def size(self) -> int:
+    return sum(os.path.getsize(path) for path in self._entries())
+
+  def _paths(self, key: CacheKey) -> List[str]:
+    name = os.path.join(self.root, f"{key.table}-{key.version}")
+    return [f"{name}.parquet", f"{name}.pkl"]
+
+  def _entries(self) -> List[str]:
+    return [os.path.join(self.root, name) for name in os.listdir(self.root)
+            if name.endswith((".parquet", ".pkl"))]
+
+  def _evict(self):
+    entries = []
+    for path in self._entries():
+      try:
+        stat = os.stat(path)
+      except FileNotFoundError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      self._remove(path)
+      total -= size
+
+  def _parquet(self, table: pd.DataFrame) -> bool:
+    if isinstance(table.columns, pd.MultiIndex):
+      return False
+    if any(isinstance(dtype, pd.SparseDtype) for dtype in table.dtypes):
+      return False
+    try:
+      import pyarrow # noqa: F401
+    except ImportError:
+      return False
+    return True
+
+  def _read(self, path: str) -> pd.DataFrame:
+    if path.endswith(".parquet"):
+      return pd.read_parquet(path)
+    with open(path, "rb") as f:
+      return pickle.load(f)
+
+  def _remove(self, path: str):
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
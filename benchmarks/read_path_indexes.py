@@ -0,0 +1,94 @@
+# Builds a synthetic answer table at schema version 3 (before the read path
+# indexes), then shows the get_records query plan and timing before and after
+# migrating it to the latest version.
+#
+#   python benchmarks/read_path_indexes.py --answers 3000000
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from alchemy.migrations import configure_connection, migrate
+from alchemy.storage import GET_RECORDS, RECORD_COLUMN_EXPRS, RECORD_COLUMNS, SQLiteStorage
+
+QUESTIONS_PER_SURVEY = 50
+OPTIONS_PER_QUESTION = 5
+
+
+def build(path: str, surveys: int, answers: int, seed: int):
+  rng = random.Random(seed)
+  con = sqlite3.connect(path)
+  migrate(con, target=3)
+  responses = answers // (surveys * QUESTIONS_PER_SURVEY)
+  con.execute("BEGIN;")
+  con.executemany("INSERT INTO survey (id, title) VALUES (?, ?);",
+                  [(s, f"survey {s}") for s in range(1, surveys + 1)])
+  con.executemany("INSERT INTO question (id, base_type, question_type, title, shortname) VALUES (?, 1, 1, ?, ?);",
+                  [(q, f"question {q}", f"q{q}") for q in range(1, surveys * QUESTIONS_PER_SURVEY + 1)])
+  con.executemany("INSERT INTO option (id, value, option_order, question_id) VALUES (?, ?, ?, ?);",
+                  [(q * OPTIONS_PER_QUESTION + o, f"option {o}", o, q)
+                   for q in range(1, surveys * QUESTIONS_PER_SURVEY + 1) for o in range(OPTIONS_PER_QUESTION)])
+  con.executemany("INSERT INTO survey_x_question (survey_id, question_id) VALUES (?, ?);",
+                  [(s, (s - 1) * QUESTIONS_PER_SURVEY + q) for s in range(1, surveys + 1)
+                                                          for q in range(1, QUESTIONS_PER_SURVEY + 1)])
+  con.executemany("INSERT INTO response (id, survey_id) VALUES (?, ?);",
+                  [(r, s) for s in range(1, surveys + 1) for r in range(1, responses + 1)])
+  # answers arrive interleaved across surveys, the way parallel loads write them
+  rows = [(q, 0, q * OPTIONS_PER_QUESTION + rng.randrange(OPTIONS_PER_QUESTION), r, s, str(rng.random()))
+          for r in range(1, responses + 1)
+          for s in range(1, surveys + 1)
+          for q in range((s - 1) * QUESTIONS_PER_SURVEY + 1, s * QUESTIONS_PER_SURVEY + 1)]
+  con.executemany("INSERT INTO answer (question_id, sub_question_id, option_id, response_id, survey_id, answer) "
+                  "VALUES (?, ?, ?, ?, ?, ?);", rows)
+  con.commit()
+  con.close()
+  return len(rows)
+
+
+def version_3_query(survey_id: int) -> Tuple[str, List[int]]:
+  # get_records as it read before answers were moved to answer_value: the
+  # text is still on the answer row
+  exprs = ["a.answer     as answer" if c == "answer" else RECORD_COLUMN_EXPRS[c] for c in RECORD_COLUMNS]
+  return GET_RECORDS.format(columns=',\n    '.join(exprs), values="", where="WHERE a.survey_id IN (?)"), [survey_id]
+
+
+def latest_query(con: sqlite3.Connection, survey_id: int) -> Tuple[str, List[int]]:
+  return SQLiteStorage(con)._records_query([survey_id], RECORD_COLUMNS, decode=True)
+
+
+def report(con: sqlite3.Connection, query: str, params: List[int], label: str):
+  print(f"\n{label}")
+  for row in con.execute(f"EXPLAIN QUERY PLAN {query}", params):
+    print(f"  {row[3]}")
+  start = time.perf_counter()
+  n = len(con.execute(query, params).fetchall())
+  print(f"  {n} records in {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare get_records query plans before and after the read path indexes.")
+  parser.add_argument("--answers", type=int, default=2_000_000)
+  parser.add_argument("--surveys", type=int, default=20)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--db", type=str, default=None, help="where to build the database, a temp file by default")
+  args = parser.parse_args()
+
+  path = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+  start = time.perf_counter()
+  n = build(path, args.surveys, args.answers, args.seed)
+  print(f"built {n} answers across {args.surveys} surveys in {time.perf_counter() - start:.1f}s ({path})")
+
+  survey_id = args.surveys // 2 or 1
+  con = configure_connection(sqlite3.connect(path))
+  report(con, *version_3_query(survey_id), "schema version 3")
+  start = time.perf_counter()
+  migrate(con)
+  print(f"\nmigrated to the latest schema in {time.perf_counter() - start:.1f}s")
+  report(con, *latest_query(con, survey_id), "latest schema")
+  con.close()
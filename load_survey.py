@@ -1,12 +1,27 @@
 import argparse
 import os
-from typing import Any, Optional, Tuple
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import chain
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 import json
+import queue
+import re
+import threading
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
 import sqlite3
 import logging
 from alchemy.alchemy_types import *
+from alchemy.question_index import QuestionIndex
+from alchemy.instrumentation import NO_INSTRUMENTATION, Instrumentation
+from alchemy.migrations import answer_number, configure_connection, migrate, variable_name, variable_prefix
+from alchemy.replay import FixtureRecorder, FixtureStore, ReplayAdapter, Throttle
+from alchemy.scheduler import DEFAULT_RATE_LIMIT, RequestScheduler
+from alchemy.storage import ParquetStorage
 
 
 SURVEY_STATIC_CHECK = """
@@ -30,24 +45,37 @@ INSERT OR IGNORE INTO
 
 
 
+# Takes the positional AnswerRow tuples produced by parse_answer_page; the
+# answer itself is stored as the id of its interned answer_value row.
 ANSWER_INSERT_STMT = """
 INSERT INTO
-  answer(question_id,  sub_question_id,  option_id,  response_id,  survey_id,  answer)
-  VALUES(:question_id, :sub_question_id, :option_id, :response_id, :survey_id, :answer);
+  answer(question_id, sub_question_id, option_id, response_id, survey_id, value_id)
+  VALUES(?,           ?,               ?,         ?,           ?,
+         (SELECT id FROM answer_value WHERE value = ?));
 """
 
-# Test query, should alter 0 rows
+ANSWER_VALUE_INSERT_STMT = """
+INSERT OR IGNORE INTO
+  answer_value (value, number)
+  VALUES       (?,     ?);
+"""
+
+# Test query, should alter 0 rows. A renamed question takes the flat
+# column name derived from its new shortname along with it.
 QUESTION_STATIC_CHECK = """
   UPDATE question
-     SET shortname  = :shortname
+     SET shortname     = :shortname,
+         variable_name = :variable_name
    WHERE id         = :id
      AND shortname != :shortname
 """
 
 QUESTION_INSERT_STMT = """
-INSERT OR IGNORE INTO 
-  question (id,  title,  base_type,  question_type, shortname)
-  VALUES   (:id, :title, :base_type, :type,         :shortname);
+INSERT INTO 
+  question (id,  title,  base_type,  question_type, shortname,  parent_id,  variable_name,  variable_prefix)
+  VALUES   (:id, :title, :base_type, :type,         :shortname, :parent_id, :variable_name, :variable_prefix)
+  ON CONFLICT (id) DO UPDATE SET parent_id = excluded.parent_id 
+                           WHERE parent_id IS NULL;
 """
 
 SURVEY_X_QUESTION_INSERT_STMT = """
@@ -58,17 +86,63 @@ INSERT OR IGNORE INTO
 
 OPTION_STATIC_CHECK = """
 UPDATE  option
-   SET  value =  :value
+   SET  value           =  :value,
+        variable_prefix =  :variable_prefix
  WHERE  id    =  :id
    AND  value != :value;
 """
 
 OPTIONS_INSERT_STMT = """
-INSERT OR IGNORE INTO
-  option (id,  value, option_order)
-  VALUES (:id, :value, :option_order);
+INSERT INTO
+  option (id,  value,  option_order,  question_id,  variable_prefix)
+  VALUES (:id, :value, :option_order, :question_id, :variable_prefix)
+  ON CONFLICT (id) DO UPDATE SET question_id = excluded.question_id
+                           WHERE question_id IS NULL;
+"""
+
+ANSWER_DELETE_STMT = """
+DELETE FROM answer
+      WHERE survey_id   = :survey_id
+        AND response_id = :id;
+"""
+
+GET_SYNC_STATE = """
+SELECT high_water_mark
+  FROM sync_state
+ WHERE survey_id = ?;
 """
 
+# Written last in every load. :changed is filled in by apply_writes, 1 when
+# the load wrote or deleted any rows before it and 0 otherwise, so
+# data_version only moves when a committed load changed the survey; cached
+# tables are keyed on it.
+SYNC_STATE_UPSERT_STMT = """
+INSERT INTO
+  sync_state (survey_id,  high_water_mark,  synced_at,  data_version)
+  VALUES     (:survey_id, :high_water_mark, :synced_at, :changed)
+  ON CONFLICT (survey_id) DO UPDATE SET high_water_mark = excluded.high_water_mark,
+                                        synced_at       = excluded.synced_at,
+                                        data_version    = sync_state.data_version + excluded.data_version;
+"""
+
+ALCHEMER_HOST       = "https://api.alchemer.com"
+RESULTS_PER_PAGE    = 100
+DEFAULT_CONCURRENCY = 8
+BULK_BATCH_SIZE     = 5000
+BISECT_MIN_BATCH    = 16
+DEFAULT_WORKERS     = 4  # surveys fetched and parsed at once by load_surveys_parallel
+WRITE_QUEUE_SIZE    = 16 # WriteOps a survey may have waiting for the writer
+WRITER_ABORT_POLL   = 0.1 # seconds a worker waits on a full queue between checks that the writer is alive
+
+# Response fields used to ask alchemer for responses newer than the last sync.
+# Each gets its own filtered pass since alchemer ANDs filters together.
+SYNC_FILTER_FIELDS  = ["date_submitted", "date_updated"]
+
+# Alchemer stamps responses with US eastern wall clock time, "EST" or "EDT".
+# High water marks are kept in UTC so they order correctly across daylight
+# saving changes.
+ALCHEMER_TIME_ZONES = {"EST": timezone(timedelta(hours=-5)), "EDT": timezone(timedelta(hours=-4))}
+
 
 def iter_over(json_data, key: str = None):
   if not key:
@@ -111,57 +185,366 @@ def execute(cursor: sqlite3.Cursor, query: str, params: Any) -> Tuple[int, Optio
   except Exception as e:
     return cursor.rowcount, f"error executing query {query} with params {params}: {str(e)}"
  
+class LoadError(Exception):
+  pass
+
+class BulkWriter():
+  # Buffers rows for one statement and writes them in fixed size batches, so
+  # a stream of rows of any length only ever holds one batch in memory.
+  def __init__(self, cursor: sqlite3.Cursor, query: str, 
+               suppress_output: bool = False, batch_size: int = BULK_BATCH_SIZE):
+    self._cursor          = cursor
+    self._query           = query
+    self._suppress_output = suppress_output
+    self._batch_size      = batch_size
+    self._batch           = []
+    self.rowcount         = 0
+
+  def write(self, rows: Iterable):
+    for row in rows:
+      self._batch.append(row)
+      if len(self._batch) >= self._batch_size:
+        self.flush()
+
+  def flush(self):
+    if self._batch:
+      self.rowcount += _execute_batch(self._cursor, self._query, self._batch, self._suppress_output)
+      self._batch = []
+
 def executemany(cursor: sqlite3.Cursor, query: str, params: Any, suppress_output=False) -> Tuple[int, Optional[str]]:
+  writer = BulkWriter(cursor, query, suppress_output)
+  writer.write(params)
+  writer.flush()
+  return writer.rowcount, None
+
+def _execute_batch(cursor: sqlite3.Cursor, query: str, batch: list, suppress_output: bool) -> int:
+  # Fast path is a single executemany for the whole batch. If any row in it
+  # fails, the batch is rolled back to a savepoint and bisected, so the good
+  # rows still go in as batches and only the bad ones are reported (and
+  # skipped) row by row.
+  if len(batch) <= BISECT_MIN_BATCH:
+    return _execute_rows(cursor, query, batch, suppress_output)
+  cursor.execute("SAVEPOINT bulk_insert;")
+  try:
+    cursor.executemany(query, batch)
+    row_count = cursor.rowcount
+    cursor.execute("RELEASE SAVEPOINT bulk_insert;")
+    return row_count
+  except sqlite3.Error:
+    cursor.execute("ROLLBACK TO SAVEPOINT bulk_insert;")
+    cursor.execute("RELEASE SAVEPOINT bulk_insert;")
+  mid = len(batch) // 2
+  return (_execute_batch(cursor, query, batch[:mid], suppress_output) + 
+          _execute_batch(cursor, query, batch[mid:], suppress_output))
+
+def _execute_rows(cursor: sqlite3.Cursor, query: str, rows: list, suppress_output: bool) -> int:
   row_count = 0
-  for param in params:
+  for row in rows:
     try:
-      cursor.execute(query, param)
+      cursor.execute(query, row)
       row_count += cursor.rowcount
     except Exception as e:
       if not suppress_output:
-        logger.warning(f"error executing query {query} with params {param}: {str(e)}")
-  return row_count, None
+        logger.warning(f"error executing query {query} with params {row}: {str(e)}")
+  return row_count
+
+def make_session(pool_size: int = DEFAULT_CONCURRENCY) -> requests.Session:
+  # One keep-alive pool shared by every request to the api, sized so that
+  # `pool_size` pages can be in flight without opening throwaway connections.
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  return session
+
+def fetch(scheduler: RequestScheduler, path: str, params: Dict[str, Any],
+          metrics: Instrumentation = NO_INSTRUMENTATION, **labels) -> requests.Response:
+  with metrics.stage("http fetch", **labels) as stage:
+    res = scheduler.get(path, params=params)
+    stage.bytes = len(res.content)
+  return res
+
+def fetch_pages(scheduler: RequestScheduler, path: str, params: Dict[str, Any], 
+                pages: Iterable[int], concurrency: int = DEFAULT_CONCURRENCY,
+                metrics: Instrumentation = NO_INSTRUMENTATION) -> Iterator[Tuple[int, requests.Response]]:
+  # Keeps up to `concurrency` requests in flight, but yields the responses
+  # strictly in page order so downstream parsing / inserting is unchanged.
+  executor  = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+  in_flight = deque()
+  try:
+    for page in pages:
+      in_flight.append((page, executor.submit(fetch, scheduler, path, {**params, 'page': page}, metrics, page=page)))
+      if len(in_flight) >= concurrency:
+        page, future = in_flight.popleft()
+        yield page, future.result()
+    while in_flight:
+      page, future = in_flight.popleft()
+      yield page, future.result()
+  finally:
+    executor.shutdown(wait=True, cancel_futures=True)
+
+def iter_response_pages(scheduler: RequestScheduler, path: str, params: Dict[str, Any],
+                        concurrency: int = DEFAULT_CONCURRENCY,
+                        metrics: Instrumentation = NO_INSTRUMENTATION) -> Iterator[Tuple[int, requests.Response]]:
+  res = fetch(scheduler, path, {**params, 'page': 1}, metrics, page=1)
+  yield 1, res
+  if res.status_code != 200:
+    return
+
+  res_data    = res.json()
+  total_pages = res_data["total_pages"]
+  logger.info(f"{total_pages} pages to process")
+  logger.info(f"{res_data['total_count']} responses")
+
+  # page 1 was already fetched for its metadata; the rest are pipelined.
+  yield from fetch_pages(scheduler, path, params, range(2, total_pages + 1), concurrency, metrics)
+
+def sync_filter_params(field: str, since: str) -> Dict[str, str]:
+  # The filter takes a zoneless eastern wall clock time. The mark is given as
+  # standard time, which is never later than its wall clock time and at most
+  # an hour earlier, so responses from the hour repeated when clocks fall back
+  # are still fetched; refetched responses are deleted and reinserted.
+  wall_clock = datetime.fromisoformat(since).astimezone(ALCHEMER_TIME_ZONES["EST"])
+  return {'filter[field][0]':    field,
+          'filter[operator][0]': '>=',
+          'filter[value][0]':    wall_clock.strftime("%Y-%m-%d %H:%M:%S")}
+
+def utc_timestamp(value: str) -> str:
+  # Alchemer's "YYYY-MM-DD HH:MM:SS <TZ>" or a stored mark, in UTC. Marks
+  # stored before they were kept in UTC have no zone and are read as EDT, the
+  # earlier of the two.
+  zone = value[19:].strip()
+  if not zone or zone in ALCHEMER_TIME_ZONES:
+    timestamp = datetime.fromisoformat(value[:19]).replace(tzinfo=ALCHEMER_TIME_ZONES.get(zone, ALCHEMER_TIME_ZONES["EDT"]))
+  elif zone[0] in "+-":
+    timestamp = datetime.fromisoformat(value)
+  else:
+    raise LoadError(f"unknown time zone in timestamp {value!r}")
+  return timestamp.astimezone(timezone.utc).isoformat()
+
+def response_timestamp(value: Optional[str]) -> Optional[str]:
+  return utc_timestamp(value) if value else None
+
+def get_high_water_mark(cursor: sqlite3.Cursor, survey_id: str) -> Optional[str]:
+  row = cursor.execute(GET_SYNC_STATE, (survey_id,)).fetchone()
+  return response_timestamp(row[0]) if row else None
+
+AnswerRow = Tuple[Any, Any, Any, Any, Any, Any]
+
+ANSWER_COLUMNS = ("question_id", "sub_question_id", "option_id", "response_id", "survey_id", "answer")
+
+# How an answer is unpacked into rows, resolved once per question id rather
+# than re-derived from its question type for every answer.
+HIDDEN_ANSWER        = 0
+SINGLE_SELECT_ANSWER = 1
+SINGLE_VALUE_ANSWER  = 2
+MULTI_SELECT_ANSWER  = 3
+MULTI_VALUE_ANSWER   = 4
+TWO_LAYER_ANSWER     = 5
+UNSUPPORTED_ANSWER   = 6
+
+def answer_kind(question_type: QuestionType) -> int:
+  if question_type == QuestionType.HIDDEN:
+    return HIDDEN_ANSWER
+  if question_type in SINGLE_SELECT_QUESTIONS:
+    return SINGLE_SELECT_ANSWER
+  if question_type in SINGLE_VALUE_QUESTION:
+    return SINGLE_VALUE_ANSWER
+  if question_type in MULTI_SELECT_QUESTIONS:
+    return MULTI_SELECT_ANSWER
+  if question_type in MULTI_VALUE_QUESTIONS:
+    return MULTI_VALUE_ANSWER
+  if question_type in TWO_LAYER_QUESTIONS:
+    return TWO_LAYER_ANSWER
+  return UNSUPPORTED_ANSWER
+
+def answer_kinds(question_index: QuestionIndex) -> Dict[int, int]:
+  return {question.id: answer_kind(question.question_type) for question in question_index}
+
+class ParsedPage(NamedTuple):
+  # A page of answers. Rows are built a whole answer kind at a time, as the
+  # tuples executemany consumes; columns() gives the same data column-wise.
+  rows:         List[AnswerRow]
+  null_answers: int
+
+  def columns(self) -> Dict[str, tuple]:
+    columns = zip(*self.rows) if self.rows else [()] * len(ANSWER_COLUMNS)
+    return dict(zip(ANSWER_COLUMNS, columns))
+
+def _bucket_answers(pairs: Iterable[Tuple[Any, Any, Any, dict]], kinds: Dict[int, int], 
+                    allowed: Iterable[int]) -> Dict[int, list]:
+  # Groups (response_id, question_id, sub_question_id, answer) by answer kind in one pass
+  buckets = {kind: [] for kind in allowed}
+  for pair in pairs:
+    answer = pair[3]
+    kind   = kinds.get(answer["id"])
+    if kind is None:
+      kind = kinds.get(int(answer["id"]))
+    if kind is None:
+      raise LoadError(f"No question matching response id {pair[0]}. This shouldn't be possible")
+    if kind not in buckets:
+      raise LoadError(f"Encountered question type we don't know how to handle yet: answer: {answer}")
+    buckets[kind].append(pair)
+  return buckets
+
+def _options(answer: dict) -> Iterable[dict]:
+  options = answer.get("options")
+  return options.values() if type(options) == dict else options if type(options) == list else ()
+
+def _unpack(rows: List[AnswerRow], buckets: Dict[int, list], survey_id: str) -> int:
+  # one comprehension per answer kind over every answer of that kind on the
+  # page. Single select answers without an answer_id are left out; returns
+  # how many.
+  single_select = buckets[SINGLE_SELECT_ANSWER]
+  selected      = [(q, s, a["answer_id"], r, survey_id, "answer" in a)
+                   for r, q, s, a in single_select if a.get("answer_id")]
+  rows += selected
+  rows += [(q, s, 0, r, survey_id, a.get("answer")) for r, q, s, a in buckets[SINGLE_VALUE_ANSWER]]
+  rows += [(q, s, o["id"], r, survey_id, "answer" in o) 
+           for r, q, s, a in buckets[MULTI_SELECT_ANSWER] for o in _options(a)]
+  rows += [(q, s, o["id"], r, survey_id, o.get("answer")) 
+           for r, q, s, a in buckets[MULTI_VALUE_ANSWER] for o in _options(a)]
+  return len(single_select) - len(selected)
+
+def parse_answer_page(responses: List[dict], survey_id: str, kinds: Dict[int, int]) -> ParsedPage:
+  # Parses a whole page at once: answers are grouped by kind in a single pass,
+  # then each group is unpacked by one comprehension instead of walking an
+  # if/elif chain per answer. Answers to a sub question carry their parent as
+  # the question. Malformed answers raise a LoadError.
+  try:
+    return _parse_answer_page(responses, survey_id, kinds)
+  except (KeyError, TypeError, ValueError, AttributeError) as e:
+    raise LoadError(f"could not parse answers of survey {survey_id}: {type(e).__name__}: {e}") from e
+
+def _parse_answer_page(responses: List[dict], survey_id: str, kinds: Dict[int, int]) -> ParsedPage:
+  answers = ((response["id"], answer["parent"], answer["id"], answer) if answer.get("parent") 
+             else (response["id"], answer["id"], 0, answer)
+             for response in responses
+             for answer in iter_over(response, "survey_data"))
+  buckets = _bucket_answers(answers, kinds, range(UNSUPPORTED_ANSWER))
+
+  rows = [(q, s, 0, r, survey_id, a.get("answer", 0)) for r, q, s, a in buckets[HIDDEN_ANSWER]]
+  null_answers = _unpack(rows, buckets, survey_id) # TODO: should we handle these differently?
+
+  # table / matrix answers: the same again one level down, under their parent
+  sub_answers = ((r, q, sub_answer["id"], sub_answer) 
+                 for r, q, _, a in buckets[TWO_LAYER_ANSWER] 
+                 for sub_answer in iter_over(a, "sub_questions"))
+  null_answers += _unpack(rows, _bucket_answers(sub_answers, kinds, (SINGLE_SELECT_ANSWER, SINGLE_VALUE_ANSWER, 
+                                                                     MULTI_SELECT_ANSWER,  MULTI_VALUE_ANSWER)),
+                          survey_id)
+  return ParsedPage(rows, null_answers)
+
+class WriteOp(NamedTuple):
+  # One statement's worth of rows for the writer. `check` marks the static
+  # checks, which should modify nothing; `message` is logged with the rowcount.
+  query:           str
+  rows:            list
+  check:           bool          = False
+  message:         Optional[str] = None
+  suppress_output: bool          = False
+
+STATEMENT_PATTERN = re.compile(r"\s*(INSERT|UPDATE|DELETE)(?:\s+OR\s+\w+)?(?:\s+INTO|\s+FROM)?\s+(\w+)", re.IGNORECASE)
+
+@lru_cache(maxsize=None)
+def statement_stage(query: str) -> str:
+  # "sqlite insert answer", "sqlite update question", ...
+  match = STATEMENT_PATTERN.match(query)
+  if not match:
+    return "sqlite execute"
+  return f"sqlite {match.group(1).lower()} {match.group(2)}"
+
+def apply_writes(cursor: sqlite3.Cursor, ops: Iterable[WriteOp],
+                 metrics: Instrumentation = NO_INSTRUMENTATION,
+                 rowcounts: Optional[Counter] = None) -> Counter:
+  # Adds each statement's rowcount to `rowcounts` (a new Counter by default),
+  # which a writer applying a load an op at a time passes back in each call.
+  rowcounts = Counter() if rowcounts is None else rowcounts
+  for op in ops:
+    if op.query == SYNC_STATE_UPSERT_STMT:
+      changed = int(any(rowcounts.values()))
+      op      = op._replace(rows=[{**row, "changed": changed} for row in op.rows])
+    with metrics.stage(statement_stage(op.query)) as stage:
+      rowcount, err = executemany(cursor, op.query, op.rows, op.suppress_output)
+      stage.rows = len(op.rows)
+    if err != None:
+      raise LoadError(err)
+    rowcounts[op.query] += rowcount
+    if op.check and rowcount != 0:
+      logger.warning(f"static check failed: {op.query} modified {rowcount} rows")
+    elif op.message:
+      logger.info(op.message.format(rowcount=rowcount))
+  return rowcounts
+
+def answer_writes(rows: List[AnswerRow]) -> Iterator[WriteOp]:
+  # Intern the batch's distinct values ahead of the answers that refer to
+  # them. Keyed on type as well, since 1 and 1.0 are equal in python but
+  # stored as different text.
+  values = dict.fromkeys((type(row[5]), row[5]) for row in rows if row[5] is not None)
+  yield WriteOp(ANSWER_VALUE_INSERT_STMT, [(value, answer_number(value)) for _, value in values],
+                suppress_output=True)
+  yield WriteOp(ANSWER_INSERT_STMT, rows, suppress_output=True)
 
 def load_survey(con: sqlite3.Connection, survey_id: str, 
-                api_key: str, api_secret: str) -> Optional[str]:
+                api_key: str, api_secret: str,
+                scheduler: Optional[RequestScheduler] = None,
+                concurrency: int = DEFAULT_CONCURRENCY,
+                incremental: bool = True,
+                host: str = ALCHEMER_HOST,
+                instrumentation: Optional[Instrumentation] = None) -> Optional[str]:
+  cursor = con.cursor()
+  if scheduler is None:
+    scheduler = RequestScheduler(make_session(concurrency), max_concurrency=concurrency)
+  metrics = (instrumentation or NO_INSTRUMENTATION).bind(survey_id=survey_id)
+  since   = get_high_water_mark(cursor, survey_id) if incremental else None
+  try:
+    ops       = iter_survey_writes(survey_id, api_key, api_secret, scheduler, concurrency, since, host, metrics)
+    rowcounts = apply_writes(cursor, ops, metrics)
+  except LoadError as e:
+    return str(e)
+  logger.info(f"added {rowcounts[ANSWER_INSERT_STMT]} answers to the database")
+  return None
 
+def iter_survey_writes(survey_id: str, api_key: str, api_secret: str,
+                       scheduler: RequestScheduler,
+                       concurrency: int = DEFAULT_CONCURRENCY,
+                       since: Optional[str] = None,
+                       host: str = ALCHEMER_HOST,
+                       metrics: Instrumentation = NO_INSTRUMENTATION) -> Iterator[WriteOp]:
+  # Fetches and parses one survey, yielding the writes that load it in the
+  # order they must be applied. Never touches the database itself, so it can
+  # run on any thread while a single writer applies the ops.
   logger.info(f"processing data for survey {survey_id}")
-  cursor = con.cursor()
   
   if not api_key:
-    return 0, f"no api key provided"
+    raise LoadError(f"no api key provided")
   if not api_secret:
-    return 0, f"no api secret provided"
+    raise LoadError(f"no api secret provided")
 
-  alchemer_host = "https://api.alchemer.com"
-  survey_path   = f"{alchemer_host}/v5/survey/{survey_id}"
+  survey_path   = f"{host}/v5/survey/{survey_id}"
   question_path = f"{survey_path}/surveyquestion"
   response_path = f"{survey_path}/surveyresponse"
+  auth_params   = {'api_token': api_key, 'api_token_secret': api_secret}
    
-  res = requests.get(survey_path, params={'api_token': api_key, 'api_token_secret': api_secret})
+  res = fetch(scheduler, survey_path, auth_params, metrics)
   if res.status_code != 200:
-    return 0, f"recieved {res.status_code} response when fetching {survey_id}: {res.reason}"
+    raise LoadError(f"recieved {res.status_code} response when fetching {survey_id}: {res.reason}")
     
-  survey_data = res.json()["data"]
+  with metrics.stage("json decode") as stage:
+    stage.bytes = len(res.content)
+    survey_data = res.json()["data"]
   assert(survey_data["id"] == survey_id)
   
-  rowcount, err = execute(cursor, SURVEY_STATIC_CHECK, survey_data)
-  if err != None:
-    return err
-  elif rowcount != 0:
-    logger.warn(f"Survey static check failed: {SURVEY_STATIC_CHECK} updated {rowcount} rows")
-
-  rowcount, err = execute(cursor, SURVEY_INSERT_STMT, survey_data)
-  if err != None:
-    return err
-
-  logger.info(f"inserted {cursor.rowcount} new survey(s) into the database")
+  yield WriteOp(SURVEY_STATIC_CHECK, [survey_data], check=True)
+  yield WriteOp(SURVEY_INSERT_STMT,  [survey_data], message="inserted {rowcount} new survey(s) into the database")
   
-  res = requests.get(question_path, params={'api_token': api_key, 'api_token_secret': api_secret})
+  res = fetch(scheduler, question_path, auth_params, metrics)
   if res.status_code != 200:
-    return f"received {res.status_code} response when fetching {survey_id}: {res.reason}" 
+    raise LoadError(f"received {res.status_code} response when fetching {survey_id}: {res.reason}")
   
-  res_json = res.json()
+  with metrics.stage("json decode") as stage:
+    stage.bytes = len(res.content)
+    res_json = res.json()
   questions_data = res_json["data"]
   options_data   = []
 
@@ -175,179 +558,224 @@ def load_survey(con: sqlite3.Connection, survey_id: str,
     question_data = questions_data[i]
     if (question_data["type"] not in QUESTION_TYPE_STR_MAP or
         question_data["base_type"] not in BASE_TYPE_STR_MAP):
-      return f"""base type / question type {question_data['base_type']} / {question_data['type']} 
-                found in survey is missing from our lookup table. Exiting early."""
+      raise LoadError(f"""base type / question type {question_data['base_type']} / {question_data['type']} 
+                found in survey is missing from our lookup table. Exiting early.""")
     question_data["type"]      = QUESTION_TYPE_STR_MAP[question_data["type"]].value
     question_data["base_type"] = BASE_TYPE_STR_MAP[question_data["base_type"]].value
     question_data["title"]     = question_data["title"]["English"]
     question_data["shortname"] = question_data["shortname"] or question_data["title"]
     question_data["survey_id"] = survey_id;
+    question_data["variable_name"]   = variable_name(question_data["shortname"])
+    question_data["variable_prefix"] = variable_prefix(question_data["title"])
+    question_data.setdefault("parent_id", 0)
     for sub_answer in question_data.get("sub_questions", []):
+      sub_answer["parent_id"] = question_data["id"]
       questions_data.append(sub_answer)
     for j, question_option in enumerate(question_data.get("options", [])):
-      question_option["option_order"] = j 
+      question_option["option_order"]    = j 
+      question_option["question_id"]     = question_data["id"]
+      question_option["variable_prefix"] = variable_prefix(question_option["value"])
       options_data.append(question_option)
     i += 1
 
+  question_index = QuestionIndex.from_questions_data(questions_data)
+  kinds          = answer_kinds(question_index)
+
   logger.info(f"starting to process questions for survey {survey_id}")
   
-  rowcount, err = executemany(cursor, QUESTION_STATIC_CHECK, questions_data)
-  if err != None:
-    return err
-  elif rowcount != 0:
-    logger.warn(f"static check failed: {QUESTION_STATIC_CHECK} modified {rowcount} rows")
-
-  rowcount, err = executemany(cursor, QUESTION_INSERT_STMT, questions_data)
-  if err != None:
-    return err
-  
-  logger.info(f"inserted {rowcount} new questions into the database")
-  
-  _, err = executemany(cursor, SURVEY_X_QUESTION_INSERT_STMT, questions_data)
-  if err != None:
-    return err
-  
-  rowcount, err = executemany(cursor, OPTION_STATIC_CHECK, options_data)
-  if err != None:
-    return err
-  elif rowcount != 0:
-    logger.warn(f"static check failed: {OPTION_STATIC_CHECK} modified {rowcount} rows")
-    
-  rowcount, err = executemany(cursor, OPTIONS_INSERT_STMT, options_data)
-  if err != None:
-    return f"error executing command '{OPTIONS_INSERT_STMT}': {err}"
-
-  logger.info(f"added {rowcount} options to the database")
+  yield WriteOp(QUESTION_STATIC_CHECK,         questions_data, check=True)
+  yield WriteOp(QUESTION_INSERT_STMT,          questions_data, message="inserted {rowcount} new questions into the database")
+  yield WriteOp(SURVEY_X_QUESTION_INSERT_STMT, questions_data)
+  yield WriteOp(OPTION_STATIC_CHECK,           options_data,   check=True)
+  yield WriteOp(OPTIONS_INSERT_STMT,           options_data,   message="added {rowcount} options to the database")
   
-  res = requests.get(response_path, params={'api_token': api_key, 
-                                            'api_token_secret': api_secret, 
-                                            'resultsperpage': 100})
-  if res.status_code != 200:
-    return f"received {res.status_code} response when fetching {survey_id}: {res.reason}"
-
-  res_data       = res.json()
-  total_pages    = res_data["total_pages"]
-  response_count = res_data["total_count"] 
-  page = 1
-
-  logger.info(f"{total_pages} pages to process")
-  logger.info(f"{response_count} responses")
-
-
-  while page < res_data['total_pages']:
+  response_params = {**auth_params, 'resultsperpage': RESULTS_PER_PAGE}
+  high_water_mark = since
+  if since:
+    logger.info(f"syncing responses submitted or updated since {since}")
+    passes = [{**response_params, **sync_filter_params(field, since)} for field in SYNC_FILTER_FIELDS]
+  else:
+    passes = [response_params]
+
+  pages = chain.from_iterable(iter_response_pages(scheduler, response_path, params, concurrency, metrics) 
+                              for params in passes)
+  seen_responses = set()
+  answer_batch   = []
+
+  for page, res in pages:
     logger.info(f"processing page {page}")
-    res = requests.get(response_path, params={'api_token': api_key, 
-                                              'api_token_secret': api_secret, 
-                                              'resultsperpage': 100,
-                                              'page': page})
     if res.status_code != 200:
-      return f"received {res.status_code} response when fetching {survey_id}: {res.reason}"
+      raise LoadError(f"received {res.status_code} response when fetching {survey_id}: {res.reason}")
 
-    responses = res.json()["data"]
+    # a response can come back from more than one filtered pass
+    with metrics.stage("json decode", page=page) as stage:
+      stage.bytes = len(res.content)
+      responses = [response for response in res.json()["data"] if response["id"] not in seen_responses]
 
     for response in responses:
       response["survey_id"] = survey_id
+      seen_responses.add(response["id"])
+      for field in SYNC_FILTER_FIELDS:
+        timestamp = response_timestamp(response.get(field))
+        if timestamp and (high_water_mark is None or timestamp > high_water_mark):
+          high_water_mark = timestamp
 
     total_answers = 0
-    null_answers  = 0
     for response in responses:
       total_answers += len(iter_over(response, "survey_data"))
     
     logger.info(f"total potential answers for page are {total_answers}")
-      
     
-    _, err = executemany(cursor, RESPONSE_INSERT_STMT, responses)
-    if err != None:
-      err
-    parsed_answers = []
-    for response in responses:
-      parsed_answer = {"response_id": response["id"], "survey_id": survey_id}
-      answers = response["survey_data"]
-      for answer in iter_over(answers):
-        cursor.execute("SELECT * FROM question WHERE id = ?", (answer["id"],))
-        question = cursor.fetchone()
-        if not question:
-          return f"No question matching response id {response['id']}. This shouldn't be possible"
-        qtype = question["question_type"]
-        if answer.get("parent"):
-          parsed_answer["question_id"] = answer["parent"]
-          parsed_answer["sub_question_id"] = answer["id"]
-        else:
-          parsed_answer["question_id"] = answer["id"]
-          parsed_answer["sub_question_id"] = 0
-        if qtype == QuestionType.HIDDEN:
-          parsed_answer["option_id"]       = 0
-          parsed_answer["answer"]          = answer.get("answer", 0)
-          parsed_answers.append(parsed_answer.copy())
-        elif qtype in SINGLE_SELECT_QUESTIONS:
-          if not answer.get("answer_id"): 
-            null_answers += 1
-            continue # TODO: should we handle this differently?
-          parsed_answer["option_id"]       = answer["answer_id"]
-          parsed_answer["answer"]          = "answer" in answer
-          parsed_answers.append(parsed_answer.copy())
-        elif qtype in SINGLE_VALUE_QUESTION:
-          parsed_answer["option_id"]       = 0
-          parsed_answer["answer"]          = answer.get("answer")
-          parsed_answers.append(parsed_answer.copy())
-        elif qtype in MULTI_SELECT_QUESTIONS:
-          for option in iter_over(answer, "options"):
-            parsed_answer["option_id"]     = option["id"] 
-            parsed_answer["answer"]        = "answer" in option 
-            parsed_answers.append(parsed_answer.copy())
-        elif qtype in MULTI_VALUE_QUESTIONS:
-          for option in iter_over(answer, "options"):
-            parsed_answer["option_id"]     = option["id"] 
-            parsed_answer["answer"]        = option.get("answer") 
-            parsed_answers.append(parsed_answer.copy())
-        elif qtype in TWO_LAYER_QUESTIONS:
-          for sub_answer in iter_over(answer, "sub_questions"):
-            parsed_answer["sub_question_id"] = sub_answer["id"]
-            cursor.execute("SELECT * FROM question WHERE id = ?", sub_answer["id"])
-            row = cursor.fetchone()
-            if not row:
-              return f"No question matching response id {response['id']}. This shouldn't be possible"
-            sub_question_qtype = row["question_type"]
-            if sub_question_qtype in SINGLE_SELECT_QUESTIONS:
-              parsed_answer["option_id"]       = sub_answer["answer_id"]
-              parsed_answer["answer"]          = "answer" in sub_answer 
-              parsed_answers.append(parsed_answer.copy())
-            elif sub_question_qtype in SINGLE_VALUE_QUESTION:
-              parsed_answer["option_id"]       = 0
-              parsed_answer["answer"]          = sub_answer.get("answer")
-              parsed_answers.append(parsed_answer.copy())
-            elif sub_question_qtype in MULTI_SELECT_QUESTIONS:
-              for option in iter_over(sub_answer, "options"):
-                parsed_answer["option_id"]     = option["id"] 
-                parsed_answer["answer"]        = "answer" in option 
-                parsed_answers.append(parsed_answer.copy())
-            elif sub_question_qtype in MULTI_VALUE_QUESTIONS:
-              for option in iter_over(sub_answer, "options"):
-                parsed_answer["option_id"]     = option["id"] 
-                parsed_answer["answer"]        = option.get("answer") 
-                parsed_answers.append(parsed_answer.copy())
-            else:
-              return f"What the hell am I supposed to do with this answer? {qtype} {answer}"
+    yield WriteOp(RESPONSE_INSERT_STMT, responses)
+    if since:
+      # responses modified since the last sync replace their earlier answers
+      yield WriteOp(ANSWER_DELETE_STMT, responses)
+
+    # answers go out in fixed size batches that can span pages; every
+    # response they reference has already been written above.
+    with metrics.stage("parse", page=page) as stage:
+      parsed = parse_answer_page(responses, survey_id, kinds)
+      stage.rows = len(parsed.rows)
+    answer_batch.extend(parsed.rows)
+    while len(answer_batch) >= BULK_BATCH_SIZE:
+      yield from answer_writes(answer_batch[:BULK_BATCH_SIZE])
+      answer_batch = answer_batch[BULK_BATCH_SIZE:]
+
+    logger.info(f"total potential answers: {total_answers}. null answers {parsed.null_answers}. Remaining {total_answers - parsed.null_answers}. Successfully parses {len(parsed.rows)}")
+
+  if answer_batch:
+    yield from answer_writes(answer_batch)
+
+  yield WriteOp(SYNC_STATE_UPSERT_STMT, [{"survey_id":       survey_id,
+                                          "high_water_mark": high_water_mark,
+                                          "synced_at":       datetime.now(timezone.utc).isoformat()}])
+
+def load_surveys_parallel(con: sqlite3.Connection, survey_ids: List[str],
+                          api_key: str, api_secret: str,
+                          scheduler: RequestScheduler,
+                          workers: int = DEFAULT_WORKERS,
+                          concurrency: int = DEFAULT_CONCURRENCY,
+                          incremental: bool = True,
+                          host: str = ALCHEMER_HOST,
+                          queue_size: int = WRITE_QUEUE_SIZE,
+                          instrumentation: Optional[Instrumentation] = None) -> Dict[str, Optional[str]]:
+  # Fetches and parses up to `workers` surveys at once on worker threads while
+  # the calling thread is the only one writing to `con`. Each survey gets its
+  # own bounded queue of WriteOps; the writer takes surveys in the order they
+  # start producing and applies each inside its own transaction, so a survey
+  # is committed or rolled back as a unit. Workers that get ahead of the
+  # writer block on their full queue, which bounds memory. Should the writer
+  # fail on anything but a LoadError (a locked database, say), the open
+  # survey is rolled back, the workers are stopped and the error re-raised.
+  # Returns survey id -> error (None when the survey committed). A survey
+  # asked for more than once is loaded once.
+  survey_ids = list(dict.fromkeys(survey_ids))
+  cursor     = con.cursor()
+  metrics = {survey_id: (instrumentation or NO_INSTRUMENTATION).bind(survey_id=survey_id)
+             for survey_id in survey_ids}
+  since   = {survey_id: get_high_water_mark(cursor, survey_id) if incremental else None
+             for survey_id in survey_ids}
+  queues    = {survey_id: queue.Queue(maxsize=queue_size) for survey_id in survey_ids}
+  cancelled = {survey_id: threading.Event() for survey_id in survey_ids}
+  aborted   = threading.Event()
+  ready     = queue.Queue()
+
+  def produce(survey_id: str):
+    announced = False
+    def put(message):
+      nonlocal announced
+      if not announced:
+        ready.put(survey_id)
+        announced = True
+      # a full queue is only waited on while the writer is still reading
+      while not aborted.is_set():
+        try:
+          queues[survey_id].put(message, timeout=WRITER_ABORT_POLL)
+          return
+        except queue.Full:
+          pass
+      raise _WriterAborted()
+    try:
+      try:
+        for op in iter_survey_writes(survey_id, api_key, api_secret, scheduler, 
+                                     concurrency, since[survey_id], host, metrics[survey_id]):
+          if cancelled[survey_id].is_set():
+            break
+          put(op)
+        put(_SURVEY_DONE)
+      except _WriterAborted:
+        raise
+      except Exception as e:
+        put(_SurveyFailed(str(e)))
+    except _WriterAborted:
+      pass
+
+  errors = {}
+  with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+    for survey_id in survey_ids:
+      executor.submit(produce, survey_id)
+
+    try:
+      for _ in survey_ids:
+        survey_id = ready.get()
+        messages  = queues[survey_id]
+        err       = None
+        rowcounts = Counter()
+        con.execute("BEGIN TRANSACTION;")
+        while True:
+          # time the writer spends starved of work points at the api side
+          with metrics[survey_id].stage("writer wait"):
+            message = messages.get()
+          if message is _SURVEY_DONE:
+            break
+          if isinstance(message, _SurveyFailed):
+            err = message.error
+            break
+          if err != None:
+            continue # draining a survey we already gave up on
+          try:
+            added = rowcounts[ANSWER_INSERT_STMT]
+            apply_writes(cursor, [message], metrics[survey_id], rowcounts)
+            if message.query == ANSWER_INSERT_STMT:
+              logger.debug(f"survey {survey_id}: added {rowcounts[ANSWER_INSERT_STMT] - added} answers")
+          except LoadError as e:
+            err = str(e)
+            cancelled[survey_id].set()
+        if err == None:
+          with metrics[survey_id].stage("sqlite commit"):
+            con.commit()
+          logger.info(f"committed survey {survey_id}")
         else:
-          return f"Encountered question type we don't know how to handle yet: type: {qtype}, answer: {answer}"
-    
-    logger.info(f"total potential answers: {total_answers}. null answers {null_answers}. Remaining {total_answers - null_answers}. Successfully parses {len(parsed_answers)}")
+          logger.error(err)
+          con.rollback()
+          logger.info(f"all data just added for suvey_id {survey_id} has been rolled back")
+        errors[survey_id] = err
+    except BaseException:
+      # anything but a LoadError stops the whole load; the workers blocked on
+      # a full queue are let go before the executor waits on them
+      if con.in_transaction:
+        con.rollback()
+      aborted.set()
+      for event in cancelled.values():
+        event.set()
+      raise
+  return errors
 
-    rowcount, err = executemany(cursor, ANSWER_INSERT_STMT, parsed_answers, True)
-    if err != None:
-      return err
-    
-    page += 1
+_SURVEY_DONE = object()
 
-    logger.info(f"added {rowcount} answers to the database")
+class _SurveyFailed(NamedTuple):
+  error: str
 
-  return None
+class _WriterAborted(Exception):
+  pass
   
   
   
-def check_type_coverage(con: sqlite3.Connection, api_key: str, api_secret: str):
-  alchemer_host = "https://api.alchemer.com"
-  surveys_path  = f"{alchemer_host}/v5/survey"
+def check_type_coverage(con: sqlite3.Connection, api_key: str, api_secret: str,
+                        scheduler: Optional[RequestScheduler] = None):
+  if scheduler is None:
+    scheduler = RequestScheduler(make_session())
+  surveys_path  = f"{ALCHEMER_HOST}/v5/survey"
   survey_question_list = [
     {"survey_id": 8002909, "question_id": 249},
     {"survey_id": 8002909, "question_id": 142},
@@ -373,7 +801,7 @@ def check_type_coverage(con: sqlite3.Connection, api_key: str, api_secret: str):
     survey_id   = survey_question["survey_id"]
     question_id = survey_question["question_id"]
     survey_question_path = f"{surveys_path}/{survey_id}/surveyquestion/{question_id}"
-    res = requests.get(survey_question_path, params={'api_token': api_key, 'api_token_secret': api_secret, 'resultsperpage': 300})
+    res = scheduler.get(survey_question_path, params={'api_token': api_key, 'api_token_secret': api_secret, 'resultsperpage': 300})
     if res.status_code != 200:
       return 0, f"recieved {res.status_code} response when fetching {survey_id}: {res.reason}"
     
@@ -385,9 +813,33 @@ if __name__ == "__main__":
     con.row_factory = sqlite3.Row
     cursor = con.cursor()
     cursor.execute('PRAGMA foreign_keys = ON;')
+    migrate(con)
+    configure_connection(con)
 
     parser = argparse.ArgumentParser(description="A script that accepts a variable number of arguments.")
     parser.add_argument("survey_ids", nargs="*", type=str, help="survey ids to fetch")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, 
+                        help="number of response pages to keep in flight at once")
+    parser.add_argument("--requests-per-minute", type=int, default=DEFAULT_RATE_LIMIT,
+                        help="alchemer api request limit to pace requests against")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="surveys to fetch and parse in parallel, all written by a single connection")
+    parser.add_argument("--parquet-dir", type=str, default=None,
+                        help="also refresh each loaded survey's answer partition in this parquet store")
+    parser.add_argument("--full", action="store_true",
+                        help="re-download every response instead of only those changed since the last sync")
+    parser.add_argument("--host", type=str, default=ALCHEMER_HOST,
+                        help="api host, e.g. a local alchemy.replay server")
+    parser.add_argument("--record", type=str, default=None,
+                        help="append every api response to this gzipped jsonl fixture file")
+    parser.add_argument("--replay", type=str, default=None,
+                        help="answer api requests from this fixture file instead of the network")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds of simulated latency per request when replaying")
+    parser.add_argument("--rate-limit", type=int, default=None,
+                        help="simulated requests per minute allowed when replaying")
+    parser.add_argument("--report", type=str, default=None,
+                        help="write per stage timings and throughput for the run to this json file")
     args = parser.parse_args()
     
     if len(args.survey_ids) == 0:
@@ -399,12 +851,50 @@ if __name__ == "__main__":
     api_secret = os.environ.get("API_SECRET")
 
 
-    for survey_id in args.survey_ids:
-      con.execute("BEGIN TRANSACTION;")
-      err = load_survey(con, survey_id, api_key, api_secret)
-      if err == None:
-        con.commit()
-      else: 
-        logging.error(err)
-        con.rollback()
-        logging.info(f"all data just added for suvey_id {survey_id} has been rolled back")
\ No newline at end of file
+    session  = make_session(args.concurrency)
+    recorder = FixtureRecorder(args.record) if args.record else None
+    if recorder:
+      recorder.attach(session)
+    if args.replay:
+      session.mount(args.host, ReplayAdapter(FixtureStore.load(args.replay), 
+                                             Throttle(args.latency, args.rate_limit)))
+      api_key    = api_key    or "replay"
+      api_secret = api_secret or "replay"
+    instrumentation = Instrumentation()
+    scheduler = RequestScheduler(session, rate_limit=args.requests_per_minute, 
+                                 max_concurrency=args.concurrency, instrumentation=instrumentation)
+
+    errors = {}
+    if args.workers > 1:
+      errors = load_surveys_parallel(con, args.survey_ids, api_key, api_secret, scheduler, 
+                                     workers=args.workers, concurrency=args.concurrency,
+                                     incremental=not args.full, host=args.host,
+                                     instrumentation=instrumentation)
+    else:
+      for survey_id in args.survey_ids:
+        con.execute("BEGIN TRANSACTION;")
+        err = load_survey(con, survey_id, api_key, api_secret, scheduler, args.concurrency, 
+                          incremental=not args.full, host=args.host, instrumentation=instrumentation)
+        errors[survey_id] = err
+        if err == None:
+          with instrumentation.stage("sqlite commit", survey_id=survey_id):
+            con.commit()
+        else: 
+          logging.error(err)
+          con.rollback()
+          logging.info(f"all data just added for suvey_id {survey_id} has been rolled back")
+
+    if args.parquet_dir:
+      parquet = ParquetStorage(con, args.parquet_dir)
+      for survey_id, err in errors.items():
+        if err == None:
+          with instrumentation.stage("parquet write", survey_id=survey_id) as stage:
+            stage.rows = rowcount = parquet.write_survey(int(survey_id))
+          logger.info(f"wrote {rowcount} answers to the parquet partition for survey {survey_id}")
+
+    if recorder:
+      recorder.close()
+
+    logger.info(f"load finished in {instrumentation.summary()}")
+    if args.report:
+      instrumentation.write_report(args.report)
\ No newline at end of file
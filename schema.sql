@@ -1,4 +1,6 @@
 PRAGMA foreign_keys = ON;
+PRAGMA page_size = 8192;
+PRAGMA journal_mode = WAL;
 BEGIN TRANSACTION;
 
 CREATE TABLE survey (
@@ -11,13 +13,18 @@ CREATE TABLE question (
   base_type     INTEGER NOT NULL,
   question_type INTEGER NOT NULL,
   title         TEXT    NOT NULL,
-  shortname     TEXT    NOT NULL
+  shortname     TEXT    NOT NULL,
+  parent_id     INTEGER,
+  variable_name   TEXT,
+  variable_prefix TEXT
 );
 
 CREATE TABLE option (
   id            INTEGER PRIMARY KEY,
   value         TEXT,
-  option_order  INTEGER
+  option_order  INTEGER,
+  question_id   INTEGER,
+  variable_prefix TEXT
 );
 
 
@@ -36,6 +43,12 @@ CREATE TABLE response (
   FOREIGN KEY (survey_id) REFERENCES survey(id) ON UPDATE RESTRICT ON DELETE RESTRICT
 );
 
+CREATE TABLE answer_value (
+  id              INTEGER PRIMARY KEY,
+  value           TEXT    NOT NULL UNIQUE,
+  number          REAL
+);
+
 CREATE TABLE answer (
   id              INTEGER PRIMARY KEY AUTOINCREMENT,
   question_id     INTEGER,
@@ -43,16 +56,35 @@ CREATE TABLE answer (
   option_id       INTEGER,
   response_id     INTEGER,
   survey_id       INTEGER,
-  answer          TEXT,
+  value_id        INTEGER,
   FOREIGN KEY (sub_question_id) REFERENCES question(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
   FOREIGN KEY (question_id) REFERENCES question(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
+  FOREIGN KEY (value_id) REFERENCES answer_value(id) ON UPDATE RESTRICT ON DELETE RESTRICT,
   UNIQUE (survey_id, question_id, sub_question_id, option_id, response_id),
   FOREIGN KEY (response_id, survey_id) REFERENCES response(id, survey_id) ON UPDATE RESTRICT ON DELETE RESTRICT
 );
 
-INSERT INTO question (id, base_type, question_type, title, shortname)
-              VALUES (0, 0, 0, "", "");
-INSERT INTO   option (id, value)
-              VALUES (0, "");
+CREATE TABLE sync_state (
+  survey_id       INTEGER PRIMARY KEY,
+  high_water_mark TEXT,
+  synced_at       TEXT    NOT NULL,
+  data_version    INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (survey_id) REFERENCES survey(id) ON UPDATE RESTRICT ON DELETE RESTRICT
+);
+
+CREATE INDEX answer_survey_response
+  ON answer (survey_id, response_id, question_id, sub_question_id, option_id, value_id);
+CREATE INDEX option_question
+  ON option (question_id, option_order);
+CREATE INDEX response_survey
+  ON response (survey_id, id);
+
+INSERT INTO question (id, base_type, question_type, title, shortname, variable_name, variable_prefix)
+              VALUES (0, 0, 0, "", "", "", "");
+INSERT INTO   option (id, value, variable_prefix)
+              VALUES (0, "", "");
+
+-- keep in step with alchemy/migrations.py
+PRAGMA user_version = 7;
 
 COMMIT;
\ No newline at end of file
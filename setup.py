@@ -22,4 +22,11 @@ setup(
     install_requires=[
       "pandas",
     ],
+    extras_require={
+      "parquet": ["pyarrow"],
+      "arrow":   ["pyarrow"],
+    },
+    entry_points={
+      "console_scripts": ["alchemy=alchemy.cli:main"],
+    },
 )
\ No newline at end of file
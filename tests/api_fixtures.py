@@ -0,0 +1,142 @@
+import json
+import random
+import sqlite3
+from datetime import datetime
+from typing import Dict, List, Optional
+from urllib.parse import urlencode
+
+import requests
+
+import load_survey
+from alchemy.migrations import configure_connection, migrate
+from alchemy.replay import FixtureStore, ReplayAdapter, Throttle, fixture_key
+from alchemy.scheduler import RequestScheduler
+
+# Loader tests run against recorded-style api fixtures served by
+# alchemy.replay, generated here instead of read from a recording so every
+# survey, page and filtered pass is under the test's control.
+
+API_KEY    = "key"
+API_SECRET = "secret"
+
+QUESTIONS = [
+  {"id": 1, "type": "HIDDEN",   "base_type": "Question", "title": {"English": "Hidden"},    "shortname": ""},
+  {"id": 2, "type": "RADIO",    "base_type": "Question", "title": {"English": "Fav color"}, "shortname": "fav color",
+   "options": [{"id": 10001, "value": "Red"}, {"id": 10002, "value": "Blue"}]},
+  {"id": 3, "type": "CHECKBOX", "base_type": "Question", "title": {"English": "Pets"},      "shortname": "pets",
+   "options": [{"id": 10003, "value": "X Dog"}, {"id": 10004, "value": "Cat"}]},
+  {"id": 4, "type": "TEXTBOX",  "base_type": "Question", "title": {"English": "Name"},      "shortname": "1name"},
+  {"id": 5, "type": "TABLE",    "base_type": "Question", "title": {"English": "Grid"},      "shortname": "grid",
+   "options": [{"id": 10005, "value": "Agree"}, {"id": 10006, "value": "Disagree"}],
+   "sub_questions": [
+     {"id": 6, "type": "RADIO", "base_type": "Question", "title": {"English": "Row A"}, "shortname": "",
+      "options": [{"id": 10007, "value": "Agree"}, {"id": 10008, "value": "Disagree"}]},
+     {"id": 7, "type": "RADIO", "base_type": "Question", "title": {"English": "Row B"}, "shortname": "",
+      "options": [{"id": 10009, "value": "Agree"}, {"id": 10010, "value": "Disagree"}]}]},
+  {"id": 8, "type": "RANK",     "base_type": "Question", "title": {"English": "Rank"},      "shortname": "rank",
+   "options": [{"id": 10011, "value": "One"}, {"id": 10012, "value": "Two"}]},
+]
+
+
+def make_response(response_id: int, rng: random.Random, submitted: str, updated: Optional[str] = None) -> dict:
+  color = rng.choice([10001, 10002, None])
+  grid  = {str(sq): {"id": sq, "type": "RADIO", "answer_id": pick, "answer": "Agree" if pick % 2 else "Disagree"}
+           for sq, pick in ((6, rng.choice([10007, 10008])), (7, rng.choice([10009, 10010])))}
+  # now and then a grid row left unanswered
+  if rng.random() < 0.2:
+    grid["7"] = {"id": 7, "type": "RADIO", "answer_id": None, "answer": None}
+  survey_data = {
+    "1": {"id": 1, "type": "HIDDEN", "answer": f"h{response_id}"},
+    "2": ({"id": 2, "type": "RADIO", "answer_id": color, "answer": "Red" if color == 10001 else "Blue"} if color
+          else {"id": 2, "type": "RADIO"}),
+    "3": {"id": 3, "type": "CHECKBOX",
+          "options": {str(o): {"id": o, "option": "x", **({"answer": "x"} if rng.random() < 0.5 else {})}
+                      for o in (10003, 10004)}},
+    "4": {"id": 4, "type": "TEXTBOX", "answer": rng.choice(["bob", "alice", "eve"])},
+    "5": {"id": 5, "type": "TABLE", "sub_questions": grid},
+    "8": {"id": 8, "type": "RANK", "options": {str(o): {"id": o, "answer": str(rng.randint(1, 2))}
+                                               for o in (10011, 10012)}},
+  }
+  return {"id": str(response_id), "status": "Complete", "date_submitted": submitted,
+          "date_updated": updated or submitted, "survey_data": survey_data}
+
+
+def make_survey(survey_id: int, n_responses: int, seed: int = 0) -> dict:
+  # responses submitted one a day through January, in eastern standard time
+  rng       = random.Random(seed)
+  responses = [make_response(i, rng, f"2024-01-{1 + i * 27 // max(n_responses, 1):02d} 10:00:00 EST")
+               for i in range(1, n_responses + 1)]
+  return {"id": str(survey_id), "title": f"Survey {survey_id}", "questions": QUESTIONS, "responses": responses}
+
+
+def _key(path: str, params: Optional[dict] = None) -> str:
+  return fixture_key(f"{path}?{urlencode(params or {})}")
+
+
+def _body(payload: dict) -> bytes:
+  return json.dumps(payload).encode("utf-8")
+
+
+def _response_pages(path: str, responses: List[dict], params: dict) -> Dict[str, tuple]:
+  per_page    = load_survey.RESULTS_PER_PAGE
+  total_pages = max(1, -(-len(responses) // per_page))
+  return {_key(path, {**params, "resultsperpage": per_page, "page": page}):
+            (200, _body({"result_ok": True, "total_count": len(responses), "page": page, "total_pages": total_pages,
+                         "results_per_page": per_page, "data": responses[(page - 1) * per_page:page * per_page]}))
+          for page in range(1, total_pages + 1)}
+
+
+def api_fixtures(*surveys: dict, since: Optional[str] = None) -> Dict[str, tuple]:
+  # What the api answers for each survey: its metadata, its questions and its
+  # response pages. With `since`, the filtered passes of an incremental sync
+  # from that high water mark.
+  fixtures = {}
+  for survey in surveys:
+    path = f"/v5/survey/{survey['id']}"
+    fixtures[_key(path)] = (200, _body({"result_ok": True, "data": {"id": survey["id"], "title": survey["title"]}}))
+    fixtures[_key(f"{path}/surveyquestion")] = (200, _body({"result_ok": True, "page": 1, "total_pages": 1,
+                                                            "results_per_page": len(survey["questions"]),
+                                                            "data": survey["questions"]}))
+    if since is None:
+      fixtures.update(_response_pages(f"{path}/surveyresponse", survey["responses"], {}))
+      continue
+    for field in load_survey.SYNC_FILTER_FIELDS:
+      newer = [r for r in survey["responses"]
+               if datetime.fromisoformat(load_survey.utc_timestamp(r[field])) >= datetime.fromisoformat(since)]
+      fixtures.update(_response_pages(f"{path}/surveyresponse", newer, load_survey.sync_filter_params(field, since)))
+  return fixtures
+
+
+def replay_scheduler(store: FixtureStore, throttle: Optional[Throttle] = None, concurrency: int = 4,
+                     **kwargs) -> RequestScheduler:
+  session = requests.Session()
+  session.mount(load_survey.ALCHEMER_HOST, ReplayAdapter(store, throttle))
+  return RequestScheduler(session, rate_limit=60_000, max_concurrency=concurrency, **kwargs)
+
+
+def load(con: sqlite3.Connection, survey_id, scheduler: RequestScheduler, **kwargs) -> Optional[str]:
+  # one survey in its own transaction, as the loader's command line does
+  con.execute("BEGIN TRANSACTION;")
+  err = load_survey.load_survey(con, str(survey_id), API_KEY, API_SECRET, scheduler, **kwargs)
+  if err is None:
+    con.commit()
+  else:
+    con.rollback()
+  return err
+
+
+def answers(con: sqlite3.Connection, survey_id=None) -> list:
+  # every stored answer with its value, independent of the interning order
+  return con.execute("""
+    SELECT a.survey_id, a.response_id, a.question_id, a.sub_question_id, a.option_id, v.value
+      FROM answer a LEFT JOIN answer_value v ON v.id = a.value_id
+     WHERE ? IS NULL OR a.survey_id = ?
+     ORDER BY 1, 2, 3, 4, 5;""", (survey_id, survey_id)).fetchall()
+
+
+def connect(path: str) -> sqlite3.Connection:
+  # a migrated database, opened as the loader opens it
+  con = sqlite3.connect(path)
+  con.execute("PRAGMA foreign_keys = ON;")
+  migrate(con)
+  return configure_connection(con)
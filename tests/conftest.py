@@ -0,0 +1,23 @@
+import pytest
+
+from api_fixtures import connect
+
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+  return str(tmp_path / "alchemy.db")
+
+
+@pytest.fixture
+def con(db_path):
+  con = connect(db_path)
+  yield con
+  con.close()
+
+
+@pytest.fixture
+def other(tmp_path):
+  # a second database, for what a load should have produced
+  con = connect(str(tmp_path / "other.db"))
+  yield con
+  con.close()
@@ -0,0 +1,161 @@
+import asyncio
+
+import pandas as pd
+import pytest
+
+from alchemy import Alchemy, to_dense
+from alchemy.cli import main
+from alchemy.replay import FixtureStore
+from alchemy.storage import ParquetStorage
+
+from api_fixtures import api_fixtures, connect, load, make_survey, replay_scheduler
+
+# Every way of building a table has to give what a plain get_table does, on
+# one small database loaded through the replayed api.
+
+SURVEY_IDS = [101, 102]
+
+
+@pytest.fixture(scope="module")
+def data_dir(tmp_path_factory):
+  # the database and a parquet store of its answers
+  path     = tmp_path_factory.mktemp("alchemy")
+  surveys  = [make_survey(101, 250, seed=1), make_survey(102, 120, seed=2)]
+  con      = connect(str(path / "alchemy.db"))
+  fixtures = FixtureStore(api_fixtures(*surveys))
+  for survey in surveys:
+    assert load(con, survey["id"], replay_scheduler(fixtures)) is None
+  parquet = ParquetStorage(con, str(path / "parquet"))
+  for survey_id in SURVEY_IDS:
+    parquet.write_survey(survey_id)
+  con.close()
+  return path
+
+
+@pytest.fixture(scope="module")
+def db(data_dir) -> str:
+  return str(data_dir / "alchemy.db")
+
+
+@pytest.fixture(scope="module")
+def alchemy(db):
+  alchemy = Alchemy(db)
+  yield alchemy
+  alchemy.close()
+
+
+@pytest.fixture(scope="module", params=["flat", "multi"])
+def column_mode(request) -> str:
+  return request.param
+
+
+@pytest.fixture(scope="module")
+def expected(alchemy, column_mode) -> pd.DataFrame:
+  return alchemy.get_table(column_mode=column_mode)
+
+
+def opened(db: str, column_mode: str, **kwargs) -> pd.DataFrame:
+  # get_table of a fresh Alchemy opened with `kwargs`
+  alchemy = Alchemy(db, **kwargs)
+  try:
+    return alchemy.get_table(column_mode=column_mode)
+  finally:
+    alchemy.close()
+
+
+BUILDS = {
+  "chunked":          lambda a, mode: a.get_table(column_mode=mode, chunksize=50),
+  "thread workers":   lambda a, mode: a.get_table(column_mode=mode, workers=2),
+  "process workers":  lambda a, mode: a.get_table(column_mode=mode, workers=2, executor="process", chunksize=80),
+  "categorical":      lambda a, mode: a.get_table(a.get_records(categorical=True), column_mode=mode),
+  "undecoded":        lambda a, mode: a.get_table(a.get_records(decode=False), column_mode=mode),
+  "lazy":             lambda a, mode: a.lazy_table(column_mode=mode).collect(),
+  "lazy chunked":     lambda a, mode: a.lazy_table(SURVEY_IDS, column_mode=mode).collect(chunksize=50),
+  "sparse":           lambda a, mode: to_dense(a.get_table(column_mode=mode, sparse=True)),
+  "sparse chunked":   lambda a, mode: to_dense(a.get_table(column_mode=mode, sparse=True, chunksize=50)),
+}
+
+
+@pytest.mark.parametrize("build", BUILDS.values(), ids=BUILDS.keys())
+def test_build_matches_get_table(alchemy, column_mode, expected, build):
+  pd.testing.assert_frame_equal(expected, build(alchemy, column_mode))
+
+
+def test_parquet_storage_matches_get_table(db, data_dir, column_mode, expected):
+  table = opened(db, column_mode, storage="parquet", parquet_dir=str(data_dir / "parquet"))
+  pd.testing.assert_frame_equal(expected, table)
+
+
+def test_read_only_matches_get_table(db, column_mode, expected):
+  pd.testing.assert_frame_equal(expected, opened(db, column_mode, read_only=True))
+
+
+def plain(table: pd.DataFrame) -> pd.DataFrame:
+  # the table's values and labels, whatever their dtypes
+  table = table.astype(object)
+  table = table.where(table.notna(), None)
+  table.columns = (pd.MultiIndex.from_tuples(list(table.columns)) if table.columns.nlevels > 1
+                   else pd.Index(list(table.columns), dtype=object))
+  table.index = pd.MultiIndex.from_tuples([tuple(map(int, row)) for row in table.index], names=table.index.names)
+  return table
+
+
+def test_pyarrow_backend_matches_get_table(db, column_mode, expected):
+  # the same table in arrow backed dtypes
+  table = opened(db, column_mode, dtype_backend="pyarrow")
+  pd.testing.assert_frame_equal(plain(expected), plain(table))
+
+
+def test_table_cache_matches_get_table(db, tmp_path, column_mode, expected):
+  alchemy = Alchemy(db, cache_dir=str(tmp_path / "cache"))
+  try:
+    pd.testing.assert_frame_equal(expected, alchemy.get_table(column_mode=column_mode))
+    pd.testing.assert_frame_equal(expected, alchemy.get_table(column_mode=column_mode))
+  finally:
+    alchemy.close()
+
+
+def test_query_cache_matches_query(db, alchemy):
+  query  = "SELECT survey_id, COUNT(*) as answers FROM answer GROUP BY survey_id ORDER BY survey_id;"
+  cached = Alchemy(db, query_cache=True)
+  try:
+    pd.testing.assert_frame_equal(alchemy.query(query), cached.query(query))
+    pd.testing.assert_frame_equal(alchemy.query(query), cached.query(query))
+  finally:
+    cached.close()
+
+
+def test_pooled_and_async_match_get_table(db, column_mode, expected):
+  alchemy = Alchemy(db, pool_size=2)
+  try:
+    pd.testing.assert_frame_equal(expected, alchemy.get_table(column_mode=column_mode))
+    pd.testing.assert_frame_equal(expected, asyncio.run(alchemy.aget_table(column_mode=column_mode)))
+    pd.testing.assert_frame_equal(expected, asyncio.run(alchemy.lazy_table(column_mode=column_mode).acollect()))
+  finally:
+    alchemy.close()
+
+
+@pytest.mark.parametrize("format", ["csv", "parquet"])
+def test_export_matches_get_table(db, alchemy, tmp_path, format):
+  out_dir = tmp_path / "export"
+  main(["export", "--db", db, "--out-dir", str(out_dir), "--format", format, "--chunksize", "60"])
+  for survey_id in SURVEY_IDS:
+    path     = out_dir / f"{survey_id}.{format}"
+    exported = (pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[""]) if format == "csv"
+                else pd.read_parquet(path))
+    exported = exported.set_index(["survey_id", "response_id"])
+    expected = alchemy.get_table(survey_ids=survey_id)
+    # exports put the columns in question order
+    assert sorted(exported.columns) == sorted(expected.columns)
+    pd.testing.assert_frame_equal(plain(expected[exported.columns]), plain(exported))
+
+
+def test_workers_refuse_uncommitted_writes(con, db_path):
+  # the workers' connections could not see the survey written here
+  alchemy = Alchemy(db_path)
+  try:
+    alchemy.query("INSERT INTO survey (id, title) VALUES (1, 'Survey 1') RETURNING id;", cache=False)
+    with pytest.raises(RuntimeError):
+      alchemy.get_table(workers=2)
+  finally:
+    alchemy.close()
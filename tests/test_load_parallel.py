@@ -0,0 +1,32 @@
+import load_survey
+from alchemy.replay import FixtureStore
+
+from api_fixtures import API_KEY, API_SECRET, answers, api_fixtures, load, make_survey, replay_scheduler
+
+
+def test_parallel_load_matches_serial(con, other):
+  surveys = [make_survey(101, 250, seed=1), make_survey(102, 40, seed=2), make_survey(103, 120, seed=3)]
+  store   = FixtureStore(api_fixtures(*surveys))
+
+  errors = load_survey.load_surveys_parallel(con, [s["id"] for s in surveys], API_KEY, API_SECRET,
+                                             replay_scheduler(store), workers=3, concurrency=4)
+  assert errors == {s["id"]: None for s in surveys}
+
+  for survey in surveys:
+    assert load(other, survey["id"], replay_scheduler(store)) is None
+  assert answers(con) == answers(other)
+
+
+def test_parallel_load_of_a_repeated_survey(con):
+  # a repeated id used to share one write queue between two producers
+  survey = make_survey(101, 250, seed=1)
+  store  = FixtureStore(api_fixtures(survey, make_survey(102, 40, seed=2)))
+
+  errors = load_survey.load_surveys_parallel(con, ["101", "102", "101"], API_KEY, API_SECRET,
+                                             replay_scheduler(store), workers=3, concurrency=4)
+  assert errors == {"101": None, "102": None}
+  assert con.execute("SELECT COUNT(*) FROM response WHERE survey_id = 101").fetchone()[0] == 250
+  assert con.execute("SELECT data_version FROM sync_state WHERE survey_id = 101").fetchone()[0] == 1
+
+  single = answers(con, 101)
+  assert len(single) == len(set(single))
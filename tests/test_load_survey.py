@@ -0,0 +1,280 @@
+import copy
+import gzip
+import json
+import os
+import random
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+import load_survey
+from alchemy import Alchemy
+from alchemy import scheduler as scheduler_module
+from alchemy.replay import FixtureRecorder, FixtureStore, ReplayAdapter, ReplayServer, Throttle
+from alchemy.scheduler import AdaptiveLimiter, RequestScheduler
+
+from api_fixtures import API_KEY, API_SECRET, answers, api_fixtures, load, make_response, make_survey, replay_scheduler
+
+
+def fresh_load(db, survey: dict) -> list:
+  # the survey's answers as a full load into an empty database stores them
+  assert load(db, survey["id"], replay_scheduler(FixtureStore(api_fixtures(survey))), incremental=False) is None
+  return answers(db)
+
+
+# executemany with savepoint bisection (user-002)
+
+def test_bulk_writer_skips_only_the_bad_rows(con):
+  con.execute("CREATE TEMP TABLE t (x INTEGER UNIQUE);")
+  con.execute("BEGIN;")
+  con.execute("INSERT INTO t VALUES (-1);")
+  writer = load_survey.BulkWriter(con.cursor(), "INSERT INTO t VALUES (?);", suppress_output=True, batch_size=64)
+  writer.write([(x,) for x in range(200)] + [(7,), (-1,), (150,)])
+  writer.flush()
+  con.commit()
+  assert writer.rowcount == 200
+  # the row written before the writer survives its rolled back batches
+  assert [x for x, in con.execute("SELECT x FROM t ORDER BY x")] == list(range(-1, 200))
+
+
+def test_repeated_response_on_a_page_is_loaded_once(con, other):
+  survey   = make_survey(101, 250, seed=1)
+  repeated = copy.deepcopy(survey)
+  repeated["responses"].insert(10, copy.deepcopy(survey["responses"][4]))
+
+  assert load(con, 101, replay_scheduler(FixtureStore(api_fixtures(repeated)))) is None
+  assert answers(con) == fresh_load(other, survey)
+
+
+# pipelined response pages (user-001)
+
+class SlowEarlyPages(FixtureStore):
+  # answers earlier pages last, so responses come back out of page order
+  def lookup(self, url):
+    page = parse_qs(urlsplit(url).query).get("page")
+    if page:
+      time.sleep(0.05 / int(page[0]))
+    return super().lookup(url)
+
+
+def test_pages_are_yielded_in_page_order(con, other):
+  survey = make_survey(101, 950, seed=4)
+  store  = SlowEarlyPages(api_fixtures(survey))
+  path   = f"{load_survey.ALCHEMER_HOST}/v5/survey/101/surveyresponse"
+  params = {"api_token": API_KEY, "api_token_secret": API_SECRET, "resultsperpage": load_survey.RESULTS_PER_PAGE}
+
+  pages = list(load_survey.iter_response_pages(replay_scheduler(store, concurrency=8), path, params, concurrency=8))
+  assert [page for page, _ in pages] == list(range(1, 11))
+  assert [r["id"] for _, res in pages for r in res.json()["data"]] == [r["id"] for r in survey["responses"]]
+
+  assert load(con, 101, replay_scheduler(store, concurrency=8), concurrency=8) is None
+  assert answers(con) == fresh_load(other, survey)
+
+
+# utc high water marks and incremental sync (user-004)
+
+def test_high_water_mark_is_stored_in_utc(con):
+  survey = make_survey(101, 250, seed=1)
+  survey["responses"][-1]["date_updated"] = "2024-07-04 09:30:00 EDT"
+  assert load(con, 101, replay_scheduler(FixtureStore(api_fixtures(survey)))) is None
+
+  mark = con.execute("SELECT high_water_mark FROM sync_state WHERE survey_id = 101").fetchone()[0]
+  assert mark == "2024-07-04T13:30:00+00:00"
+  assert load_survey.get_high_water_mark(con.cursor(), "101") == mark
+
+
+def test_timestamps_convert_to_utc():
+  assert load_survey.utc_timestamp("2024-01-28 10:00:00 EST") == "2024-01-28T15:00:00+00:00"
+  assert load_survey.utc_timestamp("2024-07-04 09:30:00 EDT") == "2024-07-04T13:30:00+00:00"
+  assert load_survey.utc_timestamp("2024-07-04T13:30:00+00:00") == "2024-07-04T13:30:00+00:00"
+  # marks stored before they were kept in utc are read as EDT
+  assert load_survey.utc_timestamp("2024-01-28 10:00:00") == "2024-01-28T14:00:00+00:00"
+  with pytest.raises(load_survey.LoadError):
+    load_survey.utc_timestamp("2024-01-28 10:00:00 PST")
+
+
+def test_sync_filter_asks_for_eastern_standard_time():
+  params = load_survey.sync_filter_params("date_updated", "2024-07-04T13:30:00+00:00")
+  assert params == {"filter[field][0]":    "date_updated",
+                    "filter[operator][0]": ">=",
+                    "filter[value][0]":    "2024-07-04 08:30:00"}
+  # the hour repeated when clocks fall back is asked for again
+  fall_back = load_survey.sync_filter_params("date_updated", load_survey.utc_timestamp("2024-11-03 01:30:00 EDT"))
+  assert fall_back["filter[value][0]"] == "2024-11-03 00:30:00"
+
+
+def test_incremental_sync_replaces_updated_responses(con, other):
+  survey = make_survey(101, 250, seed=1)
+  assert load(con, 101, replay_scheduler(FixtureStore(api_fixtures(survey)))) is None
+  since = load_survey.get_high_water_mark(con.cursor(), "101")
+
+  # one response edited, with a grid row now left blank, and one new response
+  updated = copy.deepcopy(survey)
+  edited  = updated["responses"][2]
+  edited["date_updated"] = "2024-02-02 12:00:00 EST"
+  edited["survey_data"]["4"]["answer"] = "mallory"
+  edited["survey_data"]["5"]["sub_questions"]["6"] = {"id": 6, "type": "RADIO", "answer_id": None, "answer": None}
+  updated["responses"].append(make_response(251, random.Random(9), "2024-02-03 08:00:00 EST"))
+
+  store = FixtureStore(api_fixtures(updated, since=since))
+  assert load(con, 101, replay_scheduler(store)) is None
+  assert answers(con) == fresh_load(other, updated)
+  assert load_survey.get_high_water_mark(con.cursor(), "101") == "2024-02-03T13:00:00+00:00"
+
+
+# request scheduling and backoff (user-007)
+
+def test_throttled_load_backs_off_and_completes(con, other, monkeypatch):
+  monkeypatch.setattr(scheduler_module, "BACKOFF_BASE", 0.01)
+  survey    = make_survey(101, 950, seed=4)
+  scheduler = replay_scheduler(FixtureStore(api_fixtures(survey)), Throttle(rate_limit=4, window=0.2),
+                               concurrency=8, max_retries=20)
+
+  assert load(con, 101, scheduler, concurrency=8) is None
+  assert answers(con) == fresh_load(other, survey)
+  assert scheduler.concurrency < 8
+
+
+def test_adaptive_limiter_halves_and_recovers():
+  limiter = AdaptiveLimiter(8)
+  limiter.on_throttle()
+  limiter.on_throttle()
+  assert limiter.limit == 2
+  for _ in range(2):
+    limiter.on_success()
+  assert limiter.limit == 3
+  for _ in range(3):
+    limiter.on_success(headroom=False)
+  assert limiter.limit == 2
+
+
+def test_retries_stop_at_max_retries(monkeypatch):
+  monkeypatch.setattr(scheduler_module, "BACKOFF_BASE", 0.001)
+  store     = FixtureStore({"/v5/survey/1?": (503, b"{}")})
+  scheduler = replay_scheduler(store, max_retries=2)
+  assert scheduler.get(f"{load_survey.ALCHEMER_HOST}/v5/survey/1").status_code == 503
+
+
+class StallingAdapter(ReplayAdapter):
+  # times out on the first `stalls` requests, noting the timeout each got
+  def __init__(self, store: FixtureStore, stalls: int, error: type):
+    super().__init__(store)
+    self.stalls   = stalls
+    self.error    = error
+    self.timeouts = []
+
+  def send(self, request, **kwargs):
+    self.timeouts.append(kwargs.get("timeout"))
+    if len(self.timeouts) <= self.stalls:
+      raise self.error("stalled")
+    return super().send(request, **kwargs)
+
+
+@pytest.mark.parametrize("error", [requests.ReadTimeout, requests.ConnectionError])
+def test_timeouts_are_retried(con, other, monkeypatch, error):
+  monkeypatch.setattr(scheduler_module, "BACKOFF_BASE", 0.001)
+  survey  = make_survey(101, 250, seed=1)
+  adapter = StallingAdapter(FixtureStore(api_fixtures(survey)), stalls=3, error=error)
+  session = requests.Session()
+  session.mount(load_survey.ALCHEMER_HOST, adapter)
+  scheduler = RequestScheduler(session, rate_limit=60_000, timeout=5.0)
+
+  assert load(con, 101, scheduler) is None
+  assert answers(con) == fresh_load(other, survey)
+  assert set(adapter.timeouts) == {5.0}
+
+
+def test_retries_give_up_on_a_stalled_api(monkeypatch):
+  monkeypatch.setattr(scheduler_module, "BACKOFF_BASE", 0.001)
+  session = requests.Session()
+  session.mount(load_survey.ALCHEMER_HOST, StallingAdapter(FixtureStore({}), stalls=10, error=requests.ReadTimeout))
+  scheduler = RequestScheduler(session, max_retries=2)
+  with pytest.raises(requests.ReadTimeout):
+    scheduler.get(f"{load_survey.ALCHEMER_HOST}/v5/survey/1")
+
+
+# recording and replaying the api (user-006)
+
+def test_recorded_fixtures_replay_the_same_load(con, other, tmp_path):
+  survey   = make_survey(101, 250, seed=1)
+  recorded = str(tmp_path / "fixtures.jsonl.gz")
+  with ReplayServer(FixtureStore(api_fixtures(survey))) as server, FixtureRecorder(recorded) as recorder:
+    session = load_survey.make_session(4)
+    recorder.attach(session)
+    scheduler = RequestScheduler(session, rate_limit=60_000, max_concurrency=4)
+    assert load(con, 101, scheduler, concurrency=4, host=server.url) is None
+
+  with gzip.open(recorded, "rt") as f:
+    keys = [json.loads(line)["key"] for line in f]
+  assert len(keys) == 5 and not any("api_token" in key for key in keys)
+
+  assert load(other, 101, replay_scheduler(FixtureStore.load(recorded)), incremental=False) is None
+  assert answers(other) == answers(con)
+
+
+def test_missing_fixture_fails_the_load(con):
+  assert load(con, 101, replay_scheduler(FixtureStore({}))) is not None
+  assert con.execute("SELECT COUNT(*) FROM survey").fetchone()[0] == 0
+
+
+# page parsing (user-009)
+
+def test_unanswered_single_select_sub_questions_are_skipped(con):
+  survey = make_survey(101, 250, seed=1)
+  kinds  = load_survey.answer_kinds(load_survey.QuestionIndex.from_questions_data(
+    [{**q, "type": load_survey.QUESTION_TYPE_STR_MAP[q["type"]].value,
+           "base_type": load_survey.BASE_TYPE_STR_MAP[q["base_type"]].value}
+     for q in survey["questions"] + survey["questions"][4]["sub_questions"]]))
+  blank  = sum(r["survey_data"]["5"]["sub_questions"]["7"]["answer_id"] is None for r in survey["responses"])
+  color  = sum("answer_id" not in r["survey_data"]["2"] for r in survey["responses"])
+  parsed = load_survey.parse_answer_page(survey["responses"], "101", kinds)
+  assert blank and parsed.null_answers == blank + color
+  assert all(row[2] is not None for row in parsed.rows)
+
+  assert load(con, 101, replay_scheduler(FixtureStore(api_fixtures(survey)))) is None
+  stored = con.execute("SELECT COUNT(*) FROM answer WHERE sub_question_id = 7").fetchone()[0]
+  assert stored == 250 - blank
+
+
+def test_malformed_answer_fails_the_load(con):
+  survey = make_survey(101, 250, seed=1)
+  del survey["responses"][3]["survey_data"]["3"]["options"]["10003"]["id"]
+  err = load(con, 101, replay_scheduler(FixtureStore(api_fixtures(survey))))
+  assert err is not None and "could not parse" in err
+  assert con.execute("SELECT COUNT(*) FROM answer").fetchone()[0] == 0
+
+
+# survey data versions (user-017)
+
+def data_version(con, survey_id) -> int:
+  return con.execute("SELECT data_version FROM sync_state WHERE survey_id = ?", (survey_id,)).fetchone()[0]
+
+
+def test_data_version_moves_only_when_a_load_changes_rows(con, db_path, tmp_path):
+  survey = make_survey(101, 250, seed=1)
+  store  = FixtureStore(api_fixtures(survey))
+  assert load(con, 101, replay_scheduler(store)) is None
+  assert data_version(con, 101) == 1
+
+  # cached tables are kept across loads that leave their surveys alone
+  cache  = tmp_path / "cache"
+  cached = Alchemy(db_path, cache_dir=str(cache))
+  cached.get_table()
+  files  = sorted(os.listdir(cache))
+
+  # the same responses again write nothing
+  assert load(con, 101, replay_scheduler(store), incremental=False) is None
+  assert data_version(con, 101) == 1
+  cached.get_table()
+  assert sorted(os.listdir(cache)) == files
+
+  updated = copy.deepcopy(survey)
+  updated["responses"].append(make_response(251, random.Random(9), "2024-02-03 08:00:00 EST"))
+  since = load_survey.get_high_water_mark(con.cursor(), "101")
+  assert load(con, 101, replay_scheduler(FixtureStore(api_fixtures(updated, since=since)))) is None
+  assert data_version(con, 101) == 2
+  assert len(cached.get_table()) == 251
+  assert sorted(os.listdir(cache)) != files
+  cached.close()
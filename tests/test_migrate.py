@@ -0,0 +1,58 @@
+import logging
+import sqlite3
+
+import pytest
+
+from alchemy import Alchemy
+from alchemy.cli import main
+from alchemy.migrations import LATEST_VERSION, schema_version
+
+
+def version(db_path: str) -> int:
+  con = sqlite3.connect(db_path)
+  try:
+    return schema_version(con)
+  finally:
+    con.close()
+
+
+def test_opening_does_not_migrate(db_path, caplog):
+  with caplog.at_level(logging.WARNING, logger="alchemy.alchemy"):
+    Alchemy(db_path).close()
+  assert version(db_path) == 0
+  assert "alchemy migrate" in caplog.text
+
+
+def test_migrate_on_open(db_path):
+  alchemy = Alchemy(db_path, migrate=True)
+  assert alchemy.schema_version == LATEST_VERSION
+  alchemy.close()
+
+
+def test_migrate_step_by_step(db_path, caplog):
+  alchemy = Alchemy(db_path)
+  try:
+    assert alchemy.migrate(target=3) == 3
+    with caplog.at_level(logging.INFO, logger="alchemy.alchemy"):
+      assert alchemy.migrate() == LATEST_VERSION
+    assert f"from schema version 3 to {LATEST_VERSION}" in caplog.text
+    assert alchemy.get_records().empty
+  finally:
+    alchemy.close()
+
+
+def test_read_only_cannot_migrate(con, db_path):
+  alchemy = Alchemy(db_path, read_only=True)
+  try:
+    with pytest.raises(RuntimeError):
+      alchemy.migrate()
+  finally:
+    alchemy.close()
+
+
+def test_migrate_command(db_path, capsys):
+  main(["migrate", "--db", db_path, "--target", "4"])
+  main(["migrate", "--db", db_path])
+  assert version(db_path) == LATEST_VERSION
+  assert capsys.readouterr().out.splitlines() == [f"{db_path}: schema version 0 -> 4",
+                                                  f"{db_path}: schema version 4 -> {LATEST_VERSION}"]
@@ -0,0 +1,154 @@
+import random
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from alchemy import alchemy_types, pivot
+
+# Checks the pivot engine against the DataFrame.pivot calls it replaced, on
+# randomized record sets: the same tables, dtypes and labels included, and
+# the same error where DataFrame.pivot raises one.
+
+SEEDS      = 25
+LARGE_SEED = 6  # a record set of up to LARGE_SIZE records with no repeated cell
+LARGE_SIZE = 20_000
+
+QUESTION_TYPES = [0, 5, 6, 7, 8, 9, 10, 11, 12, 13, 17]
+TEXT_COLUMNS   = ["question", "subquestion", "option", "answer"]
+OPTION_ORDER   = {"": 0, "Red": 1, "X Blue": 2, "1": 3, None: np.nan}
+
+
+def random_records(seed: int, size: int = 60) -> pd.DataFrame:
+  # Up to `size` records over a few surveys, responses and questions, with
+  # missing subquestions, options and answers; mostly unique per cell, but
+  # now and then a repeated one
+  rng       = random.Random(seed)
+  responses = max(12, size // 10)
+  questions = [(f"q{rng.randint(0, 6)}{rng.choice(['', ' x', '-X'])}", rng.choice(QUESTION_TYPES))
+               for _ in range(rng.randint(1, 8))]
+  surveys   = rng.choice([[1, 2, 3], [1, 8005443]])
+  rows, seen = [], set()
+  for _ in range(rng.randint(0, size)):
+    survey_id, response_id = rng.choice(surveys), rng.randint(1, responses)
+    question, question_type = rng.choice(questions)
+    subquestion = rng.choice(["", "", "Row A", "X row", None]) if rng.random() < 0.3 else ""
+    option      = (rng.choice(["", None]) if question_type in alchemy_types.SINGLE_VALUE_QUESTION
+                   else rng.choice(["", "Red", "X Blue", "1", None]))
+    answer      = (rng.choice(["0", "1"]) if question_type in alchemy_types.MULTI_SELECT_QUESTIONS
+                   else rng.choice(["a", "b", None, "12"]))
+    key = (survey_id, response_id, question, subquestion, option)
+    if key in seen and rng.random() < 0.9:
+      continue
+    seen.add(key)
+    rows.append((survey_id, response_id, question, subquestion, option, OPTION_ORDER[option], answer, question_type))
+  records = pd.DataFrame(rows, columns=["survey_id", "response_id", "question", "subquestion", "option",
+                                        "option_order", "answer", "question_type"])
+  records = records.astype({"survey_id": np.int32, "response_id": np.int32, "option_order": np.float64,
+                            "question_type": np.int8, **{c: object for c in TEXT_COLUMNS}})
+  if rng.random() < 0.5:
+    records = records.sort_values(["survey_id", "response_id", "question"], kind="stable", ignore_index=True)
+  return records
+
+
+def record_variants(records: pd.DataFrame):
+  # as read with the numpy and the pyarrow dtype backends
+  yield records
+  yield records.astype({"survey_id": "int32[pyarrow]", "response_id": "int32[pyarrow]",
+                        **{c: pd.StringDtype("pyarrow") for c in TEXT_COLUMNS}})
+
+
+def cases():
+  # (seed, records) for each randomized record set, small ones first
+  for seed in range(SEEDS):
+    yield seed, random_records(seed)
+  yield LARGE_SEED, random_records(LARGE_SEED, LARGE_SIZE)
+
+
+def random_variable_names(records: pd.DataFrame, seed: int) -> pd.Series:
+  rng   = random.Random(seed)
+  names = [rng.choice(["q1", "Q1", "red_q2", "a", None]) for _ in range(len(records))]
+  return pd.Series(np.array(names, dtype=object), index=records.index)
+
+
+def pivot_flat(records: pd.DataFrame, variable_name: pd.Series) -> pd.DataFrame:
+  table = pd.DataFrame({"survey_id":     records["survey_id"],
+                        "response_id":   records["response_id"],
+                        "variable_name": variable_name,
+                        "answer":        records["answer"]})
+  table = table.drop_duplicates(subset=["survey_id", "response_id", "variable_name"])
+  return table.pivot(index=pivot.INDEX, columns="variable_name", values="answer")
+
+
+def pivot_sections(records: pd.DataFrame):
+  question_type = records["question_type"]
+
+  single_select = (records.loc[question_type.isin(alchemy_types.SINGLE_SELECT_QUESTIONS),
+                               pivot.INDEX + ["question", "subquestion", "option", "option_order"]]
+                          .assign(tmp_option=""))
+  single_select_options = single_select.drop_duplicates(subset=["question", "option"])[["question", "option", "option_order"]]
+  single_select = single_select.pivot(columns=["question", "subquestion", "tmp_option"], values="option", index=pivot.INDEX)
+  single_select.columns = single_select.columns.set_names("option", level=2)
+
+  multi_select = records.loc[question_type.isin(alchemy_types.MULTI_SELECT_QUESTIONS),
+                             pivot.INDEX + pivot.MULTI_COLUMNS + ["answer"]]
+  multi_select = multi_select.pivot(columns=pivot.MULTI_COLUMNS, values="answer", index=pivot.INDEX)
+  multi_select = multi_select.replace(pivot.CHECKED).astype("boolean")
+
+  value = records.loc[question_type.isin(alchemy_types.SINGLE_VALUE_QUESTION + alchemy_types.MULTI_VALUE_QUESTIONS),
+                      pivot.INDEX + pivot.MULTI_COLUMNS + ["answer"]]
+  value = value.pivot(columns=pivot.MULTI_COLUMNS, values="answer", index=pivot.INDEX)
+
+  return single_select, single_select_options, multi_select, value
+
+
+def outcome(build):
+  # the result, or the type of the error raised instead
+  try:
+    return build()
+  except (ValueError, KeyError, TypeError) as e:
+    return type(e)
+
+
+class PivotTest(unittest.TestCase):
+  def assertSameOutcome(self, expected, got, seed: int):
+    if isinstance(expected, type) or isinstance(got, type):
+      self.assertEqual(expected, got, f"seed {seed}")
+    elif isinstance(expected, tuple):
+      for expected_part, got_part in zip(expected, got):
+        self.assertSameOutcome(expected_part, got_part, seed)
+    else:
+      # with no names at all, DataFrame.pivot labels its one column float64
+      # or object depending on the answers' dtype; the engine keeps that of
+      # the names
+      unnamed = expected.columns.nlevels == 1 and len(expected.columns) > 0 and expected.columns.isna().all()
+      pd.testing.assert_frame_equal(expected, got, check_column_type=not unnamed, obj=f"seed {seed}")
+
+  def test_flat_table(self):
+    for seed, base in cases():
+      for records in record_variants(base):
+        variable_name = random_variable_names(records, seed)
+        self.assertSameOutcome(outcome(lambda: pivot_flat(records, variable_name)),
+                               outcome(lambda: pivot.flat_table(records, variable_name)), seed)
+
+  def test_multi_table(self):
+    # the sections put side by side, as get_table does
+    def side_by_side(sections):
+      single_select, _, multi_select, value = sections
+      return pd.concat([single_select, multi_select, value], axis=1)
+
+    for seed, base in cases():
+      for records in record_variants(base):
+        self.assertSameOutcome(outcome(lambda: side_by_side(pivot_sections(records))),
+                               outcome(lambda: side_by_side(pivot.multi_sections(records))), seed)
+
+  def test_unaligned_sections(self):
+    # each section on its own rows, as chunked get_table stacks them
+    for seed, base in cases():
+      for records in record_variants(base):
+        self.assertSameOutcome(outcome(lambda: pivot_sections(records)),
+                               outcome(lambda: pivot.multi_sections(records, aligned=False)), seed)
+
+
+if __name__ == "__main__":
+  unittest.main()
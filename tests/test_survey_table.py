@@ -0,0 +1,33 @@
+import copy
+
+import pytest
+
+from alchemy import Alchemy
+from alchemy.replay import FixtureStore
+
+from api_fixtures import api_fixtures, load, make_survey, replay_scheduler
+
+
+@pytest.fixture
+def alchemy(con, db_path):
+  # survey 102 asks one question survey 101 does not
+  first, second = make_survey(101, 30, seed=1), make_survey(102, 30, seed=2)
+  second["questions"] = copy.deepcopy(second["questions"]) + [
+    {"id": 9, "type": "TEXTBOX", "base_type": "Question", "title": {"English": "Extra"}, "shortname": "extra"}]
+  for response in second["responses"]:
+    response["survey_data"]["9"] = {"id": 9, "type": "TEXTBOX", "answer": "more"}
+  store = FixtureStore(api_fixtures(first, second))
+  for survey in (first, second):
+    assert load(con, survey["id"], replay_scheduler(store)) is None
+  alchemy = Alchemy(db_path)
+  yield alchemy
+  alchemy.close()
+
+
+def test_names_resolve_in_the_selected_surveys(alchemy):
+  assert list(alchemy.lazy_table(102).select("extra", "1name").collect().columns) == ["1name", "extra"]
+  assert "extra" in alchemy.lazy_table().select("extra").collect().columns
+  with pytest.raises(ValueError, match="extra"):
+    alchemy.lazy_table(101).select("extra").collect()
+  with pytest.raises(ValueError, match="extra"):
+    alchemy.lazy_table([101]).filter("extra", "==", "more").collect()